@@ -1,86 +1,57 @@
 import numpy as np
 import matplotlib.pyplot as plt
-import ROOT
+
+from tdc.loader import load_run
+from tdc.coincidence import build_events, event_values, fold_counts
+from tdc.calib import get_luts, remove_overflow
+from tdc.fit import fit_gaussian
+from tdc.parallel import calibrate_parallel, iter_coincidences
+from tdc.catalog import find_run
 
 freq = 12e6
 
-# Folder
-timestamp = '2024-11-25_16:35:04'
+# Histogram and fit of the time differences: 'numpy' (no ROOT needed) or 'root'. Both give the same sigma and mu.
+fit_backend = 'numpy'
+
+# Folder to read data from: the latest run of this design. Give the folder name or a part of it to use another
+# run, e.g. find_run('2025-02-21'). python -m tdc.catalog lists the runs with their hits and time span
+timestamp = find_run('latest', design = 'four_channels')
 
 # Channels to use
 channels = ['00', '01', '10', '11']
 
-all_bins = {channel: [] for channel in channels}
-all_timestamps = {channel: [] for channel in channels}
-all_data = {channel: [] for channel in channels}
-all_overflow = {channel: [] for channel in channels}
+# For runs that do not fit into memory: calibrate and build the events chunk by chunk on all cores
+# (tdc/parallel.py, needs hits.tdc). Gives the same calibration and differences as the normal way.
+out_of_core = False
 
-# Read the data from the file
-def get_data(directory, channel) -> list[int]:
-    with open(f'./data/{directory}/{channel}.txt', 'r') as f:
-        data = np.loadtxt(f, dtype = str, usecols = 0, delimiter=',')
-        data = [int(i) for i in data]   
-    return data
+# Read the fine values of the given channels (hits.tdc or 00.txt ... 11.txt)
+def get_data(directory, channels) -> dict[str, np.ndarray]:
+    return {channel: hits.fine for channel, hits in load_run(directory, channels).items()}
 
 # Calculate the calibration
-def plot_calib(dir, channels):
+def plot_calib(dir, channels, data = None, luts = None):
     
     plt.figure(figsize=(12, 12))
     
-    # For each channel
-    for i, channel in enumerate(channels):
-        
-        # Read data of channel, find max bin (overflow bin)
-        data = get_data(dir, channel)
-        vals = np.unique(data)
-        max_data = vals[-1]
-
-        # Save data and positions of overflow bins
-        all_data[channel] = data
-        all_overflow[channel] = np.where(np.array(data) == max_data)[0]
+    all_data = None
+    if luts is None:
+        # Read data of all channels (if not given) and remove the overflow bins. Has to be done in each channel
+        # to ensure that the remaining values match
+        all_data = remove_overflow(data if data is not None else get_data(dir, channels))
         
-    # Find all overflow bins across the channels
-    overflow = np.unique(np.concatenate([all_overflow[channel] for channel in channels]))
+        # Bin widths and bin center times of all channels. Loaded from ./data/<dir>/calibration if the run
+        # was calibrated before, otherwise calculated and saved there
+        luts = get_luts(f'./data/{dir}', channels, all_data, freq)
+    all_bins = {channel: luts[channel].widths for channel in channels}
+    all_timestamps = {channel: luts[channel].centers for channel in channels}
     
-    # Remove overflow bins in each file. Has to be done in each file to ensure that the remaining values match
-    for channel in channels:
-        all_data[channel] = np.delete(all_data[channel], overflow)
-        
     # For each channel
     for i, channel in enumerate(channels):
         
-        # Read data
-        data = all_data[channel]
-        entries = len(data)
-        bins = []
-        
-        # Find unique values and counts
-        vals, counts = np.unique(data, return_counts=True)
-        max_data = vals[-1]
-
-        # Fill in missing bins with 0. Nessessary to ensure that the bins are in the correct order even if one stayed empty
-        full_range = np.arange(max_data)
-        missing = np.setdiff1d(full_range, vals)
-        for m in missing:
-            counts = np.insert(counts, m, 0)
-    
-        # Calculate the bin width in ns
-        for j in range(max_data + 1):
-            bins.append((counts[j]/entries) * 1/freq)
-
-        # Rescale for better readability
-        bins = np.array(bins) * 1e9
-        
-        # Calculate the timestamps of each bin
-        timestamps = np.cumsum(bins)
-        
-        # Save the data
-        all_bins[channel] = bins
-        all_timestamps[channel] = timestamps
-        
         # Plot distribution of bin widths
+        bins = all_bins[channel]
         plt.subplot(2, 2, i+1)
-        plt.bar(range(max_data+1), bins, width=1, edgecolor = 'black', linewidth = .5, align='edge')
+        plt.bar(range(len(bins)), bins, width=1, edgecolor = 'black', linewidth = .5, align='edge')
         plt.xlabel('Bins')
         plt.ylabel('Bin width [ns]')
         plt.title(f'Channel {int(channel, 2)}')
@@ -90,36 +61,55 @@ def plot_calib(dir, channels):
     return all_data, all_bins, all_timestamps
 
 
+# Timestamps for the event building. This design has no coarse counter yet, so the hit number in each channel
+# is used: hits with the same number belong to the same input signal. Channel 00 is off by one.
+# Returns the timestamps and the window for the event building
+def get_stamps(data, channels) -> tuple[dict[str, np.ndarray], int]:
+    stamps = {channel: np.arange(len(data[channel])) for channel in channels}
+    if '00' in stamps:
+        stamps['00'] = stamps['00'] - 1
+    return stamps, 0
+
 # Coincidence plot
-def coincidence(timestamps, data, channels, mean):
+def coincidence(timestamps, data, stamps, window, channels, mean):
     
-    times = {channel: [] for channel in channels}
+    # Remove the overflow bin of each channel. The channels do not have to stay aligned, the events
+    # are built from the timestamps of the remaining hits
+    keep = {channel: data[channel] != np.max(data[channel]) for channel in channels}
     
-    lens = [len(data[channel]) for channel in channels]
+    # Group the hits of all channels into events. For the mean, all four channels are needed
+    events = build_events({channel: stamps[channel][keep[channel]] for channel in channels}, window, 
+                          min_fold = 4 if mean else 2)
+    print(f'Events per fold: {fold_counts(events)}')
     
-    # For each channel
-    for channel in channels:
-        data[channel] = np.array(data[channel])
+    # Convert arrival bins to arrival times
+    times = {channel: np.array(timestamps[channel])[data[channel][keep[channel]]] for channel in channels}
+    col = {channel: k for k, channel in enumerate(events.channels)}
+    
+    # If mean --> Use mean of two channels and then calculate coincidence
+    if mean == True:
         
-        # Cut everything longer than the shortest channel. Useful if one channel stopped earlier
-        data[channel] = data[channel][:min(lens)]
+        # Times of the events where all four channels were hit
+        t = event_values(events.having(['00', '01', '10', '11']), times)
         
-        # Convert arrival bins to arrival times
-        timestamps[channel] = np.array(timestamps[channel])
-        times[channel] = timestamps[channel][data[channel]]
+    # If not mean --> Calculate the difference between the first two channels
+    else:
+        
+        # Times of the events where the first two channels were hit
+        t = event_values(events.having(['00', '01']), times)
+        
+    # Plot the histogram of the differences (convert to ps)
+    plot_hist(time_difference(t, col, mean)*1e3)
+
+# Time differences in ns from the times of the events (rows) in the channels (columns col)
+def time_difference(t, col, mean):
     
     # If mean --> Use mean of two channels and then calculate coincidence
     if mean == True:
         
-        # Sync the channels. Not quite sure why channel 1 is off by one, but it is
-        times['00'] = times['00'][1:]  
-        times['01'] = times['01'][:-1]
-        times['10'] = times['10'][:-1]
-        times['11'] = times['11'][:-1]
-        
         # Calculate the mean of the two channels
-        mean1 = np.mean([times['00'], times['01']], axis=0)
-        mean2 = np.mean([times['10'], times['11']], axis=0)
+        mean1 = np.mean(t[:, [col['00'], col['01']]], axis=1)
+        mean2 = np.mean(t[:, [col['10'], col['11']]], axis=1)
         
         # Calculate the difference
         diff = mean1 - mean2
@@ -127,12 +117,8 @@ def coincidence(timestamps, data, channels, mean):
     # If not mean --> Calculate the difference between the first two channels
     else:
         
-        # Sync the channels, as above
-        times['00'] = times['00'][1:]  
-        times['01'] = times['01'][:-1]
-        
         # Calculate the difference
-        diff = times['00'] - times['01']
+        diff = t[:, col['00']] - t[:, col['01']]
         
     # Correct for overflows
     mask = diff < 0
@@ -143,52 +129,28 @@ def coincidence(timestamps, data, channels, mean):
 
     # Remove outliers
     mask = diff < 3
-    diff = diff[mask]
-    
-    # Plot the histogram of the differences (convert to ps)
-    plot_hist(diff*1e3)
+    return diff[mask]
     
 # Plot the histogram and fit a gaussian
 def plot_hist(data):
-    
-    # Find the range of the data
-    range_ = [int(np.min(data)//100 * 100) - 50 ,int((np.max(data)) + 100)//100 * 100 + 50]
-    length_ = int((range_[1] - range_[0])/100)
+    result = fit_gaussian(data, backend = fit_backend, probs = (0.01, 0.99), save = f'./data/{timestamp}/fit.pdf')
+    print(f'sigma = {result.sigma:.1f} +- {result.sigma_err:.1f} ps, mu = {result.mu:.1f} +- {result.mu_err:.1f} ps')
+    return result
 
-    # Create the histogram
-    hist = ROOT.TH1F('Statistics', 'Coincidence with mean', length_ + 2, range_[0] - 100, range_[1] + 100)
-    
-    # Fill the histogram and scale it
-    for i in data:
-        hist.Fill(i)
-    hist.Scale(1/hist.Integral("width"))
-    
-    # Find the quantiles for suitable fit range (fit within 1% and 99%)
-    q_ = np.zeros(2)
-    hist.GetQuantiles(2, q_, np.array([0.01, 0.99]))
-    q0 = q_[0]
-    q1 = q_[1]
-    
-    # Fit the histogram with a gaussian
-    func = ROOT.TF1('func', 'ROOT::Math::normal_pdf(x, [0], [1])', q0, q1)   
-    func.SetParameters(hist.GetRMS(), hist.GetMean())
-    func.SetParNames('#sigma', '#mu')
-    hist.Fit('func', 'Q')
-    
-    # Plot
-    fit_max = func.GetMaximum() * 1.1
-    hist.GetYaxis().SetRangeUser(0, fit_max)
-    hist.GetXaxis().SetTitle('Time difference [ps]')
-    hist.GetYaxis().SetTitle('Abundance')
-    
-    ROOT.gStyle.SetOptFit(1)
-    ROOT.gStyle.SetOptStat(11)
-    
-    c = ROOT.TCanvas('c', 'c', 800, 600)
-    hist.Draw("hist")
-    func.Draw('same')
-    c.SaveAs(f'./data/{timestamp}/fit.pdf')
-    
 
-data_, bins_, timestamps_ = plot_calib(timestamp, channels)
-coincidence(timestamps_, data_, channels, True)
\ No newline at end of file
+if out_of_core:
+    # Same steps as below, the hit number stamps of get_stamps are built by the workers (offset of channel 00).
+    # Only the differences of each chunk are kept
+    luts_ = calibrate_parallel(f'./data/{timestamp}', channels, freq)
+    plot_calib(timestamp, channels, luts = luts_)
+    required = ['00', '01', '10', '11']
+    chunks = iter_coincidences(f'./data/{timestamp}', channels, window = 0, min_fold = 4, offsets = {'00': -1},
+                               luts = luts_, require = required)
+    diff_ = np.concatenate([time_difference(t, {channel: k for k, channel in enumerate(events.channels)}, True)
+                            for events, t in chunks])
+    plot_hist(diff_*1e3)
+else:
+    data_ = get_data(timestamp, channels)
+    stamps_, window_ = get_stamps(data_, channels)
+    _, bins_, timestamps_ = plot_calib(timestamp, channels, data_)
+    coincidence(timestamps_, data_, stamps_, window_, channels, True)
\ No newline at end of file
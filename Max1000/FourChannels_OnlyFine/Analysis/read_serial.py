@@ -1,69 +1,48 @@
-import serial
-import matplotlib.pyplot as plt
-import time
-import datetime
-import os
+import argparse
 
-# Open the serial port
-ser = serial.Serial(port = '/dev/serial/by-id/usb-Arrow_Arrow_USB_Blaster_TEI0001_ARA27238-if01-port0', baudrate = 115200, bytesize=8)
+from tdc.acquire import acquire, DEFAULT_PORT
 
-timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
-output_dec = " "
-parity = 0
-
-# Create a directory to store the output files
-directory = "./data/" + timestamp
-os.mkdir(directory)
-with open(f'{directory}/00.txt', 'a') as f:
-    f.write('')
-with open(f'{directory}/01.txt', 'a') as f:
-    f.write('')
-with open(f'{directory}/10.txt', 'a') as f:
-    f.write('')
-with open(f'{directory}/11.txt', 'a') as f:
-    f.write('')
+# The serial port and the runtime can be given on the command line. Use --port with the
+# pseudo terminal or socket://localhost:<port> of the emulator (python -m tdc.emulator) to test without the board.
+# The same as: tdc acquire --format channels --port ... --runtime ...
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', default = DEFAULT_PORT)
+parser.add_argument('--runtime', type = float, default = 1000, help = 'minutes to read')
+args = parser.parse_args()
 
 # Use time to read for certain amount of time
-runtime_mins = 1000  # mins
-start_time = time.time()
+runtime_mins = args.runtime  # mins
 runtime_secs = runtime_mins * 60
+freq = 12e6
+
+# Read, decode and write in separate threads so slow disk writes can not stall the serial read
+pipelined = True
+
+# Write the hits to the binary file hits.tdc instead of 00.txt ... 11.txt.
+# Convert with tdc convert to-text if the text files are needed.
+binary = True
+
+# Update the calibration during the run to follow drifts of the bin widths. A new LUT is saved
+# to {directory}/calibration/online every 10^5 hits, the histogram forgets on a scale of 10^6 hits.
+online_calibration = False
+
+# The output of one channel for one input signal are two bytes.
+# The first byte contains the channel ID and the overflow bit. The second byte contains the 8-bit data.
+# If the order gets shifted by a lost byte, the decoder notices it (zero bits set, channels out of order),
+# discards bytes until the frames fit again and prints how many were discarded.
+
+# Health metrics (bytes/s, hits/s, sync errors, serial buffer and queue fill, flush latency) are written
+# to {directory}/health.json every 5 s. Use a .prom file name for Prometheus text, set metrics_port to
+# also serve them on http://127.0.0.1:<port>/metrics
+metrics_file = 'health.json'
+metrics_port = None
 
-while (time.time() - start_time) < runtime_secs:   
-    # Read the serial port 
-    c = ser.read()
-    # If the read is not empty, decode it. The output of one channel for one input signal are two bytes.
-    # The first byte contains the channel ID and the overflow bit. The second byte contains the 8-bit data.
-    # Always alternate between the two bytes.
-    if len(c) != '':
-        # Two cases since data is UTF-encoded if in range, after this the data is in hex.
-        # First two bits are the channel ID, the last bit is the overflow bit.
-        if parity == 0:
-            try:
-                utf = c.decode()
-                bits = ' '.join([f'{i:08b}' for i in utf.encode('utf-8')])
-                channel = bits[0:2]
-                overflow = bits[-1]
-            except:
-                c = ('0' + str(c)[3:-1])
-                bits = bin(int(c, 16))
-                channel = bits[2:4]
-                overflow = bits[-1]  
-            parity = 1
-                
-        # Remaining fine bits
-        elif parity == 1:
-            try:
-                utf = c.decode()
-                bits = ' '.join([f'{i:08b}' for i in utf.encode('utf-8')])
-                output_dec = (int(bits, 2))
-            except:
-                c = ('0' + str(c)[3:-1])
-                output_dec = int(c, 16)
-            output_dec += 256 * int(overflow)
-            parity = 0
+# Also store the fine code histograms in time slices of drift_secs (e.g. 60) in {directory}/drift to follow
+# the drift of the bin widths, see tdc drift show
+drift_secs = None
 
-            # Write
-            with open(f'{directory}/{channel}.txt', 'a') as f:
-                f.write(str(output_dec) + '\n')
-    else:
-        print('Empty')
+# The port is opened and read before numpy is imported, so no hit of the start of the run is lost.
+# The hits are written to ./data/<timestamp>
+directory = acquire(args.port, 'channels', runtime_secs, './data', freq, pipelined = pipelined, binary = binary,
+                    online_calibration = online_calibration, metrics_port = metrics_port,
+                    metrics_file = metrics_file, drift_secs = drift_secs, kit = 'max1000')
@@ -1,58 +1,16 @@
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
-
-
-# Skiprows needed since the data is read in chunks of 1000 for live histogram
-skiprows_next : int = 0
-
-# Folder to read data from
-timestamp = 'coarse_2025-02-21_11:20:02'
-
-# Channels to plot
-channels = ['fine']
-full_data = {channel: [] for channel in channels}
-
-# Read the data from the file in chunks of 1000
-def get_data(skiprows : int, directory, channel) -> list[int]:
-    with open(f'./data/{directory}/{channel}.txt', 'r') as f:
-        data = np.loadtxt(f, dtype = str, usecols = 0, max_rows = 1000, delimiter=',', skiprows = skiprows)
-        data = [int(i) for i in data]   
-    return data
-
-
-fig = plt.figure(figsize=(12, 12))
-
-# Update the histogram with the new data
-def update_hist(frame):
-
-    global skiprows_next
-    
-    # If 1000 new values are found, update the histogram
-    for i, channel in enumerate(channels):
-        data = get_data(skiprows_next, timestamp, channel)
-        if len(data) < 1000:
-            return
-        full_data[channel].extend(data)
-    
-        ax = plt.subplot(1, 1, i+1)
-        
-        ax.clear()
-        ax.set_xlabel('bins')
-        ax.set_ylabel('frequency')
-        ax.hist(full_data[channel], bins=300, range=(0, 300), width=1, edgecolor = 'black', linewidth = .1)
-        ax.set_xlim(-2, 300)
-    skiprows_next += 1000
-    
-    # Save the histogram
-    plt.savefig(f'./data/{timestamp}/histogram.pdf', dpi=300)
-
-# Animate the histogram
-ani = FuncAnimation(fig, update_hist, interval=.1)
-plt.show()
-
-
+from tdc.live import live_histogram
+from tdc.catalog import find_run
 
 
+# Folder to read data from: the latest run of this design on this kit (text runs and older runs do not record
+# the kit and are found for both kits). Give the folder name or a part of it to use another
+# run, e.g. find_run('2025-02-21'). python -m tdc.catalog lists the runs with their hits and time span
+timestamp = find_run('latest', design = 'one_channel', kit = 'max1000')
 
+# Channels to plot. The one channel design has a single channel '0'
+channels = ['0']
 
+# Follow the file of the run and update the histogram with the new values only. The file is read in the
+# background, the window is redrawn at most fps times per second and the histogram is saved every snapshot_secs.
+# Without a display: python -m tdc.monitor latest --headless --snapshot histogram.png --every 30
+live_histogram(timestamp, channels, fps = 5, snapshot_secs = 30, save_path = f'./data/{timestamp}/histogram.pdf')
@@ -0,0 +1,41 @@
+import argparse
+
+from tdc.acquire import acquire
+
+# Receive the datagrams of the FPGA on this address and port.
+# The design sends no sequence number yet. If a sender adds a 4 byte counter in front of each datagram, set seq_bytes = 4.
+# To test without the board: tdc emulate --format ethernet
+# The same as: tdc acquire --format ethernet --port <host>:<port> --runtime ...
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', default = '0.0.0.0')
+parser.add_argument('--port', type = int, default = 5000)
+parser.add_argument('--seq-bytes', type = int, default = 0)
+parser.add_argument('--runtime', type = float, default = 1000, help = 'minutes to read')
+args = parser.parse_args()
+
+# Use time to read for certain amount of time
+runtime_mins = args.runtime  # mins
+runtime_secs = runtime_mins * 60
+freq = 12e6
+
+# Update the calibration during the run (see read_with_coarse.py)
+online_calibration = False
+
+# Same 5 byte records as over UART: 9 fine bits followed by 31 coarse bits, LSB first.
+# Lost hits show up as large steps of the coarse counter (for a periodic input signal).
+
+# Health metrics (bytes/s, hits/s, sync errors, queue fill, lost datagrams, flush latency) are written
+# to {directory}/health.json every 5 s. Use a .prom file name for Prometheus text, set metrics_port to
+# also serve them on http://127.0.0.1:<port>/metrics
+metrics_file = 'health.json'
+metrics_port = None
+
+# Also store the fine code histograms in time slices of drift_secs (e.g. 60) in {directory}/drift to follow
+# the drift of the bin widths, see tdc drift show
+drift_secs = None
+
+# The socket is bound before numpy is imported. The hits are written to ./data/coarse_<timestamp>/hits.tdc
+# like in the UART readout, so the live histogram and the analysis scripts work unchanged
+directory = acquire(f'{args.host}:{args.port}', 'ethernet', runtime_secs, './data', freq,
+                    online_calibration = online_calibration, metrics_port = metrics_port, seq_bytes = args.seq_bytes,
+                    metrics_file = metrics_file, drift_secs = drift_secs, kit = 'max10')
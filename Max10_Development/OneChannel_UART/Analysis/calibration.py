@@ -1,38 +1,38 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
-# Specify the file to read
-timestamp = 'coarse_2025-02-21_11:20:02'
-
-# Read the data from the file
-with open(f'./data/{timestamp}/fine.txt', 'r') as f:
-    data = np.loadtxt(f, dtype = str, usecols = 0, delimiter=',')
-    data = [int(i) for i in data]
-    
-freq = 12e6
-
-# Find maximum bin that was filled
-max_bin = np.max(data)
+from tdc.calib import get_luts
+from tdc.catalog import find_run
+from tdc.dnl import characterize, format_linearity, hits_needed, plot_linearity
 
-# Find the number of entries in each bin
-_, counts = np.unique(data, return_counts=True)
+# Folder to read data from: the latest run of this design on this kit (text runs and older runs do not record
+# the kit and are found for both kits). Give the folder name or a part of it to use another
+# run, e.g. find_run('2025-02-21'). python -m tdc.catalog lists the runs with their hits and time span
+timestamp = find_run('latest', design = 'one_channel', kit = 'max10')
 
-# Find number of entries
-entries = len(data)
-bins = []
+freq = 12e6
 
-# Fill each bin with corresponding entries. Translate to ns
-for i in range(max_bin):
-    bins.append(counts[i]/entries * 1/freq)
-    
-# Rescale for better readability
-bins_ns = np.array(bins) * 1e9
+# Calculate the bin widths in ns from the number of entries in each bin. The fine values of the run are read
+# without the overflow hits (maximum bin). The result is saved in ./data/<timestamp>/calibration and loaded
+# from there the next time.
+lut = get_luts(f'./data/{timestamp}', ['0'], freq = freq)['0']
+bins_ns = lut.widths
+max_bin = lut.n_codes
+entries = lut.entries
 
 # Mean 
 mean_width = np.mean(bins_ns)
 
+# DNL, INL and effective LSB with bootstrap errors (resampled histograms, so this is fast for any number of hits).
+# The errors shrink with 1/sqrt(entries): hits_needed gives the entries for a target precision of the bin centers
+linearity = characterize({'0': lut}, freq = freq, n_boot = 1000)['0']
+print(format_linearity(linearity))
+print(f'{hits_needed(linearity, target_ps = 1.):.3g} hits needed to know every bin center to 1 ps')
+bins_ns_err = linearity.dnl_err * linearity.metrics['lsb'] / 1e3
+
 # Plot each bin with its width
 plt.bar(range(max_bin), bins_ns, width=1, edgecolor = 'black', linewidth = .5, align='edge')
+plt.errorbar(np.arange(max_bin) + .5, bins_ns, yerr = bins_ns_err, fmt = 'none', ecolor = 'red', elinewidth = .5)
 plt.xlabel('Bins')
 plt.ylabel('Bin width [ns]')
 plt.title('Bin width in ns')
@@ -48,3 +48,6 @@ plt.title('Distribution of bin widths in ns')
 plt.legend([f'Mean bin width = {mean_width:.2f} ns'])
 plt.savefig('bin_distr_hist_ns.pdf', dpi=300)
 plt.show()
+
+# DNL and INL per bin, the bands are the bootstrap errors
+plot_linearity({'0': linearity}, save_path = 'dnl_inl.pdf')
@@ -1,24 +1,42 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
-# Folder
-timestamp = 'coarse_2025-02-21_11:20:02'
-
-# Read the data from the file
-with open(f'./data/{timestamp}/coarse.txt', 'r') as f:
-    coarse = np.loadtxt(f, dtype = str, usecols = 0, delimiter=',')
-    coarse = [int(i) for i in coarse]
-    
-# Calculate difference between each value pair. Translate to Hz
-diff = np.array([coarse[i+1] - coarse[i] for i in range(0, len(coarse)-1)]) * 1/(12 * 10**6)
-diff = 1/diff
-
-# Remove outliers (happens when counter is reset)
-diff = diff[diff < 67]
-diff = diff[diff > 0]
+from tdc.loader import load_run
+from tdc.coarse import unwrap, fit_period
+from tdc.catalog import find_run
+
+# Folder to read data from: the latest run of this design on this kit (text runs and older runs do not record
+# the kit and are found for both kits). Give the folder name or a part of it to use another
+# run, e.g. find_run('2025-02-21'). python -m tdc.catalog lists the runs with their hits and time span
+timestamp = find_run('latest', design = 'one_channel', kit = 'max10')
+
+# Clock frequency and frequency of the waveform generator (None if unknown)
+freq = 12e6
+trigger_freq = None
+
+# Read the coarse values of the run (hits.tdc or coarse.txt)
+coarse = load_run(timestamp)['0'].coarse
+if coarse is None:
+    raise SystemExit(f'{timestamp}: the run has no coarse values (coarse.txt is missing)')
+
+# Unwrap the 31 bit coarse counter (wraps every ~178 s) into ticks since the first hit
+timeline = unwrap(coarse)
+print(f'{len(coarse)} hits, {len(timeline.wraps)} wraps, {len(timeline.resets)} counter resets')
+
+# Fit the trigger period to all hits before the first counter reset. With a known trigger frequency this also gives the clock frequency
+segment = timeline.ticks[:timeline.resets[0]] if len(timeline.resets) else timeline.ticks
+fit = fit_period(segment)
+print(f'Trigger rate: {freq / fit.period:.6f} Hz (period {fit.period:.3f} +- {fit.period_err:.3f} ticks, {fit.missing} missing hits)')
+if trigger_freq:
+    print(f'Clock frequency: {fit.period * trigger_freq:.1f} Hz')
+
+# Calculate difference between each value pair. Translate to Hz. Steps over a counter reset are not used
+steps = np.diff(timeline.ticks)
+steps[timeline.resets - 1] = 0
+diff = freq / steps[steps > 0]
 
 # Plot the histogram. Result is hist with 3 peaks, meaning that we measure the frequency +- one clock cycle.
-plt.hist(diff, bins=25, edgecolor = 'black', linewidth = .1, label=f'Mean: {np.mean(diff):.4f} Hz')
+plt.hist(diff, bins=25, edgecolor = 'black', linewidth = .1, label=f'Fit: {freq / fit.period:.4f} Hz')
 plt.xlabel('Frequency (Hz)')
 plt.ylabel('Frequency')
 plt.legend()
@@ -1,98 +1,49 @@
-import serial
-import matplotlib.pyplot as plt
-import time
-import datetime
-import os
+import argparse
 
-# Open the serial port
-ser = serial.Serial(port = '/dev/serial/by-id/usb-Arrow_Arrow_USB_Blaster_TEI0001_ARA27238-if01-port0', baudrate = 115200, bytesize=8)
+from tdc.acquire import acquire, DEFAULT_PORT
 
-timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
-output_dec = 0
-parity = 0
-coarse_ = ''
+# The serial port and the runtime can be given on the command line. Use --port with the
+# pseudo terminal or socket://localhost:<port> of the emulator (python -m tdc.emulator) to test without the board.
+# The same as: tdc acquire --format coarse --port ... --runtime ...
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', default = DEFAULT_PORT)
+parser.add_argument('--runtime', type = float, default = 1000, help = 'minutes to read')
+args = parser.parse_args()
 
-# Create a directory to store the output files
-directory = "./data/coarse_" + timestamp
-os.mkdir(directory)
-with open(f'{directory}/coarse.txt', 'a') as f:
-    f.write('')
-with open(f'{directory}/fine.txt', 'a') as f:
-    f.write('')
-    
 # Use time to read for certain amount of time
-runtime_mins = 1000  # mins
-start_time = time.time()
+runtime_mins = args.runtime  # mins
 runtime_secs = runtime_mins * 60
-
-coarse = ""
-
-while (time.time() - start_time) < runtime_secs:   
-    # Read the serial port 
-    c = ser.read()
-    # If the read is not empty, decode it and write it to output.txt
-    if len(c) != '':
-        
-        # First byte contain the first 7 fine bits. 
-        # Two cases since data is UTF-encoded if in range, after this the data is in hex
-        if parity == 0:
-            try:
-                utf = c.decode()
-                bits = ' '.join([f'{i:08b}' for i in utf.encode('utf-8')])
-                output_fine= int(bits, 2)
-            except:
-                c = ('0' + str(c)[3:-1])
-                bits = bin(int(c, 16))[2:]
-                output_fine = int(c, 16)
-
-            # Reset the coarse value
-            parity += 1
-            coarse = ''
-        
-        # Second byte contain the MSB of the fine bits (overflow) and the first 7 coarse bits
-        elif parity == 1: 
-            try:
-                utf = c.decode()
-                bits = ' '.join([f'{i:08b}' for i in utf.encode('utf-8')])
-            except:
-                c = ('0' + str(c)[3:-1])
-                bits = bin(int(c, 16))
-                bits = bits[2:]
-
-            # Add the overflow to the fine bits
-            overflow = bits[-1]
-            output_fine = output_fine + int(overflow)*256
-            
-            # Add the coarse bits
-            coarse = (str(bits[:-1])) 
-            parity += 1
-            
-        # The rest of the bytes contain the remaining coarse bits
-        elif parity < 5:
-            try:
-                utf = c.decode()
-                bits = ' '.join([f'{i:08b}' for i in utf.encode('utf-8')])
-            except:
-                c = ('0' + str(c)[3:-1])
-                bits = bin(int(c, 16))
-                bits = bits[2:]
-                
-            # Update the coarse bits
-            coarse = (str(bits)) + coarse
-            
-            # Write the coarse and fine bits to the output files when 40 bits are read
-            if parity == 4:
-                coarse = int(''.join(coarse), 2)
-                with open(f'{directory}/coarse.txt', 'a') as f:
-                    f.write(str(coarse) + '\n')
-                    
-                with open(f'{directory}/fine.txt', 'a') as f:
-                    f.write(str(output_fine) + '\n')
-                
-                parity = 0
-                
-            else:       
-                parity += 1
-
-    else:
-        print('Empty')
+freq = 12e6
+
+# Read, decode and write in separate threads so slow disk writes can not stall the serial read
+pipelined = True
+
+# Write the hits to the binary file hits.tdc instead of fine.txt and coarse.txt.
+# Convert with tdc convert to-text if the text files are needed.
+binary = True
+
+# Update the calibration during the run to follow drifts of the bin widths. A new LUT is saved
+# to {directory}/calibration/online every 10^5 hits, the histogram forgets on a scale of 10^6 hits.
+online_calibration = False
+
+# Each hit consists of 5 bytes: 9 fine bits followed by 31 coarse bits, LSB first.
+# The decoder keeps incomplete frames until the remaining bytes arrive.
+# Frames that can not be right (fine value above 288, coarse jumping) mean a byte was lost: the decoder
+# then discards bytes until the frames fit again and prints how many were discarded.
+
+# Health metrics (bytes/s, hits/s, sync errors, serial buffer and queue fill, flush latency) are written
+# to {directory}/health.json every 5 s. Use a .prom file name for Prometheus text, set metrics_port to
+# also serve them on http://127.0.0.1:<port>/metrics
+metrics_file = 'health.json'
+metrics_port = None
+
+# Also store the fine code histograms in time slices of drift_secs (e.g. 60) in {directory}/drift to follow
+# the drift of the bin widths, see tdc drift show
+drift_secs = None
+
+# The port is opened and read before numpy is imported, so no hit of the start of the run is lost.
+# The hits are written to ./data/coarse_<timestamp>. The kit is recorded in hits.tdc, so the analysis scripts
+# of the other kit, which runs the same design, do not pick this run
+directory = acquire(args.port, 'coarse', runtime_secs, './data', freq, pipelined = pipelined, binary = binary,
+                    online_calibration = online_calibration, metrics_port = metrics_port,
+                    metrics_file = metrics_file, drift_secs = drift_secs, kit = 'max10')
@@ -0,0 +1,42 @@
+# Benchmark: timestamp-based event building.
+#
+# Generates four channels of picosecond timestamps for the same input signals with
+# timing jitter and randomly lost hits, builds 2- to 4-fold events and prints the
+# throughput in hits/s. Run from the repository root:
+#   python benchmarks/bench_coincidence.py [n_hits]      (default 10^7, e.g. 100000000 for 10^8)
+
+import sys
+import time
+
+import numpy as np
+
+from tdc.coincidence import build_events, fold_counts
+
+
+# Timestamps in ps of n_signals signals seen by each channel, 1 % of the hits are lost
+def make_stamps(n_signals: int, channels: list[str], rate_hz: float = 10e3, jitter_ps: float = 150., seed: int = 0):
+    rng = np.random.default_rng(seed)
+    signals = np.cumsum(rng.exponential(1e12 / rate_hz, n_signals)).astype(np.int64)
+    stamps = {}
+    for channel in channels:
+        t = signals + rng.normal(0, jitter_ps, n_signals).astype(np.int64)
+        stamps[channel] = np.sort(t[rng.random(n_signals) > 0.01])
+    return stamps
+
+
+def main():
+    n_hits = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**7
+    channels = ['00', '01', '10', '11']
+    stamps = make_stamps(n_hits // len(channels), channels)
+    total = sum(len(s) for s in stamps.values())
+
+    for min_fold in (2, 3, 4):
+        t0 = time.perf_counter()
+        events = build_events(stamps, window=2000, min_fold=min_fold)
+        dt = time.perf_counter() - t0
+        print(f'{min_fold}-fold: {len(events):>11,} events from {total:,} hits in {dt:6.2f} s'
+              f' = {total / dt:13,.0f} hits/s  {fold_counts(events)}')
+
+
+if __name__ == '__main__':
+    main()
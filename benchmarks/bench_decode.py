@@ -0,0 +1,113 @@
+# Microbenchmark: decoding of the 5 byte fine+coarse UART stream.
+#
+# Compares the byte-by-byte decoding of the original read_with_coarse.py with the
+# vectorized FrameDecoder and prints the achieved events/s for both.
+# Run from the repository root: python benchmarks/bench_decode.py [n_events]
+
+import sys
+import time
+
+import numpy as np
+
+from tdc.decode import FrameDecoder, FRAME_BYTES
+
+
+# Random hits packed into the wire format of fifo_writer.vhd
+def make_stream(n_events: int, seed: int = 0) -> tuple[bytes, np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    fine = rng.integers(0, 289, n_events, dtype=np.uint64)
+    coarse = np.sort(rng.integers(0, 2**31, n_events, dtype=np.uint64))
+    words = (coarse << 9) | fine
+    stream = words.astype('<u8').view(np.uint8).reshape(n_events, 8)[:, :FRAME_BYTES].tobytes()
+    return stream, fine, coarse
+
+
+# Decoding loop of the original read_with_coarse.py, fed with single bytes like ser.read()
+def legacy_decode(stream: bytes) -> tuple[list[int], list[int]]:
+    fines, coarses = [], []
+    parity = 0
+    for k in range(len(stream)):
+        c = stream[k:k+1]
+        if parity == 0:
+            try:
+                utf = c.decode()
+                bits = ' '.join([f'{i:08b}' for i in utf.encode('utf-8')])
+                output_fine = int(bits, 2)
+            except:
+                c = ('0' + str(c)[3:-1])
+                bits = bin(int(c, 16))[2:]
+                output_fine = int(c, 16)
+            parity += 1
+            coarse = ''
+        elif parity == 1:
+            try:
+                utf = c.decode()
+                bits = ' '.join([f'{i:08b}' for i in utf.encode('utf-8')])
+            except:
+                c = ('0' + str(c)[3:-1])
+                bits = bin(int(c, 16))
+                bits = bits[2:]
+            overflow = bits[-1]
+            output_fine = output_fine + int(overflow)*256
+            coarse = (str(bits[:-1]))
+            parity += 1
+        elif parity < 5:
+            try:
+                utf = c.decode()
+                bits = ' '.join([f'{i:08b}' for i in utf.encode('utf-8')])
+            except:
+                c = ('0' + str(c)[3:-1])
+                bits = bin(int(c, 16))
+                bits = bits[2:]
+            coarse = (str(bits)) + coarse
+            if parity == 4:
+                coarses.append(int(''.join(coarse), 2))
+                fines.append(output_fine)
+                parity = 0
+            else:
+                parity += 1
+    return fines, coarses
+
+
+# Vectorized decoding, fed in chunks like reads of ser.in_waiting
+def bulk_decode(stream: bytes, chunk: int = 4096) -> tuple[np.ndarray, np.ndarray]:
+    decoder = FrameDecoder()
+    fines, coarses = [], []
+    for k in range(0, len(stream), chunk):
+        fine, coarse = decoder.feed(stream[k:k+chunk])
+        fines.append(fine)
+        coarses.append(coarse)
+    fine, coarse = decoder.flush()
+    fines.append(fine)
+    coarses.append(coarse)
+    return np.concatenate(fines), np.concatenate(coarses)
+
+
+def main():
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    stream, fine, coarse = make_stream(n_events)
+
+    # The legacy path is slow, only time a subset of the stream
+    n_legacy = min(n_events, 50_000)
+    t0 = time.perf_counter()
+    legacy_fine, legacy_coarse = legacy_decode(stream[:n_legacy * FRAME_BYTES])
+    t_legacy = time.perf_counter() - t0
+
+    results = {}
+    for chunk in (64, 4096, 1 << 20):
+        t0 = time.perf_counter()
+        bulk_fine, bulk_coarse = bulk_decode(stream, chunk)
+        results[chunk] = time.perf_counter() - t0
+
+    # Both paths have to give the same hits
+    assert np.array_equal(legacy_fine, fine[:n_legacy]) and np.array_equal(legacy_coarse, coarse[:n_legacy])
+    assert np.array_equal(bulk_fine, fine) and np.array_equal(bulk_coarse, coarse)
+
+    print(f'byte-by-byte          : {n_legacy / t_legacy:14,.0f} events/s')
+    for chunk, t in results.items():
+        print(f'bulk, {chunk:>8} B reads: {n_events / t:14,.0f} events/s')
+    print(f'UART limit (115200 Bd): {115200 / 10 / FRAME_BYTES:14,.0f} events/s')
+
+
+if __name__ == '__main__':
+    main()
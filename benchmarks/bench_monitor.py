@@ -0,0 +1,122 @@
+# Benchmark: rendering cost of the live histograms (tdc/monitor.py).
+#
+# Times one frame of the old live plot (set the height of every bar, draw the whole
+# figure and save a 300 dpi PDF on every frame) against the parts of the monitor:
+# blitting the steps onto the saved background, a full draw (only after the y axis
+# was rescaled) and the PNG / NPZ snapshots. Prints ms per frame and the CPU share at
+# the given refresh rates. Uses the Agg backend, so no display is needed. Run from
+# the repository root:
+#   python benchmarks/bench_monitor.py [channels] [fps] [seconds between snapshots]      (default 4, 5, 10)
+
+import os
+import sys
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+from tdc.live import LiveHistogram, LivePlot
+from tdc.monitor import Monitor
+
+N_BINS = 300
+# Frames per measurement
+REPEAT = 10
+
+
+def timed(func, repeat: int = REPEAT) -> float:
+    func()
+    t = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - t) / repeat * 1e3
+
+
+def main():
+    n_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    fps = float(sys.argv[2]) if len(sys.argv) > 2 else 5.
+    snapshot_secs = float(sys.argv[3]) if len(sys.argv) > 3 else 10.
+    channels = [f'{i:02b}' for i in range(n_channels)]
+    ncols = min(2, n_channels)
+    nrows = -(-n_channels // ncols)
+    rng = np.random.default_rng(0)
+
+    hist = LiveHistogram(channels, N_BINS)
+    hist.update({channel: rng.integers(0, 289, 10**6) for channel in channels})
+
+    def new_hits():
+        hist.update({channel: rng.integers(0, 289, 1000) for channel in channels})
+
+    with tempfile.TemporaryDirectory(prefix='tdc_monitor_') as tmp:
+        # Old live plot: one bar per bin, everything redrawn and saved as PDF on every frame
+        fig = plt.figure(figsize=(12, 12))
+        bars = []
+        for i, channel in enumerate(channels):
+            ax = fig.add_subplot(nrows, ncols, i + 1)
+            bars.append((ax, channel, ax.bar(np.arange(N_BINS), hist.counts[channel], width=1, align='edge',
+                                             edgecolor='black', linewidth=.1)))
+
+        def old_frame():
+            new_hits()
+            for ax, channel, rects in bars:
+                for rect, h in zip(rects, hist.counts[channel].tolist()):
+                    rect.set_height(h)
+                ax.set_ylim(0, hist.counts[channel].max() * 1.05)
+            fig.canvas.draw()
+            fig.savefig(os.path.join(tmp, 'histogram.pdf'), dpi=300)
+
+        old = timed(old_frame, 3)
+        plt.close(fig)
+
+        # Monitor: steps blitted onto the background
+        plot = LivePlot(hist, nrows, ncols, figsize=(12, 12))
+        canvas = plot.fig.canvas
+        for artist in plot.artists:
+            artist.set_animated(True)
+        canvas.draw()
+        background = canvas.copy_from_bbox(plot.fig.bbox)
+
+        def blit_frame():
+            new_hits()
+            plot.redraw()
+            canvas.restore_region(background)
+            for artist in plot.artists:
+                plot.fig.draw_artist(artist)
+            canvas.blit(plot.fig.bbox)
+
+        def full_frame():
+            new_hits()
+            plot.redraw()
+            canvas.draw()
+
+        blit = timed(blit_frame)
+        full = timed(full_frame)
+        plt.close(plot.fig)
+
+        monitor = Monitor(tmp, channels, N_BINS, snapshots=['histogram.png'], nrows=nrows, ncols=ncols)
+        monitor.hist = hist
+
+        def snapshot(monitor):
+            new_hits()
+            monitor.version += 1
+            monitor.save_snapshots()
+
+        png = timed(lambda: snapshot(monitor))
+        monitor.snapshots = [os.path.join(tmp, 'histogram.npz')]
+        npz = timed(lambda: snapshot(monitor))
+
+    print(f'{n_channels} channels, {N_BINS} bins')
+    print(f'old frame (bars, draw, 300 dpi PDF): {old:8.1f} ms  -> {old * 10 / 1e3:.1f} s CPU per s at 10 fps')
+    print(f'blit frame:                          {blit:8.1f} ms')
+    print(f'full draw (after a rescale):         {full:8.1f} ms')
+    print(f'PNG snapshot:                        {png:8.1f} ms')
+    print(f'NPZ snapshot:                        {npz:8.1f} ms')
+    cpu = 100 * (blit * fps + png / snapshot_secs) / 1e3
+    print(f'monitor at {fps:g} fps with a PNG every {snapshot_secs:g} s: CPU {cpu:5.1f} %'
+          f', headless {100 * png / snapshot_secs / 1e3:5.2f} %')
+
+
+if __name__ == '__main__':
+    main()
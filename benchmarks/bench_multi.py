@@ -0,0 +1,50 @@
+# Benchmark: CPU use of the asyncio acquisition (tdc/multi.py) with several boards.
+#
+# For 1, 2, 4 and 8 boards, one emulator process per board (python -m tdc.emulator
+# --format ethernet) sends hits at the same rate over the loopback interface and one
+# MultiAcquisition process reads all of them. Prints the CPU time of the acquisition
+# per second of run time, in total and per board. The senders need CPU too: with fewer cores
+# than boards they do not reach the rate, compare the hits/s. Run from the repository root:
+#   python benchmarks/bench_multi.py [rate per board in Hz] [seconds]      (default 10^5 Hz, 5 s)
+
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from tdc.multi import MultiAcquisition
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+FIRST_PORT = 5300
+
+
+def measure(n_boards: int, rate: float, seconds: float, data_dir: str) -> tuple[float, int]:
+    boards = [(f'board{i}', f'udp://127.0.0.1:{FIRST_PORT + i}', None) for i in range(n_boards)]
+    with MultiAcquisition(boards, data_dir, report_secs=seconds + 1) as acq:
+        senders = [subprocess.Popen([sys.executable, '-m', 'tdc.emulator', '--format', 'ethernet',
+                                     '--port', str(FIRST_PORT + i), '--rate', str(rate), '--duration', str(seconds),
+                                     '--seed', str(i)], cwd=ROOT, stdout=subprocess.DEVNULL)
+                   for i in range(n_boards)]
+        cpu = time.process_time()
+        manifest = asyncio.run(acq.run(seconds))
+        cpu = time.process_time() - cpu
+        for sender in senders:
+            sender.wait()
+    return cpu / seconds, sum(board['hits'] for board in manifest['boards'])
+
+
+def main():
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 1e5
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.
+
+    with tempfile.TemporaryDirectory(prefix='tdc_multi_') as data_dir:
+        for n_boards in (1, 2, 4, 8):
+            load, hits = measure(n_boards, rate, seconds, os.path.join(data_dir, str(n_boards)))
+            print(f'{n_boards} boards: {hits / seconds:12,.0f} hits/s  CPU {100 * load:5.1f} %'
+                  f'  ({100 * load / n_boards:5.1f} % per board)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# Benchmark: time from starting the acquisition until the serial port is read.
+#
+# The old readout scripts imported numpy and the whole tdc package (and through
+# metrics.py http.server) before opening the port. tdc.acquire opens the port and
+# starts the reader thread first and imports the rest afterwards. Both orders are
+# run in a fresh interpreter on a loop:// port, REPEAT times each. Prints the time
+# from the start of the process until the reader runs, the time until everything
+# is set up, and the peak RSS of the process. Run from the repository root:
+#   python benchmarks/bench_startup.py [repeat]      (default 10)
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+READ = '''
+import serial
+from tdc.pipeline import AcquisitionPipeline
+ser = serial.serial_for_url('loop://', timeout=0.1)
+pipeline = AcquisitionPipeline(ser).start_reading()
+print('reading', time.time(), flush=True)
+'''
+SETUP = '''
+from tdc.calib import StreamingCalibrator
+from tdc.decode import FrameDecoder
+from tdc.demux import ChannelDemux
+from tdc.metrics import HealthMonitor
+from tdc.storage import EventWriter
+'''
+DONE = '''
+import resource
+print('ready', time.time(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, flush=True)
+pipeline.stop()
+'''
+ORDERS = {
+    'imports first (old scripts)': 'import time\n' + SETUP + READ + DONE,
+    'port first (tdc acquire)': 'import time\n' + READ + SETUP + DONE,
+}
+
+
+def measure(code: str) -> tuple[float, float, float]:
+    start = time.time()
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                         env=dict(os.environ, PYTHONPATH=ROOT)).stdout.split('\n')
+    reading = float(out[0].split()[1])
+    _, ready, rss = out[1].split()
+    return (reading - start) * 1e3, (float(ready) - start) * 1e3, float(rss)
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print(f'{"":>28} {"reading":>10} {"set up":>10} {"peak RSS":>10}')
+    for name, code in ORDERS.items():
+        measure(code)
+        results = [measure(code) for _ in range(repeat)]
+        reading, ready, rss = (statistics.median(r[i] for r in results) for i in range(3))
+        print(f'{name:>28} {reading:8.0f} ms {ready:8.0f} ms {rss:7.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
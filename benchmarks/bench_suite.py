@@ -0,0 +1,288 @@
+# Benchmark suite: throughput of each stage of the analysis chain.
+#
+# For every size, a synthetic four channel run (hits.tdc, one input signal seen by
+# all four channels) is generated and each stage is timed in its own process, so
+# that the peak RSS of the stage can be measured:
+#   decode_coarse     5 byte frames as read by read_with_coarse.py, fed in 64 kB reads
+#   decode_channels   2 byte frames as read by read_serial.py
+#   load              get_data: all channels of the run with the loader
+#   load_text         the same for the run converted to the legacy text files 00.txt ... 11.txt
+#   calib             plot_calib without plotting: remove_overflow and calibrate
+#   calib_chunked     calibrate_run, chunk by chunk
+#   calib_parallel    calibrate_parallel: same LUTs as calib, chunk by chunk on all cores
+#   coincidence       coincidence() of calibration.py up to the time differences
+#   coincidence_parallel  the same events and times with iter_coincidences, chunk by chunk on all cores
+#   dnl               characterize: DNL/INL with 1000 bootstrap replicas of the histograms (after calib_parallel)
+#   fit               plot_hist: histogram and Gaussian fit (numpy backend) of the differences
+#
+# Prints hits/s (always counted in hits of the run) and the peak RSS of the process
+# running the stage, which includes loading the data the stage needs, per stage and
+# size, and the scaling exponent of each stage (time ~ n^k). Everything is also
+# written to a JSON file. Run from the repository root:
+#   python benchmarks/bench_suite.py                                  # 10^5 ... 10^7 hits
+#   python benchmarks/bench_suite.py --sizes 1e5 1e6 1e7 1e8 1e9 --stages decode_coarse load calib_chunked
+#   python benchmarks/bench_suite.py --compare benchmarks/results/old.json
+#
+# Stages that hold the whole run in memory are skipped above --in-memory-max hits.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from tdc.calib import calibrate, calibrate_run, remove_overflow
+from tdc.coincidence import build_events, event_values
+from tdc.decode import ChannelFrameDecoder, FrameDecoder, encode_channel_frames, encode_frames
+from tdc.dnl import characterize
+from tdc.emulator import HitGenerator
+from tdc.fit import fit_gaussian
+from tdc.loader import load_run
+from tdc.parallel import calibrate_parallel, index_run, iter_coincidences
+from tdc.storage import FILE_NAME, FLAG_NO_COARSE, EventWriter, binary_to_text
+
+CHANNELS = ['00', '01', '10', '11']
+FREQ = 12e6
+# Signals generated at once when writing a synthetic run
+GEN_BLOCK = 1 << 20
+# Bytes per serial read in the decode stages
+READ_BYTES = 1 << 16
+
+IN_MEMORY = {'load', 'load_text', 'calib', 'coincidence', 'fit'}
+STAGES = ['decode_coarse', 'decode_channels', 'load', 'load_text', 'calib', 'calib_chunked', 'calib_parallel',
+          'coincidence', 'coincidence_parallel', 'dnl', 'fit']
+
+
+# Fine codes of n signals in the four channels. All channels see the same signal, each
+# with its own uneven bin widths and 30 ps jitter, so the time differences are Gaussian
+def make_fine(n: int, rng) -> np.ndarray:
+    phase = rng.random(n)
+    fine = np.empty((n, len(CHANNELS)), dtype=np.uint16)
+    for k in range(len(CHANNELS)):
+        gen = HitGenerator(1., seed=k)
+        u = (phase + rng.normal(0, 30e-12 * FREQ, n)) % 1
+        fine[:, k] = np.minimum(np.searchsorted(gen.cdf, u, side='right'), gen.n_codes - 1)
+    # Some overflow codes
+    fine[rng.random(fine.shape) < 1e-3] = 288
+    return fine
+
+
+# Write a run with n_hits records (n_hits / 4 signals) to run_dir/hits.tdc
+def generate(run_dir: str, n_hits: int) -> None:
+    os.makedirs(run_dir, exist_ok=True)
+    rng = np.random.default_rng(0)
+    n_signals = n_hits // len(CHANNELS)
+    with EventWriter(os.path.join(run_dir, FILE_NAME), CHANNELS, FREQ) as out:
+        for lo in range(0, n_signals, GEN_BLOCK):
+            fine = make_fine(min(GEN_BLOCK, n_signals - lo), rng)
+            ids = np.tile(np.arange(len(CHANNELS)), len(fine))
+            out.write(ids, fine.ravel(), flags=FLAG_NO_COARSE)
+
+
+# Feed n frames of the stream in READ_BYTES pieces. A 4 MB block is generated once and fed repeatedly
+def run_decode(n: int, frame_bytes: int, block: bytes, decoder) -> float:
+    total = n * frame_bytes
+    view = memoryview(block)
+    t0 = time.perf_counter()
+    done = 0
+    while done < total:
+        for lo in range(0, len(block), READ_BYTES):
+            size = min(READ_BYTES, total - done)
+            decoder.feed(view[lo:lo + size])
+            done += size
+            if done >= total:
+                break
+    return time.perf_counter() - t0
+
+
+# The part of coincidence() in calibration.py before plot_hist: returns the time differences in ns
+def coincidence(data, centers):
+    stamps = {channel: np.arange(len(data[channel])) for channel in CHANNELS}
+    stamps['00'] = stamps['00'] - 1
+    keep = {channel: data[channel] != np.max(data[channel]) for channel in CHANNELS}
+    events = build_events({channel: stamps[channel][keep[channel]] for channel in CHANNELS}, 0, min_fold=4)
+    times = {channel: centers[channel][data[channel][keep[channel]]] for channel in CHANNELS}
+    t = event_values(events.having(CHANNELS), times)
+    diff = t[:, [0, 1]].mean(axis=1) - t[:, [2, 3]].mean(axis=1)
+    diff[diff < 0] += 1 / FREQ * 1e9
+    diff[diff > 80] -= 1 / FREQ * 1e9
+    return diff[diff < 3]
+
+
+# Time one stage in this process. Returns the seconds spent in the stage
+def run_stage(stage: str, run_dir: str, n: int) -> float:
+    rng = np.random.default_rng(1)
+    data_dir, timestamp = os.path.split(run_dir)
+
+    if stage == 'decode_coarse':
+        m = (4 << 20) // 5
+        block = encode_frames(rng.integers(0, 289, m), np.sort(rng.integers(0, 2**31, m)))
+        return run_decode(n, 5, block, FrameDecoder())
+    if stage == 'decode_channels':
+        m = (4 << 20) // 2
+        block = encode_channel_frames(np.tile(np.arange(4), m // 4), rng.integers(0, 289, m))
+        return run_decode(n, 2, block, ChannelFrameDecoder())
+    if stage == 'calib_chunked':
+        t0 = time.perf_counter()
+        calibrate_run(run_dir, CHANNELS, FREQ, save=False)
+        return time.perf_counter() - t0
+
+    if stage in ('calib_parallel', 'coincidence_parallel', 'dnl'):
+        t0 = time.perf_counter()
+        index = index_run(run_dir)
+        luts = calibrate_parallel(run_dir, index=index, save=False)
+        if stage == 'calib_parallel':
+            return time.perf_counter() - t0
+        if stage == 'dnl':
+            t0 = time.perf_counter()
+            characterize(luts, FREQ, n_boot=1000)
+            return time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for events, times in iter_coincidences(run_dir, min_fold=4, offsets={'00': -1}, luts=luts, index=index):
+            pass
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    data = {c: np.asarray(h.fine) for c, h in load_run(timestamp, CHANNELS, data_dir=data_dir).items()}
+    if stage in ('load', 'load_text'):
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    luts = calibrate(remove_overflow(data), FREQ)
+    if stage == 'calib':
+        return time.perf_counter() - t0
+
+    centers = {c: luts[c].centers for c in CHANNELS}
+    t0 = time.perf_counter()
+    diff = coincidence(data, centers)
+    if stage == 'coincidence':
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    fit_gaussian(diff * 1e3)
+    return time.perf_counter() - t0
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+# Run a stage in a fresh process and return its result
+def measure(stage: str, run_dir: str, n: int) -> dict:
+    out = subprocess.run([sys.executable, __file__, '--worker', stage, run_dir, str(n)],
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+# Exponent k of time ~ n^k from a straight line fit in log-log
+def scaling(results: list[dict]) -> dict[str, float]:
+    out = {}
+    for stage in dict.fromkeys(r['stage'] for r in results):
+        rows = [r for r in results if r['stage'] == stage and r['seconds'] > 0]
+        if len(rows) >= 2:
+            k, _ = np.polyfit(np.log([r['n_hits'] for r in rows]), np.log([r['seconds'] for r in rows]), 1)
+            out[stage] = round(float(k), 3)
+    return out
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Print the speed of each stage and size relative to an older result file
+def compare(old_path: str, results: list[dict]) -> None:
+    with open(old_path) as f:
+        old = {(r['stage'], r['n_hits']): r for r in json.load(f)['results']}
+    print(f'\ncompared to {old_path}:')
+    for r in results:
+        o = old.get((r['stage'], r['n_hits']))
+        if o:
+            ratio = r['hits_per_s'] / o['hits_per_s']
+            print(f"{r['stage']:>16} {r['n_hits']:>13,}  {ratio:6.2f}x{'   <- slower' if ratio < 0.9 else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the stages of the analysis chain on synthetic runs')
+    parser.add_argument('--sizes', nargs='+', type=float, default=[1e5, 1e6, 1e7], help='hits per run')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--in-memory-max', type=float, default=1e8, help='largest run for the in-memory stages')
+    parser.add_argument('--output', default=None, help='JSON file (default benchmarks/results/<date>_<commit>.json)')
+    parser.add_argument('--compare', default=None, help='JSON file of an earlier run')
+    parser.add_argument('--tmp', default=None, help='directory for the synthetic runs')
+    parser.add_argument('--worker', nargs=3, metavar=('STAGE', 'RUN_DIR', 'N'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        stage, run_dir, n = args.worker
+        seconds = run_stage(stage, run_dir, int(n))
+        print(json.dumps({'stage': stage, 'n_hits': int(n), 'seconds': seconds,
+                          'hits_per_s': int(n) / seconds if seconds else None, 'peak_rss_mb': peak_rss_mb()}))
+        return
+
+    tmp = tempfile.mkdtemp(prefix='tdc_bench_', dir=args.tmp)
+    results = []
+    try:
+        for n in map(int, args.sizes):
+            run_dir = os.path.join(tmp, f'run_{n}')
+            if any(s not in ('decode_coarse', 'decode_channels') for s in args.stages):
+                t0 = time.perf_counter()
+                generate(run_dir, n)
+                print(f'generated {n:,} hits in {time.perf_counter() - t0:.1f} s')
+            text_dir = run_dir + '_text'
+            if 'load_text' in args.stages and n <= args.in_memory_max:
+                t0 = time.perf_counter()
+                binary_to_text(os.path.join(run_dir, FILE_NAME), text_dir)
+                print(f'converted to text in {time.perf_counter() - t0:.1f} s')
+            for stage in args.stages:
+                if stage in IN_MEMORY and n > args.in_memory_max:
+                    print(f'{stage:>16} {n:>13,}  skipped (more than --in-memory-max hits)')
+                    continue
+                r = measure(stage, text_dir if stage == 'load_text' else run_dir, n)
+                results.append(r)
+                print(f"{stage:>16} {n:>13,}  {r['seconds']:8.3f} s  {r['hits_per_s']:15,.0f} hits/s"
+                      f"  {r['peak_rss_mb']:8.0f} MB peak RSS")
+            shutil.rmtree(run_dir, ignore_errors=True)
+            shutil.rmtree(text_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    exponents = scaling(results)
+    print('\nscaling (time ~ n^k):', ', '.join(f'{s} {k}' for s, k in exponents.items()))
+
+    commit = git_commit()
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         f"{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{commit or 'nogit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'results': results,
+            'scaling': exponents,
+        }, f, indent=1)
+    print(f'results written to {output}')
+
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# Benchmark: UDP receiver for the Ethernet design.
+#
+# A sender thread streams 5 byte records over the loopback interface in datagrams
+# with a sequence number, the receiver reads them in bulk, decodes them and checks
+# for lost datagrams and coarse gaps. Prints the received MB/s and hits/s.
+# Run from the repository root:
+#   python benchmarks/bench_udp.py [n_hits] [rate in MB/s]      (default 10^7 hits, unlimited rate)
+
+import sys
+import threading
+import time
+
+import numpy as np
+
+from tdc.decode import FrameDecoder
+from tdc.udp import CoarseGapDetector, UdpReceiver, send_frames
+
+
+def main():
+    n_hits = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**7
+    rate = float(sys.argv[2]) * 1e6 if len(sys.argv) > 2 else None
+
+    # Periodic input signal: the coarse counter advances by a fixed step
+    fine = np.random.default_rng(0).integers(0, 289, n_hits)
+    coarse = (np.arange(n_hits, dtype=np.int64) * 1000) % (1 << 31)
+
+    receiver = UdpReceiver('127.0.0.1', 0, seq_bytes=4, timeout=1.0)
+    decoder = FrameDecoder()
+    gaps = CoarseGapDetector()
+    sender = threading.Thread(target=send_frames, args=(fine, coarse, '127.0.0.1', receiver.address[1], 256, 4, rate))
+
+    hits = 0
+    t0 = t1 = time.perf_counter()
+    sender.start()
+    with receiver:
+        while True:
+            data = receiver.read()
+            if not data:
+                if not sender.is_alive():
+                    break
+                continue
+            f, c = decoder.feed(data)
+            gaps.check(c)
+            hits += len(f)
+            t1 = time.perf_counter()
+    hits += len(decoder.flush()[0])
+    sender.join()
+
+    dt = t1 - t0
+    stats = receiver.stats()
+    print(f'received {hits:,} of {n_hits:,} hits in {dt:.2f} s = {stats["bytes"] / dt / 1e6:.1f} MB/s = {hits / dt:,.0f} hits/s')
+    print(f'lost datagrams: {stats["lost_datagrams"]}, coarse gaps: {gaps.gaps} ({gaps.missing} hits missing)')
+
+
+if __name__ == '__main__':
+    main()
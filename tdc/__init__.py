@@ -0,0 +1,5 @@
+# Shared host-side code for the TDC readout and analysis scripts.
+#
+# The modules in here only depend on numpy (and pyserial for reading the
+# boards), so the acquisition scripts can import them without pulling in
+# any plotting libraries.
@@ -0,0 +1,4 @@
+# python -m tdc <command> [options], the same as the tdc command
+from .cli import main
+
+main()
@@ -0,0 +1,233 @@
+# Acquisition of one board into ./data/<timestamp>.
+#
+# Used by the readout scripts (read_with_coarse.py, read_serial.py, read_ethernet.py)
+# and by `tdc acquire`. The formats are those of the designs:
+#   coarse     one channel, 5 byte frames with fine and coarse value over UART -> ./data/coarse_<timestamp>
+#   channels   four channels, 2 byte frames with channel and fine value over UART -> ./data/<timestamp>
+#   ethernet   the 5 byte frames of the one channel design in UDP datagrams -> ./data/coarse_<timestamp>
+#
+# The port (or UDP socket) is opened and read before numpy and the rest of the package
+# are imported. The receive buffer of a serial port holds 4 kB, i.e. 0.35 s at 115200
+# baud, so bytes sent right after handle_start released the reset of the FPGA would
+# be lost while Python is still importing. The reader thread of the pipeline keeps the
+# bytes in its queue until the decoder and the writer are set up. Nothing in here
+# imports matplotlib or ROOT.
+#
+#   tdc acquire --format channels --port /dev/ttyUSB0 --runtime 60
+
+import argparse
+import datetime
+import os
+import time
+
+from .pipeline import AcquisitionPipeline, run_pipeline
+
+FORMATS = ['coarse', 'channels', 'ethernet']
+# Development kits, recorded in the header of hits.tdc. The one channel design runs on both, so find_run needs
+# the kit to tell their runs apart
+KITS = ['max1000', 'max10']
+DEFAULT_PORT = '/dev/serial/by-id/usb-Arrow_Arrow_USB_Blaster_TEI0001_ARA27238-if01-port0'
+
+
+# UDP socket bound to host:port as early as possible, the kernel buffers the datagrams from then on
+def _bind(address: str, rcvbuf: int = 1 << 25):
+    import socket
+
+    host, port = address.rsplit(':', 1) if ':' in address else ('0.0.0.0', address)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind((host, int(port)))
+    return sock
+
+
+# Read one board for runtime_secs. port: serial port or socket://host:port, host:port to listen on for ethernet.
+# Returns the run directory.
+def acquire(port: str, fmt: str = 'coarse', runtime_secs: float = 1000 * 60, data_dir: str = './data',
+            freq: float = 12e6, baudrate: int = 115200, pipelined: bool = True, binary: bool = True,
+            online_calibration: bool = False, metrics_port: int | None = None, seq_bytes: int = 0,
+            metrics_file: str = 'health.json', drift_secs: float | None = None, kit: str | None = None) -> str:
+    if fmt not in FORMATS:
+        raise ValueError(f'unknown format {fmt!r}, use one of {FORMATS}')
+    if kit is not None and kit not in KITS:
+        raise ValueError(f'unknown kit {kit!r}, use one of {KITS}')
+
+    # Open the port and start reading before anything else is done
+    if fmt == 'ethernet':
+        sock = _bind(port)
+        ser = None
+    else:
+        import serial
+        # Short read timeout so the reader thread notices the end of the run
+        ser = serial.serial_for_url(port, baudrate=baudrate, bytesize=8, timeout=0.1 if pipelined else None)
+        pipeline = AcquisitionPipeline(ser).start_reading() if pipelined else None
+
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
+    directory = os.path.join(data_dir, ('' if fmt == 'channels' else 'coarse_') + timestamp)
+    os.mkdir(directory)
+
+    from .calib import StreamingCalibrator
+    from .decode import CHANNELS, ChannelFrameDecoder, FrameDecoder
+    from .demux import ChannelDemux
+    from .metrics import HealthMonitor
+    from .storage import FILE_NAME, FLAG_NO_COARSE, LAYOUT_FINE_COARSE, LAYOUT_PER_CHANNEL, EventWriter
+
+    receiver = gaps = None
+    if fmt == 'ethernet':
+        from .udp import CoarseGapDetector, UdpReceiver
+        # The design sends no sequence number yet. If a sender adds a 4 byte counter in front of each datagram,
+        # use seq_bytes = 4
+        ser = receiver = UdpReceiver(seq_bytes=seq_bytes, timeout=0.1, sock=sock)
+        pipeline = AcquisitionPipeline(receiver).start_reading() if pipelined else None
+        # Lost hits show up as large steps of the coarse counter (for a periodic input signal)
+        gaps = CoarseGapDetector(factor=1.5)
+
+    channels = CHANNELS if fmt == 'channels' else ['0']
+    # Update the calibration during the run to follow drifts of the bin widths. A new LUT is saved
+    # to {directory}/calibration/online every 10^5 hits, the histogram forgets on a scale of 10^6 hits.
+    calibrator = StreamingCalibrator(channels, window=1e6, publish_every=10**5, run_dir=directory) \
+        if online_calibration else None
+    # Fine code histograms in time slices of drift_secs in {directory}/drift (see drift.py)
+    drift = None
+    if drift_secs:
+        from .drift import DriftRecorder
+        drift = DriftRecorder(directory, channels, freq, has_coarse=fmt != 'channels', width_s=drift_secs)
+
+    # Frames that can not be right mean a byte was lost: the decoder then discards bytes until the
+    # frames fit again and prints how many were discarded
+    if fmt == 'channels':
+        decoder = ChannelFrameDecoder()
+
+        def batch(values):
+            channel, fine = values
+            return (channel, fine) if len(fine) != 0 else None
+    else:
+        decoder = FrameDecoder()
+
+        def batch(values):
+            fine, coarse = values
+            if len(fine) == 0:
+                return None
+            if gaps:
+                gaps.check(coarse)
+            return fine, coarse
+
+    def decode(chunk):
+        return batch(decoder.feed(chunk))
+
+    if binary:
+        header = {'kit': kit} if kit else {}
+        if fmt == 'channels':
+            # This design has no coarse counter
+            out = EventWriter(os.path.join(directory, FILE_NAME), CHANNELS, freq, LAYOUT_PER_CHANNEL, **header)
+
+            def store(batch):
+                out.write(batch[0], batch[1], flags=FLAG_NO_COARSE)
+        else:
+            out = EventWriter(os.path.join(directory, FILE_NAME), ['0'], freq, LAYOUT_FINE_COARSE,
+                              **({'source': 'udp'} if fmt == 'ethernet' else {}), **header)
+
+            def store(batch):
+                out.write(0, batch[0], batch[1])
+    elif fmt == 'channels':
+        # Buffer the values of each channel and write them to {channel}.txt once 64 kB or 1 s are reached
+        out = ChannelDemux(directory, CHANNELS, flush_bytes=1 << 16, flush_secs=1.0)
+
+        def store(batch):
+            out.scatter(*batch)
+    else:
+        out = ChannelDemux(directory, ['fine', 'coarse'])
+
+        def store(batch):
+            out.add('fine', batch[0])
+            out.add('coarse', batch[1])
+            out.poll()
+
+    def write(batch):
+        store(batch)
+        if fmt == 'channels':
+            health.count(batch[0])
+            if calibrator:
+                calibrator.update(*batch)
+            if drift:
+                drift.add(*batch)
+        else:
+            health.count(0, len(batch[0]))
+            if calibrator:
+                calibrator.add('0', batch[0], convert=False)
+            if drift:
+                drift.add(0, *batch)
+
+    # Health metrics (bytes/s, hits/s, sync errors, buffer and queue fill, flush latency) are written to
+    # {directory}/{metrics_file} every 5 s (.prom: Prometheus text) and served on
+    # http://127.0.0.1:<metrics_port>/metrics if metrics_port is given
+    metrics_path = os.path.join(directory, metrics_file)
+    health = HealthMonitor(channels, decoder=decoder, writer=out, receiver=receiver)
+
+    try:
+        with out:
+            if pipelined:
+                pipeline.decode = decode
+                pipeline.write = write
+                # Chunks the reader had to drop: the decoder discards the partial frame and syncs again
+                pipeline.lost = decoder.skip
+                # The decoder keeps the last frame back until it sees the bytes after it
+                pipeline.flush = lambda: batch(decoder.flush())
+                health.pipeline = pipeline
+                health.start(metrics_path, metrics_port)
+                run_pipeline(pipeline, runtime_secs)
+            else:
+                health.start(metrics_path, metrics_port)
+                start_time = time.time()
+                while (time.time() - start_time) < runtime_secs:
+                    # Read everything that is waiting and decode all complete frames at once
+                    values = decoder.read(ser)
+                    if len(values[1]) != 0:
+                        write(values)
+                    elif not decoder.rest:
+                        print('Empty')
+                values = decoder.flush()
+                if len(values[1]) != 0:
+                    write(values)
+    finally:
+        health.stop(metrics_path)
+        ser.close()
+
+    if receiver is not None:
+        print(receiver.stats())
+        print(f'coarse gaps: {gaps.gaps} ({gaps.missing} hits missing)')
+    if calibrator:
+        calibrator.close()
+    if drift:
+        drift.close()
+    return directory
+
+
+def main(argv: list[str] | None = None, prog: str | None = None):
+    parser = argparse.ArgumentParser(prog=prog, description='Read one TDC board into ./data/<timestamp>')
+    parser.add_argument('--format', choices=FORMATS, default='coarse',
+                        help='coarse: one channel (UART), channels: four channels, ethernet: one channel over UDP')
+    parser.add_argument('--port', default=None, help='serial port or socket://host:port of the emulator,'
+                                                     ' [host:]port to listen on for ethernet (default 0.0.0.0:5000)')
+    parser.add_argument('--runtime', type=float, default=1000, help='minutes to read')
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('--clock', type=float, default=12e6, help='clock frequency in Hz')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--text', action='store_true', help='write text files instead of hits.tdc')
+    parser.add_argument('--no-pipeline', action='store_true', help='read, decode and write in one thread')
+    parser.add_argument('--online-calibration', action='store_true', help='update the LUTs during the run')
+    parser.add_argument('--metrics-file', default='health.json', help='.json or .prom file in the run folder')
+    parser.add_argument('--metrics-port', type=int, default=None, help='serve the health metrics on this port')
+    parser.add_argument('--drift', type=float, default=None, metavar='SECONDS',
+                        help='also store the fine code histograms in time slices of this width')
+    parser.add_argument('--seq-bytes', type=int, default=0, help='sequence number in front of each datagram')
+    parser.add_argument('--kit', choices=KITS, default=None, help='development kit, recorded in hits.tdc')
+    args = parser.parse_args(argv)
+
+    port = args.port or ('0.0.0.0:5000' if args.format == 'ethernet' else DEFAULT_PORT)
+    print(acquire(port, args.format, args.runtime * 60, args.data_dir, args.clock, args.baud, not args.no_pipeline,
+                  not args.text, args.online_calibration, args.metrics_port, args.seq_bytes, args.metrics_file,
+                  args.drift, args.kit))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+# Code-density calibration of the delay lines.
+#
+# With signals arriving uniformly distributed within the clock period, the number
+# of hits in a fine code is proportional to the width of that bin:
+#
+#   width[code] = counts[code] / entries * 1/freq
+#
+# The time of a code is the center of its bin, i.e. the sum of all previous widths
+# plus half of its own width. The counts of all channels are histogrammed in one
+# np.bincount call. The resulting look-up tables (LUTs) are saved per run and
+# channel in ./data/<timestamp>/calibration/<channel>.npz so later analysis can
+# load them instead of recomputing.
+#
+# For long runs the bin widths drift with temperature. StreamingCalibrator updates
+# the histograms hit batch by hit batch with exponential forgetting and publishes
+# a new LUT every N hits. Each published LUT is saved in calibration/online/ and a
+# log records from which hit on it was in effect.
+
+import argparse
+import csv
+import datetime
+import os
+from typing import NamedTuple
+
+import numpy as np
+
+LUT_VERSION = 1
+LUT_DIR = 'calibration'
+ONLINE_DIR = 'online'
+ONLINE_LOG = 'luts.csv'
+
+# carry4_count * 4 bins in the delay line. Code 288 is the overflow bin
+CHAIN_CODES = 4 * 72
+
+
+class Lut(NamedTuple):
+    channel: str
+    counts: np.ndarray          # hits per fine code
+    widths: np.ndarray          # bin widths in ns
+    centers: np.ndarray         # time of the bin centers in ns, measured from the start of the delay line
+    freq: float                 # clock frequency in Hz
+
+    @property
+    def entries(self) -> int:
+        return int(self.counts.sum())
+
+    @property
+    def n_codes(self) -> int:
+        return len(self.counts)
+
+    # Right bin edges in ns (the cumulative sum of the widths)
+    @property
+    def edges(self) -> np.ndarray:
+        return np.cumsum(self.widths)
+
+    # Convert fine codes to times in ns. Codes beyond the calibrated range get the time of the last bin
+    def times(self, fine: np.ndarray) -> np.ndarray:
+        return self.centers[np.minimum(fine, self.n_codes - 1)]
+
+
+# Build the LUT of one channel from its code-density counts
+def lut_from_counts(channel: str, counts: np.ndarray, freq: float = 12e6) -> Lut:
+    counts = np.asarray(counts)
+    entries = counts.sum()
+    widths = counts / entries * 1 / freq * 1e9 if entries else np.zeros(len(counts))
+    centers = np.cumsum(widths) - widths / 2
+    return Lut(channel, counts, widths, centers, freq)
+
+
+# Histogram the fine codes of all channels in one pass. Returns an array of shape (channels, n_codes)
+def code_density(fine: dict[str, np.ndarray], n_codes: int | None = None) -> np.ndarray:
+    channels = list(fine)
+    if n_codes is None:
+        n_codes = max((int(fine[c].max()) + 1 for c in channels if len(fine[c])), default=0)
+    codes = np.concatenate([np.minimum(fine[c], n_codes - 1).astype(np.int64) for c in channels])
+    offsets = np.repeat(np.arange(len(channels)) * n_codes, [len(fine[c]) for c in channels])
+    return np.bincount(codes + offsets, minlength=len(channels) * n_codes).reshape(len(channels), n_codes)
+
+
+# Remove the overflow hits (the maximum code of each channel, recorded when a signal arrives during the reset
+# of the delay line). Hits with the same index are removed in all channels so the remaining values still match.
+def remove_overflow(fine: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    length = max((len(d) for d in fine.values()), default=0)
+    overflow = np.zeros(length, dtype=bool)
+    for data in fine.values():
+        if len(data):
+            overflow[:len(data)] |= data == data.max()
+    return {channel: np.asarray(data)[~overflow[:len(data)]] for channel, data in fine.items()}
+
+
+# Calibrate all channels. Returns a LUT per channel
+def calibrate(fine: dict[str, np.ndarray], freq: float = 12e6, n_codes: int | None = None) -> dict[str, Lut]:
+    counts = code_density(fine, n_codes)
+    return {channel: lut_from_counts(channel, counts[i], freq) for i, channel in enumerate(fine)}
+
+
+def lut_path(run_dir: str, channel: str) -> str:
+    return os.path.join(run_dir, LUT_DIR, f'{channel}.npz')
+
+
+def save_lut(run_dir: str, lut: Lut, path: str | None = None, **meta) -> str:
+    path = path or lut_path(run_dir, lut.channel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, version=LUT_VERSION, run=os.path.basename(os.path.normpath(run_dir)), channel=lut.channel,
+             freq=lut.freq, counts=lut.counts, widths=lut.widths, centers=lut.centers,
+             created=datetime.datetime.now().isoformat(timespec='seconds'), **meta)
+    return path
+
+
+def save_luts(run_dir: str, luts: dict[str, Lut], **meta) -> list[str]:
+    return [save_lut(run_dir, lut, **meta) for lut in luts.values()]
+
+
+# Load the LUT of one channel. Raises FileNotFoundError if the run was not calibrated yet
+def load_lut(run_dir: str, channel: str, path: str | None = None) -> Lut:
+    path = path or lut_path(run_dir, channel)
+    with np.load(path) as f:
+        if int(f['version']) > LUT_VERSION:
+            raise ValueError(f'{path}: LUT version {int(f["version"])} is newer than supported')
+        return Lut(str(f['channel']), f['counts'], f['widths'], f['centers'], float(f['freq']))
+
+
+def load_luts(run_dir: str, channels: list[str]) -> dict[str, Lut]:
+    return {channel: load_lut(run_dir, channel) for channel in channels}
+
+
+# Load the LUTs of a run, or calibrate the (overflow-free) fine codes and save the LUTs if there are none yet
+def get_luts(run_dir: str, channels: list[str], fine: dict[str, np.ndarray] | None = None, freq: float = 12e6,
+             recompute: bool = False) -> dict[str, Lut]:
+    if not recompute:
+        try:
+            return load_luts(run_dir, channels)
+        except FileNotFoundError:
+            pass
+    if fine is None:
+        from .loader import Run
+        fine = remove_overflow({c: h.fine for c, h in Run(run_dir).load(channels).items()})
+    luts = calibrate({c: fine[c] for c in channels}, freq)
+    save_luts(run_dir, luts)
+    return luts
+
+
+# Calibrate a run chunk by chunk, so memory does not grow with the run length. The overflow code (the
+# highest code of each channel) is dropped from the counts. Unlike remove_overflow, the hits with the
+# same index in the other channels are kept, so for several channels the result can differ slightly.
+def calibrate_run(run_dir: str, channels: list[str] | None = None, freq: float = 12e6,
+                  n_codes: int = CHAIN_CODES + 1, save: bool = True) -> dict[str, Lut]:
+    from .loader import Run
+    run = Run(run_dir)
+    channels = list(run.channels) if channels is None else list(channels)
+    counts = np.zeros((len(channels), n_codes), dtype=np.int64)
+    for chunk in run.iter_chunks(channels):
+        present = [c for c in channels if c in chunk]
+        part = code_density({c: chunk[c].fine for c in present}, n_codes)
+        counts[[channels.index(c) for c in present]] += part
+
+    luts = {}
+    for i, channel in enumerate(channels):
+        used = np.flatnonzero(counts[i])
+        n = used[-1] if len(used) else 0
+        luts[channel] = lut_from_counts(channel, counts[i, :n], freq)
+    if save:
+        save_luts(run_dir, luts)
+    return luts
+
+
+def online_lut_path(run_dir: str, channel: str, number: int) -> str:
+    return os.path.join(run_dir, LUT_DIR, ONLINE_DIR, f'{channel}_{number:06d}.npz')
+
+
+class StreamingCalibrator:
+    """Code-density calibration that is updated during the acquisition.
+
+    The histogram of each channel decays by exp(-n / window) for every n new hits, so it follows
+    drifts of the bin widths on a scale of window hits (window=None: no forgetting). Every
+    publish_every hits of a channel a new LUT is published. If run_dir is given, every LUT is saved
+    to calibration/online/<channel>_<number>.npz and calibration/online/luts.csv records the first
+    hit (counted per channel) it was used for. Memory does not grow with the run, an update
+    costs O(batch + n_codes).
+    """
+
+    def __init__(self, channels: list[str], n_codes: int = CHAIN_CODES, freq: float = 12e6,
+                 window: float | None = 10**6, publish_every: int = 10**5, run_dir: str | None = None,
+                 initial: dict[str, Lut] | None = None):
+        self.channels = list(channels)
+        self.n_codes = n_codes
+        self.freq = freq
+        self.window = window
+        self.publish_every = publish_every
+        self.run_dir = run_dir
+
+        self.counts = np.zeros((len(self.channels), n_codes))
+        self.hits = np.zeros(len(self.channels), dtype=np.int64)
+        self.since_publish = np.zeros(len(self.channels), dtype=np.int64)
+
+        # LUT in effect per channel and its number (-1: no LUT yet)
+        self.luts = dict(initial or {})
+        self.numbers = {channel: (0 if channel in self.luts else -1) for channel in self.channels}
+
+        self.log = None
+        if run_dir is not None:
+            os.makedirs(os.path.join(run_dir, LUT_DIR, ONLINE_DIR), exist_ok=True)
+            self.log = open(os.path.join(run_dir, LUT_DIR, ONLINE_DIR, ONLINE_LOG), 'a', newline='')
+            for channel, lut in self.luts.items():
+                self._save(channel, lut)
+
+    def _save(self, channel: str, lut: Lut) -> None:
+        if self.log is None:
+            return
+        number = self.numbers[channel]
+        save_lut(self.run_dir, lut, online_lut_path(self.run_dir, channel, number), number=number,
+                 first_hit=int(self.hits[self.channels.index(channel)]))
+        csv.writer(self.log).writerow([channel, number, int(self.hits[self.channels.index(channel)])])
+        self.log.flush()
+
+    def _publish(self, i: int) -> None:
+        channel = self.channels[i]
+        self.numbers[channel] += 1
+        self.luts[channel] = lut_from_counts(channel, self.counts[i].copy(), self.freq)
+        self.since_publish[i] = 0
+        self._save(channel, self.luts[channel])
+
+    # Add the fine codes of one channel. Returns the times in ns (nan before the first LUT) and the LUT number used
+    # for each hit if convert is set
+    def add(self, channel: str, fine: np.ndarray, convert: bool = True):
+        i = self.channels.index(channel)
+        fine = np.asarray(fine)
+        times = np.empty(len(fine)) if convert else None
+        numbers = np.empty(len(fine), dtype=np.int32) if convert else None
+
+        # Split the batch where a new LUT is published, the hits after that use the new LUT
+        pos = 0
+        while pos < len(fine):
+            n = min(len(fine) - pos, self.publish_every - self.since_publish[i])
+            segment = fine[pos:pos + n]
+
+            if convert:
+                lut = self.luts.get(channel)
+                times[pos:pos + n] = lut.times(segment) if lut is not None else np.nan
+                numbers[pos:pos + n] = self.numbers[channel]
+
+            if self.window:
+                self.counts[i] *= np.exp(-n / self.window)
+            valid = segment[segment < self.n_codes]
+            self.counts[i] += np.bincount(valid, minlength=self.n_codes)
+
+            self.hits[i] += n
+            self.since_publish[i] += n
+            pos += n
+            if self.since_publish[i] >= self.publish_every:
+                self._publish(i)
+
+        return (times, numbers) if convert else None
+
+    # Add a batch of hits of several channels, ids are indices into self.channels
+    def update(self, ids: np.ndarray, fine: np.ndarray, convert: bool = False) -> dict:
+        out = {}
+        for i, channel in enumerate(self.channels):
+            selected = fine[ids == i] if np.ndim(ids) else (fine if ids == i else fine[:0])
+            if len(selected):
+                out[channel] = self.add(channel, selected, convert)
+        return out
+
+    def close(self) -> None:
+        if self.log is not None:
+            self.log.close()
+
+
+# Read the LUTs published during a run. Returns per channel the first hit of each LUT and the LUTs
+def load_online_luts(run_dir: str) -> dict[str, tuple[np.ndarray, list[Lut]]]:
+    entries = {}
+    with open(os.path.join(run_dir, LUT_DIR, ONLINE_DIR, ONLINE_LOG), newline='') as f:
+        for channel, number, first_hit in csv.reader(f):
+            entries.setdefault(channel, []).append((int(first_hit), int(number)))
+    out = {}
+    for channel, rows in entries.items():
+        rows.sort()
+        luts = [load_lut(run_dir, channel, online_lut_path(run_dir, channel, number)) for _, number in rows]
+        out[channel] = (np.array([first for first, _ in rows]), luts)
+    return out
+
+
+# Convert fine codes with the LUT that was in effect for each hit. first_hit is the index (per channel) of fine[0]
+def online_times(online: tuple[np.ndarray, list[Lut]], fine: np.ndarray, first_hit: int = 0) -> np.ndarray:
+    starts, luts = online
+    index = np.searchsorted(starts, np.arange(first_hit, first_hit + len(fine)), side='right') - 1
+    times = np.full(len(fine), np.nan)
+    for k in np.unique(index[index >= 0]):
+        sel = index == k
+        times[sel] = luts[k].times(fine[sel])
+    return times
+
+
+# Calibrate a run and save its LUTs. Binary runs are calibrated chunk by chunk in worker processes
+def main(argv: list[str] | None = None, prog: str | None = None):
+    from .catalog import resolve_run
+    from .loader import Run
+
+    parser = argparse.ArgumentParser(prog=prog, description='Code-density calibration of the channels of a run')
+    parser.add_argument('run', nargs='?', default='latest',
+                        help="run folder, run name in --data-dir, part of it or 'latest'")
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('-c', '--channels', nargs='+', default=None)
+    parser.add_argument('--freq', type=float, default=None, help='clock frequency in Hz (default: the one of the run)')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--recompute', action='store_true', help='calibrate again even if the run has LUTs')
+    args = parser.parse_args(argv)
+
+    run_dir = resolve_run(args.run, args.data_dir)
+    run = Run(run_dir)
+    channels = args.channels or run.channels
+    freq = args.freq or run.clock_hz
+    luts = {}
+    if not args.recompute:
+        try:
+            luts = load_luts(run_dir, channels)
+        except FileNotFoundError:
+            pass
+    if not luts and run.binary:
+        from .parallel import calibrate_parallel
+        luts = calibrate_parallel(run_dir, channels, freq, processes=args.processes)
+    elif not luts:
+        luts = get_luts(run_dir, channels, freq=freq, recompute=True)
+    for channel, lut in luts.items():
+        print(f'{channel}: {lut.entries} hits, {lut.n_codes} codes, delay line {lut.edges[-1]:.3f} ns'
+              f' -> {lut_path(run_dir, channel)}')
+
+
+if __name__ == '__main__':
+    main()
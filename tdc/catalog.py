@@ -0,0 +1,460 @@
+# Catalog of the recorded runs in ./data with cached summaries.
+#
+# Every folder ./data/<timestamp> with a hits.tdc or the legacy text files is a run,
+# the boards of a multi board run (multi.py) are the runs ./data/multi_<timestamp>/<board>.
+# The summary of a run (design, board, channels, hits per channel, time span, file
+# sizes, fine code histograms and coarse counter statistics) is computed once chunk
+# by chunk and cached in <run>/summary.npz. Listing the runs and plotting their
+# histograms then only reads the small cache files.
+#
+# The cache stores the size and modification time of the data files it was computed
+# from. If they differ, the summary is recomputed: when only records were appended to
+# hits.tdc (a run that is still being recorded), only the new records are read and
+# added to the cached histograms and counters. Otherwise the whole run is read again.
+#
+#   catalog = Catalog('./data')
+#   for info in catalog.runs(design='four_channels'):
+#       print(info['name'], info['hits'])
+#   summary = catalog.summary('latest')         # run name, part of it or 'latest'
+#   summary.hist['00']                           # counts of the fine codes 0 ... 511
+#
+# The analysis scripts pick their run with find_run(), which only looks at the folder
+# names and headers and does not need the summaries. The one channel design runs on the
+# Max1000 and on the Max10 kit, so its scripts also give the kit that acquire() recorded
+# in the header. Text runs and runs recorded before the kit was stored have no kit and
+# are found for either kit:
+#
+#   timestamp = find_run('latest', design = 'one_channel', kit = 'max1000')
+#
+#   python -m tdc.catalog                      # table of all runs
+#   python -m tdc.catalog show latest --plot   # summary and histograms of a run
+
+import argparse
+import datetime
+import json
+import os
+import re
+import zlib
+from typing import NamedTuple
+
+import numpy as np
+
+from .coarse import Unwrapper
+from .decode import FINE_BITS
+from .loader import RECORD_BLOCK, Run
+from .multi import ARRIVALS_FILE, MANIFEST
+from .metrics import write_snapshot
+from .storage import (FILE_NAME, FLAG_NO_COARSE, FLAG_NO_FINE, LAYOUT_FINE_COARSE, RECORD_DTYPE, legacy_layout,
+                      read_header)
+
+SUMMARY_FILE = 'summary.npz'
+SUMMARY_VERSION = 2
+# Overview of all runs (without histograms), rewritten by Catalog.runs()
+INDEX_FILE = 'catalog.json'
+# Bins of the cached histograms: every value a 9 bit fine code can take
+CODES = 1 << FINE_BITS
+# Bytes at the end of the summarized records that must be unchanged to only add the appended records
+TAIL_BYTES = 1 << 12
+TEXT_FILES = ['fine.txt', 'coarse.txt', '00.txt', '01.txt', '10.txt', '11.txt']
+DESIGNS = {LAYOUT_FINE_COARSE: 'one_channel', 'per_channel': 'four_channels'}
+STARTED = re.compile(r'(\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2})')
+
+
+class Summary(NamedTuple):
+    info: dict                      # everything but the histograms, can be written as JSON
+    hist: dict[str, np.ndarray]     # fine code counts per channel, CODES bins
+
+
+# Names of all runs in data_dir, relative to it
+def list_runs(data_dir: str = './data') -> list[str]:
+    names = []
+    for entry in sorted(os.scandir(data_dir), key=lambda e: e.name) if os.path.isdir(data_dir) else []:
+        if not entry.is_dir() or entry.name.startswith('.'):
+            continue
+        if _data_files(entry.path):
+            names.append(entry.name)
+        elif os.path.exists(os.path.join(entry.path, MANIFEST)):
+            names += [f'{entry.name}/{board.name}' for board in sorted(os.scandir(entry.path), key=lambda e: e.name)
+                      if board.is_dir() and _data_files(board.path)]
+    return names
+
+
+# Pick a run: its name, 'latest' or a part of the name (the latest matching run is taken).
+# design restricts the search to 'one_channel', 'four_channels' or 'one_channel_ethernet' runs,
+# kit to runs of 'max1000' or 'max10' (runs without a recorded kit match any kit).
+def find_run(spec: str = 'latest', design: str | None = None, data_dir: str = './data',
+             kit: str | None = None) -> str:
+    names = list_runs(data_dir)
+    if spec in names:
+        return spec
+    if design is not None:
+        names = [name for name in names if _design(os.path.join(data_dir, name)) == design]
+    if kit is not None:
+        names = [name for name in names if _header(os.path.join(data_dir, name)).get('kit', kit) == kit]
+    if spec != 'latest':
+        names = [name for name in names if spec in name]
+    if not names:
+        raise FileNotFoundError(f'{data_dir}: no run matching {spec!r}' + (f' with design {design}' if design else '')
+                                + (f' from kit {kit}' if kit else ''))
+    return max(names, key=lambda name: _started(name, os.path.join(data_dir, name)))
+
+
+# Run folder given on the command line: an existing folder, or a run name, part of it or 'latest'
+# in data_dir (see find_run). The tdc subcommands take their run with this.
+def resolve_run(run: str = 'latest', data_dir: str = './data', design: str | None = None,
+                kit: str | None = None) -> str:
+    if os.path.isdir(run):
+        return run
+    return os.path.join(data_dir, find_run(run, design, data_dir, kit))
+
+
+class Catalog:
+    """The runs of a data folder with their cached summaries."""
+
+    def __init__(self, data_dir: str = './data', chunk: int = RECORD_BLOCK):
+        self.data_dir = data_dir
+        self.chunk = chunk
+
+    def names(self) -> list[str]:
+        return list_runs(self.data_dir)
+
+    # Summary of one run, from the cache if it is up to date
+    def summary(self, spec: str = 'latest', refresh: bool = False) -> Summary:
+        name = find_run(spec, data_dir=self.data_dir)
+        return run_summary(os.path.join(self.data_dir, name), name, refresh, self.chunk)
+
+    # Summaries (without histograms) of all runs, sorted by start time. Filters: design, layout and/or kit
+    def runs(self, design: str | None = None, layout: str | None = None, kit: str | None = None) -> list[dict]:
+        infos = []
+        for name in self.names():
+            try:
+                info = self.summary(name).info
+            except (OSError, ValueError) as e:
+                print(f'{name}: skipped ({e})')
+                continue
+            if ((design is None or info['design'] == design) and (layout is None or info['layout'] == layout)
+                    and (kit is None or info['kit'] in (kit, None))):
+                infos.append(info)
+        infos.sort(key=lambda info: (info['started'] or info['modified'], info['name']))
+        if design is None and layout is None and kit is None:
+            write_snapshot({'runs': infos}, os.path.join(self.data_dir, INDEX_FILE))
+        return infos
+
+
+# Summary of the run in run_dir, from its cache if it is up to date. Otherwise it is computed and cached
+def run_summary(run_dir: str, name: str | None = None, refresh: bool = False, chunk: int = RECORD_BLOCK) -> Summary:
+    cached = None if refresh else load_summary(run_dir)
+    signature = _signature(run_dir)
+    if cached is not None and cached[0].info['files'] == signature:
+        return cached[0]
+
+    summary, state = summarize(run_dir, name, chunk, cached)
+    try:
+        save_summary(run_dir, summary, state)
+    except OSError as e:
+        print(f'{run_dir}: summary not cached ({e})')
+    return summary
+
+
+# Read a run and compute its summary. With the cache of an earlier, shorter state of the
+# same hits.tdc only the appended records are read.
+def summarize(run_dir: str, name: str | None = None, chunk: int = RECORD_BLOCK,
+              cached: tuple[Summary, dict] | None = None) -> tuple[Summary, dict]:
+    name = name or os.path.basename(os.path.normpath(run_dir))
+    run = Run(run_dir)
+    signature = _signature(run_dir)
+    hist = np.zeros((len(run.channels), CODES), dtype=np.int64)
+    hits = np.zeros(len(run.channels), dtype=np.int64)
+    state = {'records': 0, 'tail_crc': 0, 'flagged': {'no_fine': 0, 'no_coarse': 0}, 'coarse': None}
+
+    if run.binary and cached is not None and appended(run, cached[1]):
+        state = cached[1]
+        for i, channel in enumerate(run.channels):
+            hist[i] = cached[0].hist[channel]
+            hits[i] = cached[0].info['hits'][channel]
+    coarse = _CoarseStats(state['coarse'])
+
+    if run.binary:
+        for lo in range(state['records'], len(run.records), chunk):
+            records = run.records[lo:lo + chunk]
+            channel = records['channel'].astype(np.int64)
+            flags = records['flags']
+            fine = records['fine'].astype(np.int64)
+            valid = ((flags & FLAG_NO_FINE) == 0) & (fine < CODES) & (channel < len(run.channels))
+            state['flagged']['no_fine'] += int(np.count_nonzero(flags & FLAG_NO_FINE))
+            if run.has_coarse:
+                state['flagged']['no_coarse'] += int(np.count_nonzero(flags & FLAG_NO_COARSE))
+            hist += np.bincount(channel[valid] * CODES + fine[valid], minlength=hist.size).reshape(hist.shape)
+            if run.has_coarse:
+                valid &= (flags & FLAG_NO_COARSE) == 0
+                coarse.feed(records['coarse'][valid])
+        hits[:] = hist.sum(axis=1)
+        state['records'] = len(run.records)
+        state['tail_crc'] = tail_crc(run)
+    else:
+        for part in run.iter_chunks(chunk=chunk):
+            for channel, h in part.items():
+                i = run.channels.index(channel)
+                fine = h.fine[h.fine < CODES].astype(np.int64)
+                hist[i] += np.bincount(fine, minlength=CODES)
+                hits[i] += len(h.fine)
+                if h.coarse is not None:
+                    coarse.feed(h.coarse)
+    state['coarse'] = coarse.state()
+
+    started = _started(name, run_dir)
+    modified = max((m for _, m in signature.values()), default=0) / 1e9
+    span = coarse.span(run.clock_hz)
+    if span is None and os.path.exists(os.path.join(run_dir, ARRIVALS_FILE)):
+        # Without a coarse counter the span comes from the host times of the batches of a multi board run
+        arrivals = np.fromfile(os.path.join(run_dir, ARRIVALS_FILE), dtype='<i8').reshape(-1, 2)
+        span = (arrivals[-1, 1] - arrivals[0, 1]) / 1e9 if len(arrivals) > 1 else None
+    header = run.header or {}
+    info = {
+        'version': SUMMARY_VERSION,
+        'name': name,
+        'format': 'binary' if run.binary else 'text',
+        'layout': run.layout,
+        'design': _design(run_dir, run.layout, header),
+        'kit': header.get('kit'),
+        'board': header.get('board'),
+        'source': header.get('source'),
+        'clock_hz': run.clock_hz,
+        'channels': list(run.channels),
+        'hits': dict(zip(run.channels, hits.tolist())),
+        'flagged': state['flagged'],
+        'started': _iso(started) if STARTED.search(name) else None,
+        'modified': _iso(modified),
+        'span_s': span,
+        'rate_hz': int(hits.sum()) / span if span else None,
+        'coarse': coarse.info(run.clock_hz),
+        'size_bytes': sum(s for s, _ in signature.values()),
+        'files': signature,
+    }
+    return Summary(info, dict(zip(run.channels, hist))), state
+
+
+def save_summary(run_dir: str, summary: Summary, state: dict) -> str:
+    path = os.path.join(run_dir, SUMMARY_FILE)
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, version=SUMMARY_VERSION, info=json.dumps(summary.info), state=json.dumps(state),
+             hist=np.array([summary.hist[c] for c in summary.info['channels']]).reshape(-1, CODES))
+    os.replace(tmp, path)
+    return path
+
+
+# Cached summary and state of a run, None if there is none or it cannot be used
+def load_summary(run_dir: str) -> tuple[Summary, dict] | None:
+    path = os.path.join(run_dir, SUMMARY_FILE)
+    try:
+        with np.load(path) as f:
+            if int(f['version']) != SUMMARY_VERSION:
+                return None
+            info = json.loads(str(f['info']))
+            state = json.loads(str(f['state']))
+            return Summary(info, dict(zip(info['channels'], f['hist']))), state
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# Size and modification time in ns of the data files of a run
+def _signature(run_dir: str) -> dict[str, list[int]]:
+    signature = {}
+    for name in _data_files(run_dir):
+        st = os.stat(os.path.join(run_dir, name))
+        signature[name] = [st.st_size, st.st_mtime_ns]
+    return signature
+
+
+def _data_files(run_dir: str) -> list[str]:
+    if os.path.exists(os.path.join(run_dir, FILE_NAME)):
+        return [FILE_NAME]
+    return [name for name in TEXT_FILES if os.path.exists(os.path.join(run_dir, name))]
+
+
+# True if records were appended to the ones the cached state was computed from. Only the end of the
+# old records is compared, the files are written append only.
+def appended(run: Run, state: dict) -> bool:
+    return 0 < state['records'] < len(run.records) and tail_crc(run, state['records']) == state['tail_crc']
+
+
+# CRC of the last TAIL_BYTES of the first n records (default: all)
+def tail_crc(run: Run, n: int | None = None) -> int:
+    n = len(run.records) if n is None else n
+    records = run.records[max(0, n - TAIL_BYTES // RECORD_DTYPE.itemsize):n]
+    return zlib.crc32(np.ascontiguousarray(records).tobytes())
+
+
+# Header of hits.tdc, empty for text runs
+def _header(run_dir: str) -> dict:
+    path = os.path.join(run_dir, FILE_NAME)
+    return read_header(path) if os.path.exists(path) else {}
+
+
+def _design(run_dir: str, layout: str | None = None, header: dict | None = None) -> str:
+    if layout is None:
+        header = _header(run_dir)
+        layout = header['layout'] if header else legacy_layout(run_dir)[0]
+    design = DESIGNS.get(layout, layout)
+    if layout == LAYOUT_FINE_COARSE and str((header or {}).get('source', '')).startswith('udp'):
+        design += '_ethernet'
+    return design
+
+
+# Start time of a run in s since the epoch, from the timestamp in its (or its multi run's) folder name
+def _started(name: str, run_dir: str) -> float:
+    match = STARTED.search(name)
+    if match:
+        return datetime.datetime.strptime(match.group(1), '%Y-%m-%d_%H:%M:%S').timestamp()
+    return min(m for _, m in _signature(run_dir).values()) / 1e9
+
+
+def _iso(t: float) -> str:
+    return datetime.datetime.fromtimestamp(t).isoformat(timespec='seconds')
+
+
+class _CoarseStats:
+    """Counters of the unwrapped coarse values, continued from a saved state."""
+
+    def __init__(self, state: dict | None = None):
+        self.unwrapper = Unwrapper()
+        self.first = None
+        self.min_step = None
+        self.max_step = None
+        self.wraps = 0
+        self.resets = 0
+        if state:
+            self.unwrapper.restore(state)
+            self.first = state['first']
+            self.min_step = state['min_step']
+            self.max_step = state['max_step']
+            self.wraps = state['wraps']
+            self.resets = state['resets']
+
+    def feed(self, coarse: np.ndarray) -> None:
+        if len(coarse) == 0:
+            return
+        u = self.unwrapper
+        if self.first is None:
+            self.first = int(coarse[0])
+        last_tick = u.last_tick
+        n_before = u.n
+        ticks = u.feed(coarse)
+        steps = np.diff(ticks) if n_before == 0 else np.diff(ticks, prepend=last_tick)
+        if len(steps):
+            self.min_step = int(steps.min()) if self.min_step is None else min(self.min_step, int(steps.min()))
+            self.max_step = int(steps.max()) if self.max_step is None else max(self.max_step, int(steps.max()))
+        # Only the numbers of wraps and resets are kept
+        self.wraps += len(u.wraps)
+        self.resets += len(u.resets)
+        u.wraps, u.resets = [], []
+
+    def state(self) -> dict | None:
+        u = self.unwrapper
+        if u.n == 0:
+            return None
+        return {**u.state(), 'first': self.first, 'min_step': self.min_step, 'max_step': self.max_step,
+                'wraps': self.wraps, 'resets': self.resets}
+
+    def span(self, clock_hz: float) -> float | None:
+        return self.unwrapper.last_tick / clock_hz if self.unwrapper.n else None
+
+    def info(self, clock_hz: float) -> dict | None:
+        u = self.unwrapper
+        if u.n == 0:
+            return None
+        return {
+            'hits': u.n,
+            'first': self.first,
+            'last': u.last_raw,
+            'ticks': u.last_tick,
+            'wraps': self.wraps,
+            'resets': self.resets,
+            'min_step': self.min_step,
+            'max_step': self.max_step,
+            'mean_step': u.last_tick / (u.n - 1) if u.n > 1 else None,
+        }
+
+
+def _format_row(info: dict) -> str:
+    hits = sum(info['hits'].values())
+    span = f"{info['span_s']:.0f} s" if info['span_s'] is not None else '-'
+    return f"{info['name']:<36} {info['design']:<21} {info['format']:<6} {hits:>12} {span:>9} " \
+           f"{info['size_bytes'] / 1e6:>9.1f} MB  {info['kit'] or '':<8} {info['board'] or ''}"
+
+
+def format_summary(summary: Summary) -> str:
+    info = summary.info
+    lines = [f"{info['name']} ({info['design']}, {info['format']}, {info['size_bytes'] / 1e6:.1f} MB)"]
+    if info['kit'] or info['board'] or info['source']:
+        lines.append(f"kit {info['kit'] or '-'}, board {info['board'] or '-'}, source {info['source'] or '-'}")
+    lines.append(f"started {info['started'] or '-'}, last written {info['modified']}")
+    if info['span_s'] is not None:
+        rate = f", {info['rate_hz']:.1f} hits/s" if info['rate_hz'] else ''
+        lines.append(f"span {info['span_s']:.1f} s{rate}")
+    for channel, hist in summary.hist.items():
+        codes = np.flatnonzero(hist)
+        used = f'codes {codes[0]} ... {codes[-1]}, {hist[codes[-1]]} hits in the last code' if len(codes) else 'no hits'
+        lines.append(f"channel {channel}: {info['hits'][channel]} hits, {used}")
+    if info['coarse']:
+        c = info['coarse']
+        lines.append(f"coarse: {c['wraps']} wraps, {c['resets']} counter resets, steps {c['min_step']} ... "
+                     f"{c['max_step']} ticks (mean {c['mean_step'] or 0:.1f})")
+    flagged = {k: v for k, v in info['flagged'].items() if v}
+    if flagged:
+        lines.append(f'flagged records: {flagged}')
+    return '\n'.join(lines)
+
+
+# Plot the cached fine code histograms of a run
+def plot_summary(summary: Summary, save_path: str | None = None, show: bool = True):
+    import matplotlib.pyplot as plt
+
+    channels = list(summary.hist)
+    ncols = min(2, len(channels))
+    nrows = (len(channels) + ncols - 1) // ncols
+    fig, axes = plt.subplots(nrows, ncols, squeeze=False, figsize=(6 * ncols, 4 * nrows))
+    for ax, channel in zip(axes.flat, channels):
+        hist = summary.hist[channel]
+        n_codes = np.flatnonzero(hist)[-1] + 1 if hist.any() else 1
+        ax.bar(np.arange(n_codes), hist[:n_codes], width=1, align='edge')
+        ax.set_title(f"Channel {channel}: {summary.info['hits'][channel]} hits")
+        ax.set_xlabel('Fine code')
+        ax.set_ylabel('Entries')
+    fig.suptitle(summary.info['name'])
+    fig.tight_layout()
+    if save_path:
+        fig.savefig(save_path, dpi=300)
+    if show:
+        plt.show()
+    return fig
+
+
+def main(argv: list[str] | None = None, prog: str | None = None):
+    parser = argparse.ArgumentParser(prog=prog, description='List the recorded runs and show their cached summaries')
+    parser.add_argument('command', nargs='?', choices=['list', 'show'], default='list')
+    parser.add_argument('run', nargs='?', default='latest', help="run folder, run name, part of it or 'latest' (show)")
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('--design', default=None, help='one_channel, one_channel_ethernet or four_channels')
+    parser.add_argument('--kit', default=None, help='max1000 or max10')
+    parser.add_argument('--refresh', action='store_true', help='recompute the summary (show)')
+    parser.add_argument('--plot', action='store_true', help='plot the fine code histograms (show)')
+    parser.add_argument('--save', default=None, help='save the plot to this file (show)')
+    args = parser.parse_args(argv)
+
+    catalog = Catalog(args.data_dir)
+    if args.command == 'list':
+        for info in catalog.runs(design=args.design, kit=args.kit):
+            print(_format_row(info))
+        return
+
+    run_dir = resolve_run(args.run, args.data_dir, args.design, args.kit)
+    name = os.path.relpath(run_dir, args.data_dir)
+    summary = run_summary(run_dir, None if name.startswith('..') else name, args.refresh)
+    print(format_summary(summary))
+    if args.plot or args.save:
+        plot_summary(summary, args.save, show=args.plot)
+
+
+if __name__ == '__main__':
+    main()
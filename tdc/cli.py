@@ -0,0 +1,57 @@
+# The `tdc` command: one entry point for the acquisition and analysis tools.
+#
+#   tdc acquire --format channels --port /dev/ttyUSB0 --runtime 60
+#   tdc monitor latest --fps 5
+#   tdc calibrate ./data/<timestamp>
+#   tdc coincide latest --window 2
+#   tdc convert to-text ./data/<timestamp>
+#
+# The commands that read a run take its folder, or its name in ./data (--data-dir),
+# a part of the name or 'latest' (catalog.resolve_run).
+#
+# Only the module of the chosen subcommand is imported, so `tdc acquire` starts
+# without numpy, matplotlib or ROOT in the way of opening the port, and
+# `tdc --help` returns at once. Each module also runs as python -m tdc.<module>.
+
+import importlib
+import sys
+
+# Subcommand -> (module, help)
+COMMANDS = {
+    'acquire': ('tdc.acquire', 'read one board into ./data/<timestamp>'),
+    'multi': ('tdc.multi', 'read several boards into one run'),
+    'monitor': ('tdc.monitor', 'live fine code histograms of a run that is being recorded'),
+    'calibrate': ('tdc.calib', 'code-density calibration of a run'),
+    'coincide': ('tdc.parallel', 'calibrate a run and build its coincidence events on all cores'),
+    'timestamps': ('tdc.timestamps', 'absolute ps timestamps of the hits'),
+    'drift': ('tdc.drift', 'fine code histograms of a run in time slices'),
+    'rates': ('tdc.rates', 'rate, dead time and lost hits from the coarse counter'),
+    'dnl': ('tdc.dnl', 'DNL, INL and effective LSB with uncertainties'),
+    'runs': ('tdc.catalog', 'list the recorded runs and their summaries'),
+    'convert': ('tdc.storage', 'convert runs between the text and the binary format'),
+    'emulate': ('tdc.emulator', 'emulate the byte stream of a board'),
+}
+
+
+def usage() -> str:
+    width = max(map(len, COMMANDS))
+    lines = ['usage: tdc <command> [options]', '', 'commands:']
+    lines += [f'  {name:<{width}}  {help_text}' for name, (_, help_text) in COMMANDS.items()]
+    lines += ['', "run 'tdc <command> --help' for the options of a command"]
+    return '\n'.join(lines)
+
+
+def main(argv: list[str] | None = None) -> None:
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return
+    command = argv[0]
+    if command not in COMMANDS:
+        sys.exit(f'tdc: unknown command {command!r}\n\n{usage()}')
+    module = importlib.import_module(COMMANDS[command][0])
+    module.main(argv[1:], prog=f'tdc {command}')
+
+
+if __name__ == '__main__':
+    main()
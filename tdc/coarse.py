@@ -0,0 +1,149 @@
+# Unwrapping of the coarse counter into an absolute timeline.
+#
+# The coarse counter of the one channel designs has 31 bits and wraps after
+# 2^31 ticks (about 178 s at 12 MHz). unwrap() turns the raw values into a
+# monotonic int64 tick count since the first hit of the run:
+#   - a step backwards that is a short step forwards modulo 2^31 is a wrap. Short
+#     means at most max_gap ticks, by default 100 times the median step between hits
+#     (at most half the period), so resets are rarely taken for wraps,
+#   - any other step backwards is a counter reset (FPGA reset or reprogramming).
+#     The elapsed time is unknown then, the counter is assumed to have restarted
+#     from 0 right after the previous hit, so the timeline stays monotonic.
+# Unwrapper does the same chunk by chunk for streams and long runs.
+#
+# fit_period() fits the ticks of a periodic trigger linearly against the pulse
+# number. This gives the trigger period in ticks, i.e. the trigger rate if the
+# clock is known or the clock frequency if the trigger rate is known.
+
+from typing import NamedTuple
+
+import numpy as np
+
+from .decode import COARSE_BITS
+
+COARSE_PERIOD = 1 << COARSE_BITS
+
+
+class Timeline(NamedTuple):
+    ticks: np.ndarray       # int64 ticks since the first hit
+    wraps: np.ndarray       # index of the hits right after a wrap
+    resets: np.ndarray      # index of the hits right after a counter reset
+
+
+# Default for the longest gap that is still accepted as a wrap
+def default_max_gap(coarse: np.ndarray, period: int) -> int:
+    d = np.diff(coarse.astype(np.int64))
+    d = d[d > 0]
+    if len(d) == 0:
+        return period // 2
+    return int(min(100 * np.median(d), period // 2))
+
+
+# Forward steps (in ticks) between consecutive hits. Wraps and resets are given as boolean masks.
+def _steps(coarse: np.ndarray, period: int, max_gap: int):
+    d = np.diff(coarse.astype(np.int64))
+    back = d < 0
+    wrap = back & (d + period <= max_gap)
+    reset = back & ~wrap
+    d[wrap] += period
+    d[reset] = coarse[1:][reset]
+    return d, wrap, reset
+
+
+def unwrap(coarse: np.ndarray, period: int = COARSE_PERIOD, max_gap: int | None = None) -> Timeline:
+    coarse = np.asarray(coarse)
+    max_gap = default_max_gap(coarse, period) if max_gap is None else max_gap
+    if len(coarse) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return Timeline(empty, empty, empty)
+
+    d, wrap, reset = _steps(coarse, period, max_gap)
+    ticks = np.empty(len(coarse), dtype=np.int64)
+    ticks[0] = 0
+    np.cumsum(d, out=ticks[1:])
+    return Timeline(ticks, np.flatnonzero(wrap) + 1, np.flatnonzero(reset) + 1)
+
+
+class Unwrapper:
+    """Streaming version of unwrap(): feed the coarse values chunk by chunk, get the ticks back."""
+
+    def __init__(self, period: int = COARSE_PERIOD, max_gap: int | None = None):
+        self.period = period
+        # Without max_gap it is estimated from the first chunk
+        self.max_gap = max_gap
+        self.last_raw = None
+        self.last_tick = 0
+        self.n = 0
+        self.wraps = []
+        self.resets = []
+
+    def feed(self, coarse: np.ndarray) -> np.ndarray:
+        coarse = np.asarray(coarse)
+        if len(coarse) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        if self.max_gap is None:
+            self.max_gap = default_max_gap(coarse, self.period)
+
+        # Prepend the last value of the previous chunk to get the step across the chunk boundary
+        if self.last_raw is None:
+            raw = coarse.astype(np.int64)
+            d, wrap, reset = _steps(raw, self.period, self.max_gap)
+            steps = np.concatenate([[0], d])
+            offset = self.n
+        else:
+            raw = np.concatenate([[self.last_raw], coarse.astype(np.int64)])
+            steps, wrap, reset = _steps(raw, self.period, self.max_gap)
+            offset = self.n - 1
+
+        ticks = self.last_tick + np.cumsum(steps)
+        self.wraps.extend((np.flatnonzero(wrap) + 1 + offset).tolist())
+        self.resets.extend((np.flatnonzero(reset) + 1 + offset).tolist())
+        self.last_raw = int(coarse[-1])
+        self.last_tick = int(ticks[-1])
+        self.n += len(coarse)
+        return ticks
+
+    # Position in the stream, to continue it later with restore() (the wraps and resets are not kept)
+    def state(self) -> dict:
+        return {'max_gap': self.max_gap, 'last_raw': self.last_raw, 'last_tick': self.last_tick, 'n': self.n}
+
+    def restore(self, state: dict) -> 'Unwrapper':
+        self.max_gap = state['max_gap']
+        self.last_raw = state['last_raw']
+        self.last_tick = state['last_tick']
+        self.n = state['n']
+        return self
+
+    def report(self) -> str:
+        return f'{self.n} hits, {len(self.wraps)} wraps, {len(self.resets)} counter resets' + \
+               (f' (at hits {self.resets[:10]}{" ..." if len(self.resets) > 10 else ""})' if self.resets else '')
+
+
+class PeriodFit(NamedTuple):
+    period: float           # ticks per trigger pulse
+    period_err: float
+    offset: float           # ticks of pulse 0
+    rms: float              # rms of the residuals in ticks
+    missing: int            # pulses without a hit
+
+
+# Linear fit ticks = offset + period * pulse. The pulse number of each hit is counted from the
+# steps in units of the median step, so missing hits do not bias the fit. Segments after counter resets should be fitted separately.
+def fit_period(ticks: np.ndarray) -> PeriodFit:
+    ticks = np.asarray(ticks, dtype=np.int64)
+    if len(ticks) < 3:
+        raise ValueError('at least 3 hits are needed to fit the trigger period')
+    rel = ticks - ticks[0]
+    d = np.diff(ticks)
+    pulse = np.concatenate([[0], np.cumsum(np.maximum(np.rint(d / np.median(d)), 1).astype(np.int64))])
+
+    # Least squares on centered values, in float64 after subtracting the first tick
+    x = pulse - pulse.mean()
+    y = rel - rel.mean()
+    sxx = x @ x
+    period = (x @ y) / sxx
+    offset = ticks[0] + rel.mean() - period * pulse.mean()
+    res = y - period * x
+    rms = np.sqrt(res @ res / (len(ticks) - 2))
+    return PeriodFit(period, rms / np.sqrt(sxx), offset, rms, int(pulse[-1] + 1 - len(np.unique(pulse))))
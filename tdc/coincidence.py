@@ -0,0 +1,88 @@
+# Event building for coincidence measurements.
+#
+# The hits of all channels are merged on their timestamps and grouped into events:
+# a hit belongs to the current event if it follows the previous hit by at most
+# window and lies within window of the first hit of the event. An event keeps the
+# first hit of each channel. Lost hits only remove a channel from one event instead
+# of shifting all later hits like pairing by array index does.
+#
+# Everything is done with a stable sort of the merged stream and cumulative sums,
+# O(n log n) for n hits. Any integer time base works: picoseconds for designs with
+# a coarse counter, the position in the acquisition stream for designs without.
+
+from typing import NamedTuple
+
+import numpy as np
+
+
+class Events(NamedTuple):
+    channels: list[str]
+    index: np.ndarray       # (n_events, n_channels) index of the hit in its channel, -1 if the channel is missing
+    fold: np.ndarray        # number of channels present in each event
+    start: np.ndarray       # timestamp of the first hit of each event
+
+    def __len__(self) -> int:
+        return len(self.fold)
+
+    # Events that contain all of the given channels
+    def having(self, channels: list[str]) -> 'Events':
+        cols = [self.channels.index(c) for c in channels]
+        sel = (self.index[:, cols] >= 0).all(axis=1)
+        return Events(self.channels, self.index[sel], self.fold[sel], self.start[sel])
+
+
+def build_events(stamps: dict[str, np.ndarray], window: int, min_fold: int = 2) -> Events:
+    channels = list(stamps)
+    lens = [len(stamps[c]) for c in channels]
+    if sum(lens) == 0:
+        return Events(channels, np.empty((0, len(channels)), dtype=np.int64), np.empty(0, dtype=np.int64),
+                      np.empty(0, dtype=np.int64))
+
+    # Merge the channels. Each channel is sorted already, so the stable sort only has to merge the runs
+    t = np.concatenate([np.asarray(stamps[c], dtype=np.int64) for c in channels])
+    ch = np.repeat(np.arange(len(channels), dtype=np.int64), lens)
+    idx = np.concatenate([np.arange(n, dtype=np.int64) for n in lens])
+    order = np.argsort(t, kind='stable')
+    t, ch, idx = t[order], ch[order], idx[order]
+
+    # A new event starts after every gap larger than the window
+    new = np.empty(len(t), dtype=bool)
+    new[0] = True
+    np.greater(np.diff(t), window, out=new[1:])
+    event = np.cumsum(new) - 1
+    start = t[new]
+
+    # Keep the first hit per event and channel. Each channel is in time order, so a hit is the first of its
+    # channel in the event if the hit before it in the same channel belongs to an earlier event
+    event_of = np.empty_like(event)
+    event_of[order] = event
+    first = np.empty(len(t), dtype=bool)
+    first[0] = True
+    np.not_equal(event_of[1:], event_of[:-1], out=first[1:])
+    starts = np.cumsum(lens)[:-1]
+    first[starts[starts < len(t)]] = True
+    # Hits too far from the first hit of their event (long chains of close hits) are not used
+    keep = first[order] & (t - start[event] <= window)
+
+    # Each (event, channel) pair is assigned at most once
+    index = np.full((len(start), len(channels)), -1, dtype=np.int64)
+    index[event[keep], ch[keep]] = idx[keep]
+
+    fold = (index >= 0).sum(axis=1)
+    sel = fold >= min_fold
+    return Events(channels, index[sel], fold[sel], start[sel])
+
+
+# Look up per-hit values (e.g. calibrated fine times) for each event. Missing channels are nan
+def event_values(events: Events, values: dict[str, np.ndarray]) -> np.ndarray:
+    out = np.full(events.index.shape, np.nan)
+    for k, channel in enumerate(events.channels):
+        present = events.index[:, k] >= 0
+        out[present, k] = np.asarray(values[channel])[events.index[present, k]]
+    return out
+
+
+# Count the events per fold (2-fold, 3-fold, ...)
+def fold_counts(events: Events) -> dict[int, int]:
+    folds, counts = np.unique(events.fold, return_counts=True)
+    return dict(zip(folds.tolist(), counts.tolist()))
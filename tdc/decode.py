@@ -0,0 +1,360 @@
+# Bulk decoding of the UART byte streams sent by the FPGA.
+#
+# One hit of the OneChannel_FineAndCoarse design is sent as 5 bytes (see
+# fifo_writer.vhd): the 40 bit word 31 coarse bits (39 downto 9) & 9 fine bits
+# (8 downto 0), least significant byte first. Instead of decoding byte by byte,
+# all complete frames in a buffer are decoded at once with numpy. Bytes of an
+# incomplete frame at the end of the buffer are kept for the next call.
+#
+# The stream decoders also check every frame for plausibility (fine code within
+# the delay line, coarse counter moving forward, valid channel order and zero
+# bits). A lost byte shifts all later frames, so after an implausible frame the
+# decoder searches the following bytes for the first offset where `lock` frames in
+# a row are plausible again, discards the bytes in between and logs the loss.
+# The check runs on whole arrays; the search only runs after an error.
+#
+# The frame hit by a loss mixes the bytes of two frames and can look plausible.
+# Whether a frame was hit is only known from the bytes after it, so the last frame
+# of each feed() is handed out with the next one; flush() at the end of the stream
+# returns it.
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+FRAME_BYTES = 5
+FINE_BITS = 9
+COARSE_BITS = 31
+
+FINE_MASK = (1 << FINE_BITS) - 1
+COARSE_MASK = (1 << COARSE_BITS) - 1
+
+# Highest fine value the delay line can produce (4 * 72 bins, the last one is the overflow code)
+MAX_FINE = 4 * 72
+# Largest plausible forward step of the coarse counter between two hits (2^27 ticks, ~11 s at 12 MHz)
+MAX_COARSE_STEP = 1 << 27
+# Plausible frames in a row needed to lock onto the stream again
+LOCK_FRAMES = 3
+# Frames checked to choose between candidate lock positions
+VERIFY_FRAMES = 32
+# Bytes searched for the next lock before the whole rest of the buffer is searched
+SEARCH_BYTES = 1 << 12
+
+
+# Decode all complete 5 byte frames in buf. Returns fine and coarse arrays and the number of bytes used
+def decode_frames(buf) -> tuple[np.ndarray, np.ndarray, int]:
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    n_frames = len(raw) // FRAME_BYTES
+    used = n_frames * FRAME_BYTES
+
+    fine, coarse = _split_frames(raw[:used].reshape(n_frames, FRAME_BYTES))
+    return fine, coarse, used
+
+
+# Fine and coarse of an (n, 5) array of frames
+def _split_frames(frames: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Pad every frame to 8 bytes so it can be viewed as one little endian 64 bit word
+    words = np.zeros((len(frames), 8), dtype=np.uint8)
+    words[:, :FRAME_BYTES] = frames
+    words = words.view('<u8').ravel()
+
+    fine = (words & FINE_MASK).astype(np.uint16)
+    coarse = ((words >> FINE_BITS) & COARSE_MASK).astype(np.uint32)
+    return fine, coarse
+
+
+# Inverse of decode_frames: the 5 byte frames as sent by the FPGA (used by test senders)
+def encode_frames(fine: np.ndarray, coarse: np.ndarray) -> bytes:
+    words = (np.asarray(coarse, dtype=np.uint64) & COARSE_MASK) << FINE_BITS | (np.asarray(fine, dtype=np.uint64) & FINE_MASK)
+    return words.astype('<u8').view(np.uint8).reshape(-1, 8)[:, :FRAME_BYTES].tobytes()
+
+
+class _StreamDecoder:
+    """Chunk by chunk decoding with plausibility checks and resynchronization.
+
+    Subclasses define the frame size, how an (n, frame_bytes) array of frames is decoded
+    into value arrays, which frames are plausible on their own and which pairs of
+    consecutive frames are plausible. Partial frames are carried over to the next feed().
+    """
+
+    frame_bytes = 1
+
+    def __init__(self, lock: int = LOCK_FRAMES, log=print):
+        self.lock = lock
+        self.log = log
+        self.rest = b''
+        self.frames = 0
+        self.bytes = 0
+        # Number of resynchronizations and the bytes thrown away for them
+        self.sync_errors = 0
+        self.bytes_discarded = 0
+        self.in_waiting_high_water = 0
+        self._last = None
+        self._pending = 0
+        self._skipped = False
+        self._synced = False
+
+    def _decode(self, frames: np.ndarray) -> tuple:
+        raise NotImplementedError
+
+    def _plausible(self, values: tuple) -> np.ndarray:
+        raise NotImplementedError
+
+    def _follows(self, prev: tuple, values: tuple) -> np.ndarray:
+        raise NotImplementedError
+
+    # Sort key among candidate offsets with equally long plausible runs, smaller is preferred
+    def _rank(self, values: tuple) -> float:
+        return 0.
+
+    # Values handed out (without internal check columns)
+    def _output(self, values: tuple) -> tuple:
+        return values
+
+    # Offset >= start where the stream can be locked again, or None if there is none yet.
+    # The first offset where lock plausible frames follow each other is a candidate, as are
+    # the other frame phases right after it: a stream shifted by one byte can look plausible
+    # for a while. The candidate with the longest plausible run (up to VERIFY_FRAMES) wins.
+    def _find_lock(self, raw: np.ndarray, start: int) -> int | None:
+        f = self.frame_bytes
+        for stop in (start + SEARCH_BYTES, len(raw)):
+            region = raw[start:stop]
+            if len(region) < self.lock * f:
+                return None
+            values = self._decode(sliding_window_view(region, f))
+            good = self._plausible(values)
+            good[:-f] &= self._follows(_take(values, slice(None, -f)), _take(values, slice(f, None)))
+            n = len(good) - (self.lock - 1) * f
+            chain = good[:n].copy()
+            for r in range(1, self.lock - 1):
+                chain &= good[r * f:r * f + n]
+            chain &= self._plausible(_take(values, slice((self.lock - 1) * f, None)))[:n]
+            found = np.flatnonzero(chain)
+            if len(found):
+                break
+            if stop >= len(raw):
+                return None
+
+        best = None
+        for j in found[found < found[0] + f]:
+            idx = np.arange(j, min(len(good), j + VERIFY_FRAMES * f), f)
+            bad = np.flatnonzero(~good[idx])
+            run = int(bad[0]) + 1 if len(bad) else len(idx)
+            key = (-run, self._rank(_take(values, idx[:run])))
+            if best is None or key < best[0]:
+                best = (key, int(j))
+        return start + best[1]
+
+    # Decode the complete frames of data and of the bytes kept from the last call. The last frame is kept back
+    # until the next call (final: the stream ends here, nothing is kept back)
+    def feed(self, data: bytes, final: bool = False) -> tuple:
+        self.bytes += len(data)
+        buf = self.rest + bytes(data) if self.rest else data
+        raw = np.frombuffer(buf, dtype=np.uint8)
+        f = self.frame_bytes
+        parts = []
+        pos = 0
+        while True:
+            if self._last is None:
+                # Start of the stream or after an implausible frame: find the frame boundary
+                j = self._find_lock(raw, pos)
+                if j is not None and (self._synced or self._skipped) and len(raw) - j < (VERIFY_FRAMES + 1) * f:
+                    # After lost bytes or a hole in the stream the phase is unknown: wait until all candidate
+                    # phases can be checked over VERIFY_FRAMES frames, a shifted one can look plausible for a
+                    # few frames
+                    break
+                if j is None:
+                    # Wait for more data, but only keep what is needed to find the lock
+                    keep = VERIFY_FRAMES * f
+                    if len(raw) - pos > keep:
+                        self._pending += len(raw) - pos - keep
+                        pos = len(raw) - keep
+                    break
+                lost = self._pending + j - pos
+                if lost and parts:
+                    # The frame hit by the loss is often plausible itself: drop the last frame before the loss
+                    # if it does not fit to the first frame after it, but its predecessor does. With less than
+                    # a frame discarded, the frame of the new phase right before the lock overlaps the last
+                    # frame. If that one fits instead, the last frame held its start and is dropped as well
+                    first = self._decode(raw[j:j + f].reshape(1, f))
+                    last = parts[-1]
+                    if not self._follows(_take(last, slice(-1, None)), first)[0]:
+                        before = self._decode(raw[j - f:j].reshape(1, f)) if lost < f else None
+                        if ((len(last[0]) >= 2 and self._follows(_take(last, slice(-2, -1)), first)[0])
+                                or (before is not None and self._plausible(before)[0]
+                                    and self._follows(before, first)[0])):
+                            parts[-1] = _take(last, slice(None, -1))
+                            lost += f
+                if lost:
+                    self.bytes_discarded += lost
+                if lost and not self._skipped:
+                    self.sync_errors += 1
+                    if self.log:
+                        self.log(f'Stream out of sync after {self.frames + sum(len(p[0]) for p in parts)} frames,'
+                                 f' {lost} bytes discarded')
+                self._pending = 0
+                self._skipped = False
+                self._synced = True
+                pos = j
+
+            n = (len(raw) - pos) // f
+            if not n:
+                break
+            values = self._decode(raw[pos:pos + n * f].reshape(n, f))
+            ok = self._plausible(values)
+            good = ok.copy()
+            good[1:] &= self._follows(_take(values, slice(None, -1)), _take(values, slice(1, None)))
+            if self._last is not None:
+                good[:1] &= self._follows(self._last, _take(values, slice(None, 1)))
+            bad = np.flatnonzero(~good)
+            k = int(bad[0]) if len(bad) else n
+            # If the frame before the first bad one is the odd one out (it was hit by the loss), drop it too
+            before = _take(values, slice(k - 2, k - 1)) if k >= 2 else self._last if k == 1 else None
+            if k < n and before is not None and ok[k] and self._follows(before, _take(values, slice(k, k + 1)))[0]:
+                k -= 1
+            if k:
+                parts.append(_take(values, slice(None, k)))
+                before_last = _take(values, slice(k - 2, k - 1)) if k >= 2 else self._last
+                self._last = _take(values, slice(k - 1, k))
+                last_end = pos + k * f
+            pos += k * f
+            if k == n:
+                break
+            # A frame at pos that is plausible itself and followed by plausible frames is locked
+            # again at once (a long pause or a counter reset), otherwise bytes are discarded
+            self._last = None
+
+        if parts and pos == last_end and not final:
+            # The last frame is handed out with the next feed: only the bytes after it can show that it was hit
+            # by a loss. Its bytes are decoded again, following the frame before it
+            parts[-1] = _take(parts[-1], slice(None, -1))
+            pos -= f
+            self._last = before_last
+        self.rest = bytes(raw[pos:])
+        values = _concat(parts) if parts else self._decode(np.empty((0, f), dtype=np.uint8))
+        self.frames += len(values[0])
+        return self._output(values)
+
+    # End of the stream: decode the frame kept back by the last feed()
+    def flush(self) -> tuple:
+        return self.feed(b'', final=True)
+
+    # n bytes of the stream are missing (a chunk the reader had to drop). The partial frame carried over can not be
+    # completed anymore: it is discarded and the frame boundary is searched again in the next chunk
+    def skip(self, n: int) -> None:
+        lost = n + len(self.rest)
+        self.sync_errors += 1
+        self.bytes_discarded += lost
+        if self.log:
+            self.log(f'Stream interrupted after {self.frames} frames, {lost} bytes lost')
+        self.rest = b''
+        self._last = None
+        self._skipped = True
+
+    # Read everything that is waiting in the serial buffer (blocks for at least one byte) and decode it
+    def read(self, ser) -> tuple:
+        waiting = ser.in_waiting
+        self.in_waiting_high_water = max(self.in_waiting_high_water, waiting)
+        return self.feed(ser.read(max(1, waiting)))
+
+
+def _take(values: tuple, sl: slice) -> tuple:
+    return tuple(v[sl] for v in values)
+
+
+def _concat(parts: list[tuple]) -> tuple:
+    if len(parts) == 1:
+        return parts[0]
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+
+class FrameDecoder(_StreamDecoder):
+    """Decode a 5 byte fine+coarse stream chunk by chunk.
+
+    A frame is plausible if its fine value is within the delay line and the coarse counter
+    moved forward by at most max_step ticks (modulo the wrap) since the previous frame. A larger
+    step (long pause, counter reset) is accepted if the frames after it are plausible.
+    max_step = None switches the coarse check off.
+    """
+
+    frame_bytes = FRAME_BYTES
+
+    def __init__(self, lock: int = LOCK_FRAMES, max_step: int | None = MAX_COARSE_STEP, log=print):
+        super().__init__(lock, log)
+        self.max_step = max_step
+
+    def _decode(self, frames):
+        return _split_frames(frames)
+
+    def _plausible(self, values):
+        return values[0] <= MAX_FINE
+
+    def _follows(self, prev, values):
+        if self.max_step is None:
+            return np.ones(len(values[1]), dtype=bool)
+        step = (values[1].astype(np.int64) - prev[1].astype(np.int64)) & COARSE_MASK
+        return step <= self.max_step
+
+    # Shifted by a byte, the coarse steps are 256 times larger or random: prefer small steps
+    def _rank(self, values):
+        if len(values[1]) < 2:
+            return 0.
+        return float(np.median((np.diff(values[1].astype(np.int64))) & COARSE_MASK))
+
+
+# The FourChannels_OnlyFine design sends 2 bytes per channel and hit: the first byte contains the
+# 2 bit channel ID (7 downto 6) and the overflow / fine MSB (0), the second byte the lower 8 fine bits.
+CHANNEL_FRAME_BYTES = 2
+CHANNELS = ['00', '01', '10', '11']
+# Bits of the first byte that are always zero
+ZERO_BITS = 0b00111110
+
+
+# Decode all complete 2 byte frames in buf. Returns channel IDs, fine values and the number of bytes used
+def decode_channel_frames(buf) -> tuple[np.ndarray, np.ndarray, int]:
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    n_frames = len(raw) // CHANNEL_FRAME_BYTES
+    used = n_frames * CHANNEL_FRAME_BYTES
+
+    frames = raw[:used].reshape(n_frames, CHANNEL_FRAME_BYTES)
+    channel = frames[:, 0] >> 6
+    fine = frames[:, 1].astype(np.uint16) | ((frames[:, 0] & 1).astype(np.uint16) << 8)
+    return channel, fine, used
+
+
+# Inverse of decode_channel_frames: channel IDs (0-3) and fine values as 2 byte frames
+def encode_channel_frames(channel: np.ndarray, fine: np.ndarray) -> bytes:
+    fine = np.asarray(fine, dtype=np.uint16)
+    frames = np.empty((len(fine), CHANNEL_FRAME_BYTES), dtype=np.uint8)
+    frames[:, 0] = (np.asarray(channel, dtype=np.uint8) << 6) | ((fine >> 8) & 1).astype(np.uint8)
+    frames[:, 1] = fine & 0xFF
+    return frames.tobytes()
+
+
+class ChannelFrameDecoder(_StreamDecoder):
+    """Decode the 2 byte channel/fine stream chunk by chunk.
+
+    A frame is plausible if the always-zero bits are zero and the fine value is within the
+    delay line, and it has to follow the previous frame in the round robin channel order.
+    """
+
+    frame_bytes = CHANNEL_FRAME_BYTES
+
+    def __init__(self, lock: int = LOCK_FRAMES, round_robin: bool = True, log=print):
+        super().__init__(lock, log)
+        self.round_robin = round_robin
+
+    def _decode(self, frames):
+        channel = frames[:, 0] >> 6
+        fine = frames[:, 1].astype(np.uint16) | ((frames[:, 0] & 1).astype(np.uint16) << 8)
+        return channel, fine, frames[:, 0] & ZERO_BITS
+
+    def _plausible(self, values):
+        return (values[2] == 0) & (values[1] <= MAX_FINE)
+
+    def _follows(self, prev, values):
+        if not self.round_robin:
+            return np.ones(len(values[0]), dtype=bool)
+        return values[0] == (prev[0] + 1) % len(CHANNELS)
+
+    def _output(self, values):
+        return values[0], values[1]
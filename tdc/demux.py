@@ -0,0 +1,72 @@
+# Per-channel output buffering for the acquisition scripts.
+#
+# Decoded hits are scattered into one in-memory buffer per channel. A buffer is
+# written to its {channel}.txt file once it holds more than flush_bytes or once
+# flush_secs have passed since the last flush. The files stay open for the
+# whole run instead of being opened and closed for every hit.
+
+import os
+import time
+
+import numpy as np
+
+
+class ChannelDemux:
+    """Buffered writer for one newline separated text file per channel."""
+
+    def __init__(self, directory: str, channels: list[str], flush_bytes: int = 1 << 16, flush_secs: float = 1.0):
+        self.directory = directory
+        self.channels = list(channels)
+        self.flush_bytes = flush_bytes
+        self.flush_secs = flush_secs
+
+        self.files = {channel: open(os.path.join(directory, f'{channel}.txt'), 'a') for channel in self.channels}
+        self.buffers = {channel: [] for channel in self.channels}
+        self.sizes = {channel: 0 for channel in self.channels}
+        self.last_flush = {channel: time.monotonic() for channel in self.channels}
+        # Duration of the last and of the slowest flush in s
+        self.flush_latency = 0.
+        self.flush_latency_max = 0.
+
+    # Append values to the buffer of one channel
+    def add(self, channel: str, values) -> None:
+        if len(values) == 0:
+            return
+        text = ''.join(f'{i}\n' for i in np.asarray(values).tolist())
+        self.buffers[channel].append(text)
+        self.sizes[channel] += len(text)
+
+    # Scatter hits with channel index ids (position in self.channels) to the channel buffers
+    def scatter(self, ids: np.ndarray, values: np.ndarray) -> None:
+        for i, channel in enumerate(self.channels):
+            self.add(channel, values[ids == i])
+        self.poll()
+
+    # Flush every buffer that passed the size or time threshold
+    def poll(self) -> None:
+        now = time.monotonic()
+        for channel in self.channels:
+            if self.sizes[channel] >= self.flush_bytes or (self.sizes[channel] and now - self.last_flush[channel] >= self.flush_secs):
+                self.flush(channel, now)
+
+    def flush(self, channel: str, now: float | None = None) -> None:
+        start = time.monotonic()
+        f = self.files[channel]
+        f.write(''.join(self.buffers[channel]))
+        f.flush()
+        self.buffers[channel].clear()
+        self.sizes[channel] = 0
+        self.last_flush[channel] = time.monotonic() if now is None else now
+        self.flush_latency = time.monotonic() - start
+        self.flush_latency_max = max(self.flush_latency_max, self.flush_latency)
+
+    def close(self) -> None:
+        for channel in self.channels:
+            self.flush(channel)
+            self.files[channel].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,240 @@
+# Nonlinearity of the delay lines from the code-density histograms.
+#
+# With the bin widths w[k] of the n used codes of a channel (calib.py) and the clock
+# period T:
+#
+#   lsb      = T / n                              average bin width
+#   dnl[k]   = w[k] / lsb - 1                     differential nonlinearity in LSB
+#   inl[k]   = dnl[0] + ... + dnl[k]              integral nonlinearity at the right edge of bin k, in LSB
+#   lsb_eff  = sqrt(sum(w^3) / T)                 equivalent bin width: the RMS quantization error of the
+#   q_rms    = lsb_eff / sqrt(12)                 TDC is that of an ideal TDC with bins of this width
+#   width_rms                                     spread (standard deviation) of the bin widths
+#
+# Codes without hits inside the used range are missing codes (dnl = -1).
+#
+# The uncertainties come from a bootstrap of the histograms: resampling N hits
+# with replacement is the same as drawing the counts from a multinomial
+# distribution with the measured code probabilities, which takes the same time for
+# 10^4 or 10^9 hits. The replicas are split into batches over a process pool.
+# The statistical errors scale with 1/sqrt(N), which gives the number of hits needed
+# for a target precision of the calibration:
+#
+#   results = characterize_run('./data/<timestamp>', n_boot=1000)
+#   lin = results['00']
+#   lin.metrics['dnl_max'], lin.errors['dnl_max']
+#   hits_needed(lin, target_ps=1.)      # hits for a 1 ps uncertainty of every bin center
+#
+#   python -m tdc.dnl ./data/<timestamp> --boot 1000 --target-ps 1
+
+import argparse
+from typing import NamedTuple
+
+import numpy as np
+
+from .calib import Lut, get_luts, load_luts
+from .parallel import pool_map
+
+METRICS = ['lsb', 'lsb_eff', 'q_rms', 'width_rms', 'dnl_min', 'dnl_max', 'dnl_rms', 'inl_min', 'inl_max', 'inl_rms']
+# Bootstrap replicas per task of the process pool
+BOOT_BATCH = 250
+
+
+class Linearity(NamedTuple):
+    channel: str
+    entries: int
+    widths: np.ndarray              # bin widths in ps
+    dnl: np.ndarray                 # in LSB
+    inl: np.ndarray                 # in LSB
+    missing: np.ndarray             # codes without hits
+    metrics: dict[str, float]       # lsb, lsb_eff, q_rms and width_rms in ps, the others in LSB
+    errors: dict[str, float]        # bootstrap standard deviation of the metrics, empty without bootstrap
+    dnl_err: np.ndarray | None
+    inl_err: np.ndarray | None
+    center_err: float | None        # largest bootstrap standard deviation of the bin centers in ps
+
+
+# Nonlinearity of code-density counts, rows of a 2D array are computed independently.
+# Returns the widths in ps, dnl, inl, bin centers in ps and the scalar metrics per row.
+def nonlinearity(counts: np.ndarray, freq: float = 12e6) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+                                                                   dict[str, np.ndarray]]:
+    counts = np.asarray(counts, dtype=np.float64)
+    period = 1e12 / freq
+    n = counts.shape[-1]
+    entries = counts.sum(axis=-1, keepdims=True)
+    widths = counts / np.maximum(entries, 1) * period
+    lsb = period / n
+    dnl = widths / lsb - 1
+    inl = np.cumsum(dnl, axis=-1)
+    centers = np.cumsum(widths, axis=-1) - widths / 2
+    lsb_eff = np.sqrt((widths ** 3).sum(axis=-1) / period)
+    metrics = {
+        'lsb': np.full(counts.shape[:-1], lsb),
+        'lsb_eff': lsb_eff,
+        'q_rms': lsb_eff / np.sqrt(12),
+        'width_rms': widths.std(axis=-1),
+        'dnl_min': dnl.min(axis=-1),
+        'dnl_max': dnl.max(axis=-1),
+        'dnl_rms': np.sqrt((dnl ** 2).mean(axis=-1)),
+        'inl_min': inl.min(axis=-1),
+        'inl_max': inl.max(axis=-1),
+        'inl_rms': np.sqrt((inl ** 2).mean(axis=-1)),
+    }
+    return widths, dnl, inl, centers, metrics
+
+
+# n_boot multinomial replicas of the counts. Returns the metrics of every replica (n_boot, len(METRICS)) and
+# the sums and sums of squares of dnl, inl and the centers over the replicas (2, 3, n_codes)
+def _bootstrap_batch(counts: np.ndarray, freq: float, n_boot: int, seed) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    counts = np.asarray(counts, dtype=np.int64)
+    replicas = rng.multinomial(counts.sum(), counts / counts.sum(), size=n_boot)
+    _, dnl, inl, centers, metrics = nonlinearity(replicas, freq)
+    values = np.stack([dnl, inl, centers])
+    moments = np.stack([values.sum(axis=1), (values ** 2).sum(axis=1)])
+    return np.stack([metrics[m] for m in METRICS], axis=1), moments
+
+
+# Used codes of a channel: up to its last code with hits (LUTs of several channels have a common length)
+def _used(counts: np.ndarray) -> np.ndarray:
+    counts = np.asarray(counts)
+    nonzero = np.flatnonzero(counts)
+    return counts[:nonzero[-1] + 1] if len(nonzero) else counts[:0]
+
+
+# DNL, INL and their bootstrap uncertainties of every channel. counts: code-density histogram or LUT per channel.
+# n_boot=0 skips the bootstrap. The same seed gives the same errors for any number of processes.
+def characterize(counts: dict[str, np.ndarray | Lut], freq: float = 12e6, n_boot: int = 1000,
+                 processes: int | None = None, seed: int = 0) -> dict[str, Linearity]:
+    counts = {channel: _used(c.counts if isinstance(c, Lut) else c) for channel, c in counts.items()}
+    empty = [channel for channel, c in counts.items() if c.sum() == 0]
+    if empty:
+        raise ValueError(f'no hits in channels {empty}')
+
+    tasks = []
+    seeds = iter(np.random.SeedSequence(seed).spawn(len(counts) * -(-n_boot // BOOT_BATCH)))
+    for channel, c in counts.items():
+        for lo in range(0, n_boot, BOOT_BATCH):
+            tasks.append((c, freq, min(BOOT_BATCH, n_boot - lo), next(seeds)))
+    results = pool_map(_bootstrap_batch, tasks, processes)
+
+    out = {}
+    for channel, c in counts.items():
+        widths, dnl, inl, _, metrics = nonlinearity(c, freq)
+        metrics = {m: float(v) for m, v in metrics.items()}
+        errors, dnl_err, inl_err, center_err = {}, None, None, None
+        if n_boot > 1:
+            batches = [next(results) for _ in range(0, n_boot, BOOT_BATCH)]
+            values = np.concatenate([b[0] for b in batches])
+            errors = dict(zip(METRICS, values.std(axis=0, ddof=1).tolist()))
+            s1, s2 = sum(b[1] for b in batches)
+            std = np.sqrt(np.maximum(s2 - s1 ** 2 / n_boot, 0) / (n_boot - 1))
+            dnl_err, inl_err, center_err = std[0], std[1], float(std[2].max())
+        elif n_boot == 1:
+            next(results)
+        out[channel] = Linearity(channel, int(c.sum()), widths, dnl, inl, np.flatnonzero(c == 0), metrics, errors,
+                                 dnl_err, inl_err, center_err)
+    return out
+
+
+# Load the LUTs of a run (or calibrate it, binary runs on all cores) and characterize all or the given channels
+def characterize_run(run_dir: str, channels: list[str] | None = None, freq: float = 12e6, n_boot: int = 1000,
+                     processes: int | None = None, seed: int = 0) -> dict[str, Linearity]:
+    from .loader import Run
+
+    run = Run(run_dir)
+    channels = channels or run.channels
+    try:
+        luts = load_luts(run_dir, channels)
+    except FileNotFoundError:
+        if run.binary:
+            from .parallel import calibrate_parallel
+            luts = calibrate_parallel(run_dir, channels, freq, processes=processes)
+        else:
+            luts = get_luts(run_dir, channels, freq=freq)
+    return characterize(luts, freq, n_boot, processes, seed)
+
+
+# Hits needed so that the bootstrap uncertainty of every bin center is target_ps, and/or that of the DNL of every
+# bin is target_dnl (in LSB). The errors scale with 1/sqrt(hits)
+def hits_needed(lin: Linearity, target_ps: float | None = None, target_dnl: float | None = None) -> int:
+    if lin.center_err is None:
+        raise ValueError(f'channel {lin.channel}: characterize with n_boot > 1 to estimate the hits needed')
+    ratios = []
+    if target_ps is not None:
+        ratios.append(lin.center_err / target_ps)
+    if target_dnl is not None:
+        ratios.append(float(lin.dnl_err.max()) / target_dnl)
+    if not ratios:
+        raise ValueError('give target_ps and/or target_dnl')
+    return int(np.ceil(lin.entries * max(ratios) ** 2))
+
+
+def format_linearity(lin: Linearity) -> str:
+    m, e = lin.metrics, lin.errors
+
+    def value(name, unit, digits):
+        err = f' +- {e[name]:.{digits}f}' if name in e else ''
+        return f'{m[name]:.{digits}f}{err}{unit}'
+
+    lines = [f'channel {lin.channel}: {lin.entries} hits, {len(lin.dnl)} codes, {len(lin.missing)} missing codes',
+             f"  LSB {value('lsb', ' ps', 1)}, effective LSB {value('lsb_eff', ' ps', 1)}, "
+             f"quantization RMS {value('q_rms', ' ps', 1)}, width RMS {value('width_rms', ' ps', 1)}",
+             f"  DNL {value('dnl_min', '', 3)} ... {value('dnl_max', '', 3)} LSB, RMS {value('dnl_rms', '', 3)}",
+             f"  INL {value('inl_min', '', 3)} ... {value('inl_max', '', 3)} LSB, RMS {value('inl_rms', '', 3)}"]
+    if lin.center_err is not None:
+        lines.append(f'  bin centers known to {lin.center_err:.2f} ps (largest bootstrap error)')
+    return '\n'.join(lines)
+
+
+# DNL and INL of each channel with their bootstrap errors as bands
+def plot_linearity(results: dict[str, Linearity], save_path: str | None = None, show: bool = True):
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(2, 1, sharex=True, figsize=(10, 8))
+    for lin in results.values():
+        codes = np.arange(len(lin.dnl))
+        for ax, values, err in ((axes[0], lin.dnl, lin.dnl_err), (axes[1], lin.inl, lin.inl_err)):
+            line, = ax.step(codes, values, where='mid', linewidth=.7, label=f'Channel {lin.channel}')
+            if err is not None:
+                ax.fill_between(codes, values - err, values + err, step='mid', alpha=.3, color=line.get_color())
+    axes[0].set_ylabel('DNL [LSB]')
+    axes[1].set_ylabel('INL [LSB]')
+    axes[1].set_xlabel('Bins')
+    axes[0].legend()
+    fig.tight_layout()
+    if save_path:
+        fig.savefig(save_path, dpi=300)
+    if show:
+        plt.show()
+    return fig
+
+
+def main(argv: list[str] | None = None, prog: str | None = None):
+    from .catalog import resolve_run
+
+    parser = argparse.ArgumentParser(prog=prog, description='DNL, INL and effective LSB of the channels of a run')
+    parser.add_argument('run', nargs='?', default='latest',
+                        help="run folder, run name in --data-dir, part of it or 'latest'")
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('-c', '--channels', nargs='+', default=None)
+    parser.add_argument('--freq', type=float, default=12e6, help='clock frequency in Hz')
+    parser.add_argument('--boot', type=int, default=1000, help='bootstrap replicas (0: no uncertainties)')
+    parser.add_argument('--target-ps', type=float, default=None, help='print the hits needed for this precision '
+                                                                        'of the bin centers')
+    parser.add_argument('--target-dnl', type=float, default=None, help='print the hits needed for this DNL precision')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--plot', default=None, help='save the DNL/INL plot to this file')
+    args = parser.parse_args(argv)
+
+    run_dir = resolve_run(args.run, args.data_dir)
+    results = characterize_run(run_dir, args.channels, args.freq, args.boot, args.processes)
+    for lin in results.values():
+        print(format_linearity(lin))
+        if args.boot > 1 and (args.target_ps or args.target_dnl):
+            print(f'  {hits_needed(lin, args.target_ps, args.target_dnl):.3g} hits needed for the target precision')
+    if args.plot:
+        plot_linearity(results, args.plot, show=False)
+
+
+if __name__ == '__main__':
+    main()
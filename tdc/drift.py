@@ -0,0 +1,453 @@
+# Time-resolved fine code histograms, to follow the drift of the delay lines over a run.
+#
+# The fine code counts of each channel are added up in time slices (by default one
+# minute each) and kept in <run>/drift/ with one row per slice:
+#   level0.u4        counts of the slices, uint32 rows of channels x 512 codes
+#   level1.u8 ...    each row of level k adds up FACTOR rows of level k - 1 (uint64)
+#   open.npy         counts of the slice that is still being filled
+#   drift.json       channels, slice width, unit of the time and how far the run was read
+# The level files only grow, finished rows are never written again. A query for a
+# time range takes the finest level that gives at most max_rows rows and reads only
+# those rows (memory mapped), so a day long run is shown from a few hundred rows and
+# the hits are never read again. Rows a level does not have yet (the last, unfinished
+# ones) are added up from the level below.
+#
+# The time of a hit is
+#   - the unwrapped coarse counter (one channel designs): ticks since the first hit,
+#   - without a coarse counter, the host time of the batch the hit came in: while
+#     recording (DriftRecorder, tdc acquire --drift) or from arrivals.i8 of a multi
+#     board run, in ns,
+#   - otherwise the hit number: the record number in hits.tdc, the line number in
+#     the text files.
+#
+# The store is filled during the acquisition or afterwards in one pass over the run.
+# A store built from a run that was still being recorded is continued with the
+# appended records only.
+#
+#   store = build_drift('./data/<timestamp>', width_s=60)
+#   view = store.view(start=3600, stop=7200)        # s (hit numbers for runs without time)
+#   view.counts                                      # rows x channels x codes
+#
+#   python -m tdc.drift build latest --width 60
+#   python -m tdc.drift show latest --start 3600 --stop 7200 --plot
+
+import argparse
+import json
+import os
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+from .coarse import Unwrapper
+from .decode import FINE_BITS
+from .loader import RECORD_BLOCK, Run
+from .metrics import write_snapshot
+from .storage import FLAG_NO_COARSE, FLAG_NO_FINE
+
+DRIFT_DIR = 'drift'
+DRIFT_VERSION = 1
+META_FILE = 'drift.json'
+OPEN_FILE = 'open.npy'
+CODES = 1 << FINE_BITS
+# Rows of a level added up into one row of the next level
+FACTOR = 4
+# Slice width of runs without time, in hits
+WIDTH_HITS = 10**5
+# Empty rows written at once when the run had no hits for a while
+ZERO_BLOCK = 1024
+
+
+class DriftView(NamedTuple):
+    channels: list[str]
+    level: int              # each row adds up FACTOR**level slices
+    edges: np.ndarray       # row edges in s (in hits for runs without time), one more than rows
+    counts: np.ndarray      # rows x channels x codes
+    unit: str               # 's' or 'hits'
+
+    # Hits per row and channel
+    @property
+    def hits(self) -> np.ndarray:
+        return self.counts.sum(axis=2)
+
+    # Mean fine code per row and channel (nan for rows without hits). It moves when the bin widths drift
+    def mean_code(self) -> np.ndarray:
+        hits = self.hits
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (self.counts * np.arange(self.counts.shape[2])).sum(axis=2) / hits
+
+    # Code below which the fraction q of the hits of each row and channel fall (-1 for rows without hits).
+    # q close to 1 gives the length of the delay line in codes, which follows the temperature
+    def code_quantile(self, q: float = 0.999) -> np.ndarray:
+        cumulative = np.cumsum(self.counts, axis=2)
+        total = cumulative[:, :, -1:]
+        found = (cumulative >= q * total) & (total > 0)
+        return np.where(found.any(axis=2), found.argmax(axis=2), -1)
+
+
+class DriftStore:
+    """Fine code counts per channel and time slice in a folder, with coarser levels of FACTOR rows each.
+
+    Without channels the existing store in path is opened. Otherwise a new one is created (an old store
+    in path is replaced): width is the slice width in the unit of the times given to add() ('ticks', 'ns'
+    or 'hits'), scale converts that unit to s (None for hits). source is kept in drift.json for the
+    code that fills the store.
+    """
+
+    def __init__(self, path: str, channels: list[str] | None = None, width: int | None = None, unit: str = 'ticks',
+                 scale: float | None = None, factor: int = FACTOR, n_codes: int = CODES, source: dict | None = None):
+        self.path = path
+        if channels is None:
+            with open(os.path.join(path, META_FILE)) as f:
+                meta = json.load(f)
+            if meta['version'] != DRIFT_VERSION:
+                raise ValueError(f'{path}: drift store version {meta["version"]}, expected {DRIFT_VERSION}')
+        else:
+            os.makedirs(path, exist_ok=True)
+            for name in os.listdir(path):
+                if name.startswith('level') or name == OPEN_FILE:
+                    os.remove(os.path.join(path, name))
+            meta = {'version': DRIFT_VERSION, 'channels': list(channels), 'n_codes': n_codes, 'width': int(width),
+                    'unit': unit, 'scale': scale, 'factor': factor, 'source': source or {}}
+        self.channels = meta['channels']
+        self.n_codes = meta['n_codes']
+        self.width = meta['width']
+        self.unit = meta['unit']
+        self.scale = meta['scale']
+        self.factor = meta['factor']
+        self.source = meta['source']
+        self.shape = (len(self.channels), self.n_codes)
+
+        # Drop a row that was only partly written when the process ended
+        level = 0
+        while os.path.exists(self._level_path(level)):
+            path = self._level_path(level)
+            size = os.path.getsize(path)
+            if size % self._row_bytes(level):
+                os.truncate(path, size - size % self._row_bytes(level))
+            level += 1
+        # Every finished slice has its row, so the open slice is the next one
+        self.current = self._rows(0)
+        open_path = os.path.join(self.path, OPEN_FILE)
+        if channels is None and os.path.exists(open_path):
+            self.open = np.load(open_path)
+        else:
+            self.open = np.zeros(self.shape, dtype=np.int64)
+        self._propagate()
+        if channels is not None:
+            self.flush()
+
+    def _level_path(self, level: int) -> str:
+        return os.path.join(self.path, f'level{level}.{"u4" if level == 0 else "u8"}')
+
+    @staticmethod
+    def _dtype(level: int) -> str:
+        return '<u4' if level == 0 else '<u8'
+
+    def _row_bytes(self, level: int) -> int:
+        return self.shape[0] * self.shape[1] * np.dtype(self._dtype(level)).itemsize
+
+    # Finished rows of a level
+    def _rows(self, level: int) -> int:
+        path = self._level_path(level)
+        return os.path.getsize(path) // self._row_bytes(level) if os.path.exists(path) else 0
+
+    # Rows a to b of a level as stored
+    def _read(self, level: int, a: int, b: int) -> np.ndarray:
+        if b <= a:
+            return np.zeros((0, *self.shape), dtype=np.int64)
+        rows = np.memmap(self._level_path(level), dtype=self._dtype(level), mode='r',
+                         shape=(self._rows(level), *self.shape))
+        return rows[a:b].astype(np.int64)
+
+    def _append(self, level: int, rows: np.ndarray) -> None:
+        with open(self._level_path(level), 'ab') as f:
+            f.write(rows.astype(self._dtype(level)).tobytes())
+
+    # Add up the finished groups of FACTOR rows of each level into the next level
+    def _propagate(self) -> None:
+        level = 0
+        while (n := self._rows(level)) >= self.factor:
+            done = self._rows(level + 1)
+            groups = n // self.factor
+            if groups > done:
+                rows = self._read(level, done * self.factor, groups * self.factor)
+                self._append(level + 1, rows.reshape(groups - done, self.factor, *self.shape).sum(axis=1))
+            level += 1
+
+    # Finish the open slice and the empty slices up to index, which becomes the open slice
+    def _advance(self, index: int) -> None:
+        if index <= self.current:
+            return
+        self._append(0, self.open[None])
+        for lo in range(self.current + 1, index, ZERO_BLOCK):
+            self._append(0, np.zeros((min(ZERO_BLOCK, index - lo), *self.shape), dtype=np.uint32))
+        self.current = index
+        self.open = np.zeros(self.shape, dtype=np.int64)
+        self._propagate()
+
+    # Count hits: channel indices (or one index), fine codes and times (or one time for all) in the unit of the
+    # store. The times only have to grow from call to call, hits before the open slice are counted in it.
+    def add(self, ids, fine: np.ndarray, t) -> None:
+        fine = np.asarray(fine).astype(np.int64)
+        ids = np.broadcast_to(np.asarray(ids, dtype=np.int64), fine.shape)
+        t = np.broadcast_to(np.asarray(t, dtype=np.int64), fine.shape)
+        valid = (fine < self.n_codes) & (ids < len(self.channels))
+        fine, ids, t = fine[valid], ids[valid], t[valid]
+        if len(fine) == 0:
+            return
+        index = np.maximum(t // self.width, self.current)
+        if index[0] == index[-1] == index.max():
+            self._advance(int(index[0]))
+            self.open += np.bincount(ids * self.n_codes + fine, minlength=self.open.size).reshape(self.shape)
+            return
+        slices, inverse = np.unique(index, return_inverse=True)
+        cells = self.open.size
+        counts = np.bincount(inverse * cells + ids * self.n_codes + fine, minlength=len(slices) * cells)
+        for k, slice_index in enumerate(slices.tolist()):
+            self._advance(slice_index)
+            self.open += counts[k * cells:(k + 1) * cells].reshape(self.shape)
+
+    # Save the open slice and drift.json, the finished rows are already in their files
+    def flush(self) -> None:
+        tmp = os.path.join(self.path, 'open.tmp.npy')
+        np.save(tmp, self.open)
+        os.replace(tmp, os.path.join(self.path, OPEN_FILE))
+        write_snapshot({'version': DRIFT_VERSION, 'channels': self.channels, 'n_codes': self.n_codes,
+                        'width': self.width, 'unit': self.unit, 'scale': self.scale, 'factor': self.factor,
+                        'source': self.source}, os.path.join(self.path, META_FILE))
+
+    # Slices with hits so far, including the open one
+    @property
+    def n_slices(self) -> int:
+        return self.current + (1 if self.open.any() else 0)
+
+    # Slice width in s, or in hits for stores without time
+    @property
+    def slice_width(self) -> float:
+        return round(self.width * self.scale, 9) if self.scale else self.width
+
+    # Rows a to b of a level. Rows the level does not have yet are added up from the level below
+    def rows(self, level: int, a: int, b: int) -> np.ndarray:
+        n = self._rows(level)
+        parts = [self._read(level, a, min(b, n))]
+        for row in range(max(a, n), b):
+            if level > 0:
+                parts.append(self.rows(level - 1, row * self.factor, (row + 1) * self.factor).sum(axis=0)[None])
+            elif row == self.current:
+                parts.append(self.open[None])
+            else:
+                parts.append(np.zeros((1, *self.shape), dtype=np.int64))
+        return np.concatenate(parts)
+
+    # Counts from start to stop (s, or hits without time; default: the whole run) in at most max_rows rows.
+    # The rows are aligned to the slices of the level, so they can reach a little beyond start and stop.
+    def view(self, start: float | None = None, stop: float | None = None, max_rows: int = 500) -> DriftView:
+        width = self.slice_width
+        lo = 0 if start is None else max(0, int(start // width))
+        hi = self.n_slices if stop is None else min(self.n_slices, int(np.ceil(stop / width)))
+        hi = max(hi, lo)
+        level = 0
+        while -(-(hi - lo) // self.factor ** level) > max_rows:
+            level += 1
+        step = self.factor ** level
+        a, b = lo // step, -(-hi // step)
+        edges = np.arange(a, b + 1) * step * width
+        return DriftView(self.channels, level, edges, self.rows(level, a, b), 's' if self.scale else 'hits')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+class DriftRecorder:
+    """Fill the drift store of a run while it is recorded.
+
+    The time of the hits is the unwrapped coarse counter if the design has one, else the host time at
+    which their batch arrived. The open slice is saved every flush_secs.
+    """
+
+    def __init__(self, run_dir: str, channels: list[str], clock_hz: float = 12e6, has_coarse: bool = True,
+                 width_s: float = 60., factor: int = FACTOR, flush_secs: float = 10.):
+        if has_coarse:
+            unit, scale, width = 'ticks', 1 / clock_hz, round(width_s * clock_hz)
+        else:
+            unit, scale, width = 'ns', 1e-9, round(width_s * 1e9)
+        self.store = DriftStore(drift_dir(run_dir), channels, width, unit, scale, factor, source={'live': True})
+        self.unwrapper = Unwrapper() if has_coarse else None
+        self.start_ns = time.monotonic_ns()
+        self.flush_secs = flush_secs
+        self.last_flush = time.monotonic()
+
+    def add(self, ids, fine: np.ndarray, coarse: np.ndarray | None = None) -> None:
+        if self.unwrapper is not None:
+            t = self.unwrapper.feed(coarse)
+        else:
+            t = time.monotonic_ns() - self.start_ns
+        self.store.add(ids, fine, t)
+        if time.monotonic() - self.last_flush >= self.flush_secs:
+            self.store.flush()
+            self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        self.store.flush()
+
+
+def drift_dir(run_dir: str) -> str:
+    return os.path.join(run_dir, DRIFT_DIR)
+
+
+def open_drift(run_dir: str) -> DriftStore:
+    return DriftStore(drift_dir(run_dir))
+
+
+# Fill the drift store of a run in one pass over its hits. A store that was recorded during the acquisition or
+# that is up to date is returned as it is, one built from a shorter state of hits.tdc is continued with the
+# appended records. width_s is the slice width for runs with time, width_hits for runs without.
+def build_drift(run_dir: str, width_s: float = 60., width_hits: int = WIDTH_HITS, factor: int = FACTOR,
+                chunk: int = RECORD_BLOCK, rebuild: bool = False) -> DriftStore:
+    from .catalog import appended, tail_crc
+    from .multi import ARRIVALS_FILE, host_times
+
+    run = Run(run_dir)
+    files = {name: os.path.getsize(os.path.join(run_dir, name)) for name in sorted(os.listdir(run_dir))
+             if name.endswith('.txt')} if not run.binary else None
+    store = None
+    if not rebuild and os.path.exists(os.path.join(drift_dir(run_dir), META_FILE)):
+        store = DriftStore(drift_dir(run_dir))
+        source = store.source
+        up_to_date = source.get('records') == len(run.records) and source.get('tail_crc') == tail_crc(run) \
+            if run.binary else source.get('files') == files
+        if source.get('live') or up_to_date:
+            return store
+        if not (run.binary and source.get('records') is not None and appended(run, source)):
+            store = None
+
+    if store is None:
+        if run.has_coarse:
+            unit, scale, width = 'ticks', 1 / run.clock_hz, round(width_s * run.clock_hz)
+        elif run.binary and os.path.exists(os.path.join(run_dir, ARRIVALS_FILE)):
+            unit, scale, width = 'ns', 1e-9, round(width_s * 1e9)
+        else:
+            unit, scale, width = 'hits', None, width_hits
+        store = DriftStore(drift_dir(run_dir), run.channels, width, unit, scale, factor,
+                           source={'records': 0, 'tail_crc': 0, 'unwrapper': None, 't0': None})
+    source = store.source
+
+    if run.binary:
+        unwrapper = Unwrapper().restore(source['unwrapper']) if source['unwrapper'] else Unwrapper()
+        for lo in range(source['records'], len(run.records), chunk):
+            records = run.records[lo:lo + chunk]
+            valid = (records['flags'] & FLAG_NO_FINE) == 0
+            if store.unit == 'ticks':
+                valid &= (records['flags'] & FLAG_NO_COARSE) == 0
+            index = np.flatnonzero(valid) + lo
+            records = records[valid]
+            if store.unit == 'ticks':
+                t = unwrapper.feed(records['coarse'])
+            elif store.unit == 'ns':
+                if source['t0'] is None:
+                    source['t0'] = int(host_times(run_dir, np.zeros(1))[0])
+                t = host_times(run_dir, index) - source['t0']
+            else:
+                t = index
+            store.add(records['channel'], records['fine'], t)
+        source.update(records=len(run.records), tail_crc=tail_crc(run),
+                      unwrapper=unwrapper.state() if unwrapper.n else None)
+    else:
+        # The channels of the text files are read side by side, so the hit numbers of a chunk are about the same
+        unwrapper = Unwrapper()
+        seen = dict.fromkeys(run.channels, 0)
+        for part in run.iter_chunks(chunk=chunk):
+            ids, fine, t = [], [], []
+            for channel, h in part.items():
+                ids.append(np.full(len(h.fine), run.channels.index(channel)))
+                fine.append(h.fine)
+                if store.unit == 'ticks':
+                    t.append(unwrapper.feed(h.coarse))
+                else:
+                    t.append(np.arange(seen[channel], seen[channel] + len(h.fine)))
+                seen[channel] += len(h.fine)
+            store.add(np.concatenate(ids), np.concatenate(fine), np.concatenate(t))
+        source['files'] = files
+    store.flush()
+    return store
+
+
+def format_view(view: DriftView, max_lines: int = 50) -> str:
+    step = max(1, -(-len(view.counts) // max_lines))
+    mean = view.mean_code()
+    last = view.code_quantile()
+    lines = [f'{len(view.counts)} rows of level {view.level}, ' + (f'{view.edges[1] - view.edges[0]:g} {view.unit} each'
+                                                                   if len(view.counts) else 'no hits'),
+             f'{"start":>12} ' + ' '.join(f'{"ch " + c + " hits":>14} {"mean":>7} {"99.9%":>5}' for c in view.channels)]
+    for i in range(0, len(view.counts), step):
+        lines.append(f'{view.edges[i]:12g} ' + ' '.join(f'{view.hits[i, k]:14d} {mean[i, k]:7.2f} {last[i, k]:5d}'
+                                                          for k in range(len(view.channels))))
+    return '\n'.join(lines)
+
+
+# Per channel: the fine code histograms of all rows (normalized per row) over time and the mean code
+def plot_view(view: DriftView, save_path: str | None = None, show: bool = True):
+    import matplotlib.pyplot as plt
+
+    n_codes = max(int(view.code_quantile(1.).max()) + 1, 1)
+    fig, axes = plt.subplots(2, len(view.channels), squeeze=False, sharex=True,
+                             figsize=(6 * len(view.channels), 7), gridspec_kw={'height_ratios': [3, 1]})
+    mean = view.mean_code()
+    centers = (view.edges[:-1] + view.edges[1:]) / 2
+    for k, channel in enumerate(view.channels):
+        hits = view.hits[:, k:k + 1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            share = np.where(hits > 0, view.counts[:, k, :n_codes] / hits, np.nan)
+        ax = axes[0, k]
+        ax.imshow(share.T, origin='lower', aspect='auto', interpolation='nearest',
+                  extent=(view.edges[0], view.edges[-1], 0, n_codes))
+        ax.set_title(f'Channel {channel}')
+        ax.set_ylabel('Fine code')
+        axes[1, k].plot(centers, mean[:, k], '.-')
+        axes[1, k].set_xlabel('Time [s]' if view.unit == 's' else 'Hit number')
+        axes[1, k].set_ylabel('Mean code')
+    fig.tight_layout()
+    if save_path:
+        fig.savefig(save_path, dpi=300)
+    if show:
+        plt.show()
+    return fig
+
+
+def main(argv: list[str] | None = None, prog: str | None = None):
+    from .catalog import resolve_run
+
+    parser = argparse.ArgumentParser(prog=prog, description='Fine code histograms of a run in time slices')
+    parser.add_argument('command', choices=['build', 'show'])
+    parser.add_argument('run', nargs='?', default='latest',
+                        help="run folder, run name in --data-dir, part of it or 'latest'")
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('--width', type=float, default=60., help='slice width in s (build)')
+    parser.add_argument('--width-hits', type=int, default=WIDTH_HITS, help='slice width of runs without time (build)')
+    parser.add_argument('--rebuild', action='store_true', help='build the store again from all hits (build)')
+    parser.add_argument('--start', type=float, default=None, help='in s, or in hits for runs without time')
+    parser.add_argument('--stop', type=float, default=None)
+    parser.add_argument('--rows', type=int, default=500, help='most rows to read (show)')
+    parser.add_argument('--plot', action='store_true', help='plot the histograms over time (show)')
+    parser.add_argument('--save', default=None, help='save the plot to this file (show)')
+    args = parser.parse_args(argv)
+
+    run_dir = resolve_run(args.run, args.data_dir)
+    if args.command == 'build':
+        start = time.perf_counter()
+        store = build_drift(run_dir, args.width, args.width_hits, rebuild=args.rebuild)
+        print(f'{run_dir}: {store.n_slices} slices of {store.slice_width:g} {"s" if store.scale else "hits"}'
+              f' in {store.path} ({time.perf_counter() - start:.1f} s)')
+        return
+    view = open_drift(run_dir).view(args.start, args.stop, args.rows)
+    print(format_view(view))
+    if args.plot or args.save:
+        plot_view(view, args.save, show=args.plot)
+
+
+if __name__ == '__main__':
+    main()
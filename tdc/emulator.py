@@ -0,0 +1,323 @@
+# Emulator of the FPGA byte streams, to test the readout without a board.
+#
+# Hits are generated at a given rate (Poisson, optionally in bursts), with fine
+# codes drawn from a delay line with uneven bin widths and a small fraction of
+# overflow codes, and sent in the wire format of one of the designs:
+#   coarse     5 byte fine+coarse frames of OneChannel_FineAndCoarse (UART)
+#   channels   2 byte channel/fine frames of FourChannels_OnlyFine, four per hit (UART)
+#   ethernet   the 5 byte records of OneChannel_Ethernet in UDP datagrams
+#
+# The UART formats are written to a pseudo terminal or to a TCP socket. The readers
+# connect with --port <pty path> or --port socket://localhost:<port>. The bytes of the
+# hits pass a FIFO of fifo_bytes (16, as on the FPGA) that --baud drains at the rate of
+# a real UART; bytes that do not fit are lost and counted. --loss drops random single
+# bytes to test resynchronization.
+#
+#   python -m tdc.emulator --format coarse --rate 1e4 --transport pty
+#   python Max1000/OneChannel_FineAndCoarse/Analysis/read_with_coarse.py --port /dev/pts/5
+
+import argparse
+import os
+import socket
+import time
+
+import numpy as np
+
+from .calib import CHAIN_CODES
+from .coarse import COARSE_PERIOD
+from .decode import FRAME_BYTES, encode_channel_frames, encode_frames
+
+FORMATS = ['coarse', 'channels', 'ethernet']
+# Bytes of the transmit FIFO in uart.vhd, fifo.vhd with abits = 4 and dbits = 8. The buffer FIFO in top.vhd
+# (abits = 6) is emptied into it as fast as it fills, and it ignores writes while it is full, so these 16 bytes
+# are all the designs can hold back while the UART is busy
+FIFO_BYTES = 16
+
+
+class HitGenerator:
+    """Generate hit times and fine codes slice by slice of emulated time."""
+
+    def __init__(self, rate_hz: float, burst_size: int = 1, burst_spacing: float = 1e-6, clock_hz: float = 12e6,
+                 overflow: float = 1e-3, dnl: float = 0.3, n_codes: int = CHAIN_CODES, seed: int | None = None):
+        self.rate_hz = rate_hz
+        self.burst_size = burst_size
+        self.burst_spacing = burst_spacing
+        self.clock_hz = clock_hz
+        self.overflow = overflow
+        self.n_codes = n_codes
+        self.rng = np.random.default_rng(seed)
+        # Uneven bin widths of the emulated delay line
+        widths = np.clip(1 + dnl * self.rng.standard_normal(n_codes), 0.05, None)
+        self.cdf = np.cumsum(widths) / widths.sum()
+
+    # Times in s and fine codes of the hits in [t0, t1)
+    def hits(self, t0: float, t1: float) -> tuple[np.ndarray, np.ndarray]:
+        n_bursts = self.rng.poisson((t1 - t0) * self.rate_hz / self.burst_size)
+        times = np.sort(self.rng.uniform(t0, t1, n_bursts))
+        if self.burst_size > 1:
+            times = (times[:, None] + np.arange(self.burst_size) * self.burst_spacing).ravel()
+        return times, self.fine(len(times))
+
+    def fine(self, n: int) -> np.ndarray:
+        fine = np.searchsorted(self.cdf, self.rng.random(n), side='right').astype(np.uint16)
+        fine = np.minimum(fine, self.n_codes - 1)
+        fine[self.rng.random(n) < self.overflow] = self.n_codes
+        return fine
+
+    def coarse(self, times: np.ndarray) -> np.ndarray:
+        return (np.floor(times * self.clock_hz).astype(np.int64) % COARSE_PERIOD).astype(np.uint32)
+
+
+class PtyTransport:
+    """Pseudo terminal: the reader opens self.port like a serial port."""
+
+    def __init__(self):
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+
+    # Write as much as the reader takes without blocking. Returns the bytes written
+    def write(self, data: bytes) -> int:
+        try:
+            return os.write(self.master, data)
+        except BlockingIOError:
+            return 0
+
+    def close(self) -> None:
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class TcpTransport:
+    """TCP server for one reader, which connects with --port socket://host:port."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 7000):
+        self.server = socket.create_server((host, port))
+        self.port = f'socket://{host}:{self.server.getsockname()[1]}'
+        # The emulated time starts once the reader is connected
+        print(f'waiting for the reader on {self.port}')
+        self.conn, _ = self.server.accept()
+        self.conn.setblocking(False)
+
+    def write(self, data: bytes) -> int:
+        try:
+            return self.conn.send(data)
+        except BlockingIOError:
+            return 0
+
+    def close(self) -> None:
+        self.conn.close()
+        self.server.close()
+
+
+class UdpTransport:
+    """Send whole records in datagrams, as the Ethernet design does. UDP does not wait for the reader.
+
+    On Ethernet, whole datagrams are lost instead of single bytes: loss is the probability to drop a datagram.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 5000, frames_per_datagram: int = 256, seq_bytes: int = 0,
+                 loss: float = 0., seed: int | None = None):
+        self.rng = np.random.default_rng(seed)
+        self.loss = loss
+        self.datagrams_lost = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.address = (host, port)
+        self.port = f'{host}:{port}'
+        self.size = frames_per_datagram * FRAME_BYTES
+        self.seq_bytes = seq_bytes
+        self.seq = 0
+
+    def write(self, data: bytes) -> int:
+        for lo in range(0, len(data), self.size):
+            header = (self.seq % (1 << 8 * self.seq_bytes)).to_bytes(self.seq_bytes, 'little') if self.seq_bytes else b''
+            self.seq += 1
+            if self.loss and self.rng.random() < self.loss:
+                self.datagrams_lost += 1
+                continue
+            self.sock.sendto(header + data[lo:lo + self.size], self.address)
+        return len(data)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class Emulator:
+    """Send the hits of a HitGenerator in real time in the given format."""
+
+    def __init__(self, generator: HitGenerator, transport, fmt: str = 'coarse', loss: float = 0.,
+                 fifo_bytes: int = FIFO_BYTES, baud: float | None = None, slice_secs: float = 0.01):
+        if fmt not in FORMATS:
+            raise ValueError(f'unknown format {fmt!r}, use one of {FORMATS}')
+        self.generator = generator
+        self.transport = transport
+        self.fmt = fmt
+        self.loss = loss
+        self.fifo_bytes = fifo_bytes
+        self.baud = baud
+        self.slice_secs = slice_secs
+
+        self.fifo = b''
+        # Bytes the link may still send in this slice (fractions carry over to the next slice)
+        self.credit = 0.
+        self.hits = 0
+        self.hits_dropped = 0
+        self.bytes_dropped = 0
+        self.bytes_sent = 0
+        self.bytes_lost = 0
+
+    def encode(self, times: np.ndarray, fine: np.ndarray) -> tuple[bytes, int]:
+        if self.fmt == 'channels':
+            # One input feeds all four delay lines: four frames per hit, channels in round robin
+            n = len(times)
+            fine = np.stack([fine, self.generator.fine(n), self.generator.fine(n), self.generator.fine(n)], axis=1)
+            return encode_channel_frames(np.tile(np.arange(4), n), fine.ravel()), 8
+        return encode_frames(fine, self.generator.coarse(times)), FRAME_BYTES
+
+    # Drop random bytes
+    def inject_loss(self, data: bytes) -> bytes:
+        if not self.loss or not data:
+            return data
+        raw = np.frombuffer(data, dtype=np.uint8)
+        keep = self.generator.rng.random(len(raw)) >= self.loss
+        self.bytes_lost += int((~keep).sum())
+        return raw[keep].tobytes()
+
+    # Bytes of the hits that fit into the FIFO. With --baud the FIFO drains at baud / 10 bytes/s between the hits
+    # and a hit loses the bytes that find it full, as fifo.vhd ignores writes while full. Without --baud the link
+    # is infinitely fast and nothing is lost here
+    def fill_fifo(self, times: np.ndarray, data: bytes, hit_bytes: int, t0: float) -> bytes:
+        if self.baud is None or len(times) == 0:
+            return data
+        rate = self.baud / 10
+        t = np.maximum.accumulate(times - t0)
+        # Fill level after each hit if nothing is lost: level_i = max(level_0 + S_i - rate t_i,
+        # max_j (S_i - S_j-1 - rate (t_i - t_j))) with S_i the bytes of hits 1 ... i
+        added = hit_bytes * np.arange(1, len(t) + 1)
+        low = np.minimum(-len(self.fifo), np.minimum.accumulate(added - hit_bytes - rate * t))
+        if (added - rate * t - low).max() <= self.fifo_bytes:
+            return data
+
+        raw = np.frombuffer(data, dtype=np.uint8)
+        keep = np.zeros(len(raw), dtype=bool)
+        level, last = float(len(self.fifo)), 0.
+        for i, ti in enumerate(t.tolist()):
+            level = max(0., level - rate * (ti - last))
+            last = ti
+            n = max(0, min(hit_bytes, int(self.fifo_bytes - level)))
+            keep[i * hit_bytes:i * hit_bytes + n] = True
+            level += n
+            if n < hit_bytes:
+                self.hits_dropped += 1
+                self.bytes_dropped += hit_bytes - n
+        return raw[keep].tobytes()
+
+    # Emulate the hits of one time slice and send what the link and the reader take
+    def step(self, t0: float, t1: float) -> None:
+        times, fine = self.generator.hits(t0, t1)
+        data, hit_bytes = self.encode(times, fine)
+        self.hits += len(times)
+
+        if self.fmt == 'ethernet':
+            self.bytes_sent += self.transport.write(data)
+            return
+
+        # Bytes lost on the link are removed when they enter the FIFO, for the reader it is the same
+        self.fifo += self.inject_loss(self.fill_fifo(times, data, hit_bytes, t0))
+
+        if self.baud is None:
+            limit = len(self.fifo)
+        else:
+            self.credit += self.baud / 10 * (t1 - t0)
+            limit = int(self.credit)
+        sent = self.transport.write(self.fifo[:limit]) if self.fifo else 0
+        # The link was idle or the reader did not take everything: nothing to carry over
+        self.credit = self.credit - sent if sent == limit else 0.
+        self.fifo = self.fifo[sent:]
+        self.bytes_sent += sent
+        # Bytes the reader did not take wait in the FIFO, what does not fit is lost
+        if len(self.fifo) > self.fifo_bytes:
+            self.bytes_dropped += len(self.fifo) - self.fifo_bytes
+            self.fifo = self.fifo[:self.fifo_bytes]
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'hits_dropped': self.hits_dropped,
+            'bytes_dropped': self.bytes_dropped,
+            'bytes_sent': self.bytes_sent,
+            'bytes_lost': self.bytes_lost,
+            'datagrams_lost': getattr(self.transport, 'datagrams_lost', 0),
+            'fifo_bytes': len(self.fifo),
+        }
+
+    # Run for duration seconds (None: until interrupted), printing the statistics every report_secs
+    def run(self, duration: float | None = None, report_secs: float = 5.) -> dict:
+        start = time.perf_counter()
+        t = 0.
+        next_report = report_secs
+        try:
+            while duration is None or t < duration:
+                self.step(t, t + self.slice_secs)
+                t += self.slice_secs
+                ahead = t - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+                if t >= next_report:
+                    print(format_stats(self.stats(), t))
+                    next_report += report_secs
+        except KeyboardInterrupt:
+            pass
+        print(format_stats(self.stats(), t))
+        return self.stats()
+
+
+def format_stats(stats: dict, t: float) -> str:
+    return (f"{t:8.1f} s | {stats['hits']} hits, {stats['hits_dropped']} dropped in FIFO"
+            f" ({stats['bytes_dropped']} B)"
+            f" | sent {stats['bytes_sent']} B, lost {stats['bytes_lost']} B, {stats['datagrams_lost']} datagrams"
+            f" | FIFO {stats['fifo_bytes']} B")
+
+
+def main(argv: list[str] | None = None, prog: str | None = None):
+    parser = argparse.ArgumentParser(prog=prog, description='Emulate the byte stream of the TDC designs')
+    parser.add_argument('--format', choices=FORMATS, default='coarse')
+    parser.add_argument('--transport', choices=['pty', 'tcp', 'udp'], default=None,
+                        help='default: pty for coarse and channels, udp for ethernet')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None, help='TCP or UDP port (default 7000 / 5000)')
+    parser.add_argument('--rate', type=float, default=1e3, help='input signals per second')
+    parser.add_argument('--burst', type=int, default=1, help='signals per burst')
+    parser.add_argument('--burst-spacing', type=float, default=1e-6, help='time between the signals of a burst in s')
+    parser.add_argument('--loss', type=float, default=0., help='probability to lose each byte (each datagram for udp)')
+    parser.add_argument('--baud', type=float, default=None, help='limit the link like a UART, e.g. 115200')
+    parser.add_argument('--fifo', type=int, default=FIFO_BYTES,
+                        help=f'FIFO size in bytes (default {FIFO_BYTES} as on the FPGA, larger is not physical:'
+                             ' only to test a reader without the losses of the real FIFO)')
+    parser.add_argument('--seq-bytes', type=int, default=0, help='sequence number in front of each datagram (ethernet)')
+    parser.add_argument('--duration', type=float, default=None, help='seconds to run (default: until Ctrl+C)')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    transport_name = args.transport or ('udp' if args.format == 'ethernet' else 'pty')
+    if transport_name == 'pty':
+        transport = PtyTransport()
+    elif transport_name == 'tcp':
+        transport = TcpTransport(args.host, 7000 if args.port is None else args.port)
+    else:
+        transport = UdpTransport(args.host, 5000 if args.port is None else args.port, seq_bytes=args.seq_bytes,
+                                 loss=args.loss, seed=args.seed)
+    print(f'{args.format} stream at {args.rate:g} Hz on {transport.port}')
+
+    generator = HitGenerator(args.rate, args.burst, args.burst_spacing, seed=args.seed)
+    emulator = Emulator(generator, transport, args.format, 0. if transport_name == 'udp' else args.loss, args.fifo, args.baud)
+    try:
+        emulator.run(args.duration)
+    finally:
+        transport.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# Live histograms of a run that is still being recorded.
+#
+# Instead of re-reading a file from the start on every animation frame, a tail
+# reader remembers the byte offset it has reached in each file and only parses
+# the new complete lines (text) or records (hits.tdc). The new fine codes are
+# added to fixed-size np.bincount accumulators, and the plot only updates the
+# heights of the existing steps. Memory and cost per frame do not grow with the
+# length of the run. monitor.py reads, draws and saves snapshots at separate rates.
+
+import os
+
+import numpy as np
+
+from .storage import FILE_NAME, FLAG_NO_FINE, LAYOUT_FINE_COARSE, RECORD_DTYPE, legacy_layout, read_header
+
+# Upper limit of bytes read from one file per poll, keeps the cost per frame bounded while catching up
+MAX_READ = 1 << 24
+
+
+class TextTail:
+    """Follow a newline separated text file, returning only new complete lines."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+
+    def poll(self, max_read: int = MAX_READ) -> np.ndarray:
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read(max_read)
+        except FileNotFoundError:
+            return np.empty(0, dtype=np.int64)
+        cut = data.rfind(b'\n') + 1
+        self.offset += cut
+        return np.fromstring(data[:cut], dtype=np.int64, sep=' ')
+
+
+class BinaryTail:
+    """Follow a growing hits.tdc file, returning only new complete records."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.header = None
+        self.offset = 0
+
+    def poll(self, max_read: int = MAX_READ) -> np.ndarray:
+        if self.header is None:
+            try:
+                self.header = read_header(self.path)
+            except (FileNotFoundError, ValueError):
+                return np.empty(0, dtype=RECORD_DTYPE)
+            self.offset = self.header['header_size']
+
+        max_read -= max_read % RECORD_DTYPE.itemsize
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(max_read)
+        n = len(data) // RECORD_DTYPE.itemsize
+        self.offset += n * RECORD_DTYPE.itemsize
+        return np.frombuffer(data, dtype=RECORD_DTYPE, count=n)
+
+
+class RunTail:
+    """Follow the fine codes of the selected channels of a run directory, binary or text."""
+
+    def __init__(self, run_dir: str, channels: list[str]):
+        self.run_dir = run_dir
+        self.channels = list(channels)
+        self.binary = None
+        self.tails = None
+
+    # Decide between binary and text once the acquisition created its files
+    def _open(self) -> bool:
+        path = os.path.join(self.run_dir, FILE_NAME)
+        if os.path.exists(path):
+            self.binary = BinaryTail(path)
+            self.tails = {}
+            return True
+        try:
+            layout, _ = legacy_layout(self.run_dir)
+        except FileNotFoundError:
+            return False
+        self.binary = None
+        if layout == LAYOUT_FINE_COARSE:
+            self.tails = {channel: TextTail(os.path.join(self.run_dir, 'fine.txt')) for channel in self.channels}
+        else:
+            self.tails = {channel: TextTail(os.path.join(self.run_dir, f'{channel}.txt')) for channel in self.channels}
+        return True
+
+    # New fine codes per channel since the last call
+    def poll(self) -> dict[str, np.ndarray]:
+        if self.tails is None and not self._open():
+            return {channel: np.empty(0, dtype=np.int64) for channel in self.channels}
+
+        if self.binary is None:
+            return {channel: tail.poll() for channel, tail in self.tails.items()}
+
+        records = self.binary.poll()
+        out = {}
+        if self.binary.header is not None:
+            records = records[(records['flags'] & FLAG_NO_FINE) == 0]
+            names = self.binary.header['channels']
+            for channel in self.channels:
+                out[channel] = records['fine'][records['channel'] == names.index(channel)]
+        return {channel: out.get(channel, np.empty(0, dtype=np.int64)) for channel in self.channels}
+
+
+class LiveHistogram:
+    """Fixed-size fine code histograms per channel, filled incrementally."""
+
+    def __init__(self, channels: list[str], n_bins: int = 300):
+        self.channels = list(channels)
+        self.n_bins = n_bins
+        self.counts = {channel: np.zeros(n_bins, dtype=np.int64) for channel in self.channels}
+        self.entries = {channel: 0 for channel in self.channels}
+
+    # Add new fine codes. Codes outside the histogram range are ignored, like in ax.hist(range=(0, n_bins))
+    def update(self, new: dict[str, np.ndarray]) -> int:
+        added = 0
+        for channel, values in new.items():
+            values = values[values < self.n_bins]
+            if len(values) == 0:
+                continue
+            self.counts[channel] += np.bincount(values, minlength=self.n_bins)
+            self.entries[channel] += len(values)
+            added += len(values)
+        return added
+
+
+class LivePlot:
+    """Step plot of a LiveHistogram, one artist per channel. Updates only change the step heights.
+
+    headless: the figure is not managed by pyplot and only rendered to files.
+    """
+
+    def __init__(self, hist: LiveHistogram, nrows: int = 1, ncols: int = 1, titles: dict[str, str] | None = None,
+                 figsize=(12, 12), headless: bool = False):
+        if headless:
+            from matplotlib.figure import Figure
+            self.fig = Figure(figsize=figsize)
+        else:
+            import matplotlib.pyplot as plt
+            self.fig = plt.figure(figsize=figsize)
+
+        self.hist = hist
+        self.axes = {}
+        self.steps = {}
+        edges = np.arange(hist.n_bins + 1)
+        for i, channel in enumerate(hist.channels):
+            ax = self.fig.add_subplot(nrows, ncols, i + 1)
+            ax.set_xlabel('bins')
+            ax.set_ylabel('frequency')
+            if titles:
+                ax.set_title(titles[channel])
+            ax.set_xlim(-2, hist.n_bins)
+            ax.set_ylim(0, 1)
+            self.steps[channel] = ax.stairs(hist.counts[channel], edges, fill=True, edgecolor='black', linewidth=.1)
+            self.axes[channel] = ax
+        self.fig.tight_layout()
+
+    # Set the step heights to counts (default: the current counts of the histogram). The y axis is only
+    # rescaled when the highest bin leaves the axis or drops below a quarter of it, so most updates keep
+    # the axes unchanged.
+    # Returns True if an axis was rescaled, i.e. the whole figure has to be drawn again.
+    def redraw(self, counts: dict[str, np.ndarray] | None = None) -> bool:
+        counts = counts or self.hist.counts
+        rescaled = False
+        for channel, steps in self.steps.items():
+            steps.set_data(counts[channel])
+            top = max(1, int(counts[channel].max()))
+            ax = self.axes[channel]
+            if not ax.get_ylim()[1] / 4 <= top <= ax.get_ylim()[1]:
+                ax.set_ylim(0, top * 1.5)
+                rescaled = True
+        return rescaled
+
+    @property
+    def artists(self) -> list:
+        return list(self.steps.values())
+
+
+# Live histogram of ./data/<timestamp>. The files are read in a background thread as fast as the data comes,
+# the window is refreshed at most fps times per second and the histogram is saved to save_path every
+# snapshot_secs (if it changed). See monitor.py for the details and a headless mode.
+def live_histogram(timestamp: str, channels: list[str], nrows: int = 1, ncols: int = 1,
+                   titles: dict[str, str] | None = None, interval: float = 100, save_path: str | None = None,
+                   data_dir: str = './data', fps: float | None = None, snapshot_secs: float = 10.):
+    from .monitor import Monitor
+
+    monitor = Monitor(os.path.join(data_dir, timestamp), channels, nrows=nrows, ncols=ncols, titles=titles,
+                      snapshots=[save_path] if save_path else [], snapshot_secs=snapshot_secs)
+    monitor.show(fps or 1000 / interval)
+    return monitor.hist
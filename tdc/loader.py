@@ -0,0 +1,215 @@
+# Loading of recorded runs for the analysis scripts.
+#
+# A run directory either contains the binary hits.tdc (see storage.py) or the
+# legacy text files (fine.txt + coarse.txt, or 00.txt ... 11.txt). Binary runs are
+# memory mapped, text runs are parsed block by block with numpy's C parser instead
+# of building lists of strings and ints. Both give typed numpy arrays per channel:
+# fine codes as uint16 and coarse counters as uint32 (None if the design has none).
+#
+#   run = Run('./data/<timestamp>')
+#   hits = run.load(channels=['00', '01'], start=0, stop=10**6)
+#   fine, coarse = hits['00']
+
+import os
+from typing import Iterator, NamedTuple
+
+import numpy as np
+
+from .storage import (FILE_NAME, FLAG_NO_COARSE, FLAG_NO_FINE, LAYOUT_FINE_COARSE, RECORD_DTYPE,
+                      legacy_layout, read_events)
+
+# Bytes read at once when parsing text files
+TEXT_BLOCK = 1 << 24
+# Records processed at once when selecting channels in a binary file
+RECORD_BLOCK = 1 << 22
+
+
+class Hits(NamedTuple):
+    fine: np.ndarray
+    coarse: np.ndarray | None
+
+
+# Parse a newline separated column of integers block by block. Only lines start to stop are returned.
+# An incomplete last line (file is still being written) is ignored.
+def iter_text(path: str, start: int = 0, stop: int | None = None, block: int = TEXT_BLOCK) -> Iterator[np.ndarray]:
+    line = 0
+    rest = b''
+    with open(path, 'rb') as f:
+        while stop is None or line < stop:
+            data = f.read(block)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b'\n') + 1
+            data, rest = data[:cut], data[cut:]
+
+            # Skip whole blocks before start without parsing them
+            n_lines = data.count(b'\n')
+            if line + n_lines <= start:
+                line += n_lines
+                continue
+
+            values = np.fromstring(data, dtype=np.int64, sep=' ')
+            lo = max(0, start - line)
+            hi = len(values) if stop is None else min(len(values), stop - line)
+            line += len(values)
+            if hi > lo:
+                yield values[lo:hi]
+
+
+def read_text(path: str, start: int = 0, stop: int | None = None, dtype=np.int64) -> np.ndarray:
+    blocks = [b.astype(dtype) for b in iter_text(path, start, stop)]
+    return np.concatenate(blocks) if blocks else np.empty(0, dtype=dtype)
+
+
+class Run:
+    """A recorded run in ./data/<timestamp>, either binary or legacy text."""
+
+    def __init__(self, run_dir: str):
+        self.run_dir = run_dir
+        self.path = os.path.join(run_dir, FILE_NAME)
+        self.binary = os.path.exists(self.path)
+
+        if self.binary:
+            self.header, self.records = read_events(self.path)
+            self.channels = self.header['channels']
+            self.layout = self.header['layout']
+            self.clock_hz = self.header['clock_hz']
+        else:
+            self.header = None
+            self.layout, self.channels = legacy_layout(run_dir)
+            self.clock_hz = 12e6
+
+        # Coarse values exist for the one channel design only, and not in a text run without coarse.txt
+        self.has_coarse = self.layout == LAYOUT_FINE_COARSE and (self.binary or os.path.exists(self._coarse_path()))
+
+    def _select(self, channels: list[str] | None) -> list[str]:
+        if channels is None:
+            return list(self.channels)
+        unknown = set(channels) - set(self.channels)
+        if unknown:
+            raise KeyError(f'{self.run_dir}: unknown channels {sorted(unknown)}, available: {self.channels}')
+        return list(channels)
+
+    # Records without a fine value are never hits, records without a coarse value only if the design has one
+    def _invalid_flags(self) -> int:
+        return FLAG_NO_FINE | (FLAG_NO_COARSE if self.has_coarse else 0)
+
+    def _coarse_path(self) -> str:
+        return os.path.join(self.run_dir, 'coarse.txt')
+
+    # A fine_coarse run without coarse.txt is loaded with coarse None
+    def _text_paths(self, channel: str) -> tuple[str, str | None]:
+        if self.layout == LAYOUT_FINE_COARSE:
+            return os.path.join(self.run_dir, 'fine.txt'), self._coarse_path() if self.has_coarse else None
+        return os.path.join(self.run_dir, f'{channel}.txt'), None
+
+    # Load hits start to stop (counted per channel) of the selected channels
+    def load(self, channels: list[str] | None = None, start: int = 0, stop: int | None = None) -> dict[str, Hits]:
+        channels = self._select(channels)
+
+        if not self.binary:
+            hits = {}
+            for channel in channels:
+                fine_path, coarse_path = self._text_paths(channel)
+                fine = read_text(fine_path, start, stop, np.uint16)
+                coarse = read_text(coarse_path, start, stop, np.uint32) if coarse_path else None
+                if coarse is not None:
+                    n = min(len(fine), len(coarse))
+                    fine, coarse = fine[:n], coarse[:n]
+                hits[channel] = Hits(fine, coarse)
+            return hits
+
+        # Single channel file: the slice of the memory map is returned directly, nothing is copied unless
+        # records have to be dropped. start and stop count valid hits, as in iter_chunks
+        if len(self.channels) == 1:
+            records = self.records
+            invalid = self._invalid_flags()
+            if records.size and (records['flags'] & invalid).any():
+                records = records[(records['flags'] & invalid) == 0]
+            records = records[start:stop]
+            return {self.channels[0]: Hits(records['fine'], records['coarse'] if self.has_coarse else None)}
+
+        parts = {channel: [] for channel in channels}
+        for chunk in self.iter_chunks(channels, start=start, stop=stop):
+            for channel, h in chunk.items():
+                parts[channel].append(h)
+        return {channel: _concat(parts[channel], self.has_coarse) for channel in channels}
+
+    # Iterate over the run in chunks of about chunk hits, each a dict channel -> Hits.
+    # start and stop are counted per channel.
+    def iter_chunks(self, channels: list[str] | None = None, chunk: int = RECORD_BLOCK,
+                    start: int = 0, stop: int | None = None) -> Iterator[dict[str, Hits]]:
+        channels = self._select(channels)
+
+        if not self.binary:
+            # Text files are parsed independently per channel in blocks of chunk lines
+            iters = {}
+            for channel in channels:
+                fine_path, coarse_path = self._text_paths(channel)
+                iters[channel] = (_rechunk(iter_text(fine_path, start, stop), chunk),
+                                  _rechunk(iter_text(coarse_path, start, stop), chunk) if coarse_path else None)
+            while iters:
+                out = {}
+                for channel, (fine_it, coarse_it) in list(iters.items()):
+                    fine = next(fine_it, None)
+                    coarse = next(coarse_it, None) if coarse_it else None
+                    if fine is None or (coarse_it and coarse is None):
+                        del iters[channel]
+                        continue
+                    if coarse is not None:
+                        n = min(len(fine), len(coarse))
+                        fine, coarse = fine[:n], coarse[:n].astype(np.uint32)
+                    out[channel] = Hits(fine.astype(np.uint16), coarse)
+                if out:
+                    yield out
+            return
+
+        ids = [self.channels.index(c) for c in channels]
+        seen = {i: 0 for i in ids}
+        for lo in range(0, len(self.records), chunk):
+            records = self.records[lo:lo + chunk]
+            valid = (records['flags'] & self._invalid_flags()) == 0
+            out = {}
+            for channel, i in zip(channels, ids):
+                sel = records[valid & (records['channel'] == i)]
+                a = max(0, start - seen[i])
+                b = len(sel) if stop is None else max(0, min(len(sel), stop - seen[i]))
+                seen[i] += len(sel)
+                if b > a:
+                    sel = sel[a:b]
+                    out[channel] = Hits(np.array(sel['fine']), np.array(sel['coarse']) if self.has_coarse else None)
+            if out:
+                yield out
+            if stop is not None and all(n >= stop for n in seen.values()):
+                return
+
+
+def _concat(parts: list[Hits], has_coarse: bool) -> Hits:
+    if not parts:
+        return Hits(np.empty(0, dtype=RECORD_DTYPE['fine']), np.empty(0, dtype=RECORD_DTYPE['coarse']) if has_coarse else None)
+    fine = np.concatenate([p.fine for p in parts])
+    coarse = np.concatenate([p.coarse for p in parts]) if has_coarse else None
+    return Hits(fine, coarse)
+
+
+# Regroup the blocks of iter_text into arrays of n values
+def _rechunk(blocks: Iterator[np.ndarray], n: int) -> Iterator[np.ndarray]:
+    buf = []
+    size = 0
+    for block in blocks:
+        buf.append(block)
+        size += len(block)
+        while size >= n:
+            data = np.concatenate(buf)
+            yield data[:n]
+            buf = [data[n:]]
+            size = len(buf[0])
+    if size:
+        yield np.concatenate(buf)
+
+
+# Shortcut for the analysis scripts: load the run in ./data/<timestamp>
+def load_run(timestamp: str, channels: list[str] | None = None, start: int = 0, stop: int | None = None,
+             data_dir: str = './data') -> dict[str, Hits]:
+    return Run(os.path.join(data_dir, timestamp)).load(channels, start, stop)
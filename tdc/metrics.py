@@ -0,0 +1,198 @@
+# Health metrics of a running acquisition.
+#
+# HealthMonitor collects the counters that the readout parts keep anyway (decoder,
+# pipeline, writer, UDP receiver) plus the hits per channel, and turns them into
+# a snapshot with rates. A background thread publishes the snapshot every few
+# seconds as JSON or Prometheus text file and/or serves it over HTTP on localhost:
+#
+#   health = HealthMonitor(channels, decoder = decoder, writer = out, pipeline = pipeline)
+#   health.start(path = f'{directory}/health.json', port = 9100)
+#   ...
+#   health.count(ids)            # in the write function, per batch
+#   health.stop()
+#
+# The warnings in the snapshot tell when the serial buffer or the queues are close
+# to full, i.e. before data is lost on the FPGA side.
+
+import datetime
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# Size of the serial receive buffer of the OS (Linux tty)
+SERIAL_BUFFER = 4095
+# Fill fraction above which a warning is given
+WARN_FILL = 0.8
+
+
+class HealthMonitor:
+    """Live counters of an acquisition, published periodically."""
+
+    def __init__(self, channels: list[str], decoder=None, pipeline=None, writer=None, receiver=None,
+                 buffer_size: int = SERIAL_BUFFER, interval: float = 5.):
+        self.channels = list(channels)
+        self.decoder = decoder
+        self.pipeline = pipeline
+        self.writer = writer
+        self.receiver = receiver
+        self.buffer_size = buffer_size
+        self.interval = interval
+
+        self.hits = np.zeros(len(self.channels), dtype=np.int64)
+        self.start_time = time.monotonic()
+        self._last = (self.start_time, 0, self.hits.copy())
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+        self.latest = {}
+
+    # Count hits of a batch: channel indices (position in channels) or the index of a single channel and the number of hits
+    def count(self, ids, n: int | None = None) -> None:
+        with self._lock:
+            if n is not None:
+                self.hits[ids] += n
+            else:
+                self.hits += np.bincount(ids, minlength=len(self.channels))[:len(self.channels)]
+
+    def _bytes(self) -> int:
+        if self.receiver is not None:
+            return self.receiver.bytes
+        if self.pipeline is not None:
+            return self.pipeline.bytes_read
+        return getattr(self.decoder, 'bytes', 0)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            hits = self.hits.copy()
+        n_bytes = self._bytes()
+        last_time, last_bytes, last_hits = self._last
+        dt = max(now - last_time, 1e-9)
+        self._last = (now, n_bytes, hits)
+
+        snap = {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'uptime_s': round(now - self.start_time, 3),
+            'bytes_total': n_bytes,
+            'bytes_per_s': (n_bytes - last_bytes) / dt,
+            'hits_total': dict(zip(self.channels, hits.tolist())),
+            'hits_per_s': dict(zip(self.channels, ((hits - last_hits) / dt).tolist())),
+            'sync_errors': getattr(self.decoder, 'sync_errors', 0),
+            'bytes_discarded': getattr(self.decoder, 'bytes_discarded', 0),
+            'in_waiting_high_water': getattr(self.decoder, 'in_waiting_high_water', 0),
+            'buffer_size': self.buffer_size,
+        }
+        if self.pipeline is not None:
+            stats = self.pipeline.stats()
+            snap['in_waiting_high_water'] = max(snap['in_waiting_high_water'], stats['in_waiting_high_water'])
+            for key in ('chunk_queue_depth', 'chunk_queue_high_water', 'chunk_queue_size', 'chunks_dropped',
+                        'batch_queue_depth', 'batch_queue_high_water', 'batch_queue_size'):
+                snap[key] = stats[key]
+        if self.writer is not None:
+            snap['flush_latency_s'] = self.writer.flush_latency
+            snap['flush_latency_max_s'] = self.writer.flush_latency_max
+        if self.receiver is not None:
+            stats = self.receiver.stats()
+            snap['lost_datagrams'] = stats['lost_datagrams']
+            snap['bad_datagrams'] = stats['bad_datagrams']
+            snap['bytes_discarded'] += stats['bytes_discarded']
+
+        warnings = []
+        if self.receiver is None and snap['in_waiting_high_water'] >= WARN_FILL * self.buffer_size:
+            warnings.append(f"serial buffer reached {snap['in_waiting_high_water']} of {self.buffer_size} bytes")
+        for queue in ('chunk', 'batch'):
+            if queue + '_queue_size' in snap and snap[queue + '_queue_depth'] >= WARN_FILL * snap[queue + '_queue_size']:
+                warnings.append(f'{queue} queue is {snap[queue + "_queue_depth"]} of {snap[queue + "_queue_size"]} full')
+        if snap['bytes_discarded']:
+            warnings.append(f"{snap['bytes_discarded']} bytes discarded")
+        snap['warnings'] = warnings
+        self.latest = snap
+        return snap
+
+    # Publish every interval seconds to path (.json or .prom) and/or serve on http://127.0.0.1:port/metrics
+    def start(self, path: str | None = None, port: int | None = None) -> 'HealthMonitor':
+        if port is not None:
+            self._server = serve(self, port)
+        self._thread = threading.Thread(target=self._run, args=(path,), name='tdc-health', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self, path: str | None) -> None:
+        while not self._stop.wait(self.interval):
+            snap = self.snapshot()
+            if path:
+                write_snapshot(snap, path)
+            for warning in snap['warnings']:
+                print(f'Warning: {warning}')
+
+    def stop(self, path: str | None = None) -> dict:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._server is not None:
+            self._server.shutdown()
+        snap = self.snapshot()
+        if path:
+            write_snapshot(snap, path)
+        return snap
+
+
+# Prometheus text format. Per channel values get a channel label
+def to_prometheus(snap: dict) -> str:
+    lines = []
+    for key, value in snap.items():
+        if key in ('time', 'warnings'):
+            continue
+        name = 'tdc_' + key
+        kind = 'counter' if key.endswith('_total') or key in ('sync_errors', 'bytes_discarded', 'chunks_dropped',
+                                                              'lost_datagrams', 'bad_datagrams') else 'gauge'
+        lines.append(f'# TYPE {name} {kind}')
+        if isinstance(value, dict):
+            lines += [f'{name}{{channel="{channel}"}} {v}' for channel, v in value.items()]
+        else:
+            lines.append(f'{name} {value}')
+    lines.append(f'tdc_warnings {len(snap.get("warnings", []))}')
+    return '\n'.join(lines) + '\n'
+
+
+# Write the snapshot atomically, as Prometheus text for .prom files and as JSON otherwise
+def write_snapshot(snap: dict, path: str) -> None:
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        if path.endswith('.prom'):
+            f.write(to_prometheus(snap))
+        else:
+            json.dump(snap, f, indent=1)
+    os.replace(tmp, path)
+
+
+# Serve the latest snapshot on localhost: /metrics (Prometheus text) and /metrics.json
+def serve(monitor: HealthMonitor, port: int) -> 'http.server.ThreadingHTTPServer':
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            snap = monitor.latest or monitor.snapshot()
+            if self.path == '/metrics':
+                body, kind = to_prometheus(snap).encode(), 'text/plain; version=0.0.4'
+            elif self.path in ('/', '/metrics.json'):
+                body, kind = json.dumps(snap).encode(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', kind)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, name='tdc-health-http', daemon=True).start()
+    return server
@@ -0,0 +1,216 @@
+# Live monitor of a run with reading, drawing and saving decoupled.
+#
+# Reading, redrawing every bar and saving a 300 dpi PDF on every animation frame made
+# the rendering take most of the CPU of the acquisition host. Here the three run at
+# their own rates:
+#   - a background thread reads the new hits every poll_secs and adds them to the
+#     histograms (live.py), so the histograms follow the data rate,
+#   - a GUI timer refreshes the window at most fps times per second, and only if new
+#     hits came. The steps are blitted onto the saved background of the figure, the
+#     whole figure is only drawn again when an axis has to be rescaled,
+#   - the reading thread writes the snapshots every snapshot_secs with its own figure
+#     that is never shown: .png/.pdf/.svg of the histograms or .npz with the counts.
+#     Each snapshot replaces the previous file, which can be watched remotely.
+# Headless, only the snapshots are written and matplotlib is not needed for .npz.
+#
+#   monitor = Monitor('./data/<timestamp>', ['00', '01'], snapshots=['histogram.png'], snapshot_secs=30)
+#   monitor.show(fps=5)             # window
+#   monitor.run(duration=3600)      # headless
+#
+#   python -m tdc.monitor latest --fps 5
+#   python -m tdc.monitor latest --headless --snapshot histogram.png --snapshot histogram.npz --every 30
+
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+
+from .live import LiveHistogram, LivePlot, RunTail
+
+
+class Monitor:
+    """Histograms of a growing run, filled by a reader thread and drawn or saved at capped rates.
+
+    snapshots: files to write every snapshot_secs, the format is given by the extension. Names
+    without a folder are put into the run folder.
+    """
+
+    def __init__(self, run_dir: str, channels: list[str], n_bins: int = 300, poll_secs: float = 0.05,
+                 snapshots: list[str] = (), snapshot_secs: float = 10., nrows: int = 1, ncols: int = 1,
+                 titles: dict[str, str] | None = None, figsize=(12, 12), dpi: int = 100):
+        self.run_dir = run_dir
+        self.channels = list(channels)
+        self.tail = RunTail(run_dir, channels)
+        self.hist = LiveHistogram(channels, n_bins)
+        self.poll_secs = poll_secs
+        self.snapshots = [path if os.path.dirname(path) else os.path.join(run_dir, path) for path in snapshots]
+        self.snapshot_secs = snapshot_secs
+        self.layout = dict(nrows=nrows, ncols=ncols, titles=titles, figsize=figsize)
+        self.dpi = dpi
+
+        self.lock = threading.Lock()
+        # Incremented whenever hits were added, to skip redraws and snapshots without new data
+        self.version = 0
+        self.saved_version = 0
+        self.frames = 0
+        self.snapshots_written = 0
+        self._figure = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    # Read the new hits once. Returns the number of hits added
+    def ingest(self) -> int:
+        new = self.tail.poll()
+        with self.lock:
+            added = self.hist.update(new)
+            if added:
+                self.version += 1
+        return added
+
+    # Copy of the current counts with their version
+    def counts(self) -> tuple[int, dict[str, np.ndarray]]:
+        with self.lock:
+            return self.version, {channel: counts.copy() for channel, counts in self.hist.counts.items()}
+
+    # Write all snapshot files if there are new hits since the last ones. Returns the written paths
+    def save_snapshots(self) -> list[str]:
+        version, counts = self.counts()
+        if version == self.saved_version:
+            return []
+        for path in self.snapshots:
+            base, ext = os.path.splitext(path)
+            tmp = f'{base}.tmp{ext}'
+            if ext == '.npz':
+                np.savez(tmp, channels=self.channels, counts=np.array([counts[c] for c in self.channels]),
+                         entries=[self.hist.entries[c] for c in self.channels], time=time.time(), run=self.run_dir)
+            else:
+                if self._figure is None:
+                    self._figure = LivePlot(self.hist, headless=True, **self.layout)
+                self._figure.redraw(counts)
+                self._figure.fig.savefig(tmp, dpi=self.dpi)
+            os.replace(tmp, path)
+        self.saved_version = version
+        self.snapshots_written += 1
+        return self.snapshots
+
+    def _loop(self) -> None:
+        next_snapshot = time.monotonic() + self.snapshot_secs
+        while not self._stop.wait(self.poll_secs):
+            self.ingest()
+            if self.snapshots and time.monotonic() >= next_snapshot:
+                self.save_snapshots()
+                next_snapshot = max(next_snapshot + self.snapshot_secs, time.monotonic())
+
+    # Start the reader thread
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='monitor', daemon=True)
+        self._thread.start()
+
+    # Stop the reader thread, read what is left and write the last snapshots
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.ingest()
+        if self.snapshots:
+            self.save_snapshots()
+
+    # Headless: read and write snapshots for duration seconds (default: until Ctrl+C)
+    def run(self, duration: float | None = None) -> None:
+        self.start()
+        try:
+            if duration is None:
+                while True:
+                    time.sleep(3600)
+            else:
+                time.sleep(duration)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    # Show the histograms in a window, refreshed at most fps times per second, until it is closed
+    def show(self, fps: float = 5.) -> None:
+        import matplotlib.pyplot as plt
+
+        plot = LivePlot(self.hist, **self.layout)
+        canvas = plot.fig.canvas
+        blit = canvas.supports_blit
+        for artist in plot.artists:
+            artist.set_animated(blit)
+        shown = {'version': 0, 'background': None}
+
+        # After every full draw: keep the figure without the steps as background, then draw the steps on top
+        def on_draw(event):
+            if blit:
+                shown['background'] = canvas.copy_from_bbox(plot.fig.bbox)
+            for artist in plot.artists:
+                plot.fig.draw_artist(artist)
+
+        def refresh():
+            version, counts = self.counts()
+            if version == shown['version']:
+                return
+            shown['version'] = version
+            self.frames += 1
+            if plot.redraw(counts) or shown['background'] is None:
+                canvas.draw_idle()
+                return
+            canvas.restore_region(shown['background'])
+            for artist in plot.artists:
+                plot.fig.draw_artist(artist)
+            canvas.blit(plot.fig.bbox)
+
+        canvas.mpl_connect('draw_event', on_draw)
+        timer = canvas.new_timer(interval=1000 / fps)
+        timer.add_callback(refresh)
+        timer.start()
+        self.start()
+        try:
+            plt.show()
+        finally:
+            timer.stop()
+            self.stop()
+
+
+def main(argv: list[str] | None = None, prog: str | None = None):
+    from .catalog import resolve_run
+    from .loader import Run
+
+    parser = argparse.ArgumentParser(prog=prog, description='Live fine code histograms of a run that is being recorded')
+    parser.add_argument('run', nargs='?', default='latest',
+                        help="run folder, run name in --data-dir, part of it or 'latest'")
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('-c', '--channels', nargs='+', default=None, help='default: all channels of the run')
+    parser.add_argument('--headless', action='store_true', help='no window, only write the snapshots')
+    parser.add_argument('--fps', type=float, default=5., help='highest refresh rate of the window')
+    parser.add_argument('--poll', type=float, default=0.05, help='seconds between reads of the run files')
+    parser.add_argument('--snapshot', action='append', default=[], metavar='FILE',
+                        help='.png, .pdf, .svg or .npz, written into the run folder (default headless: histogram.png)')
+    parser.add_argument('--every', type=float, default=10., help='seconds between snapshots')
+    parser.add_argument('--runtime', type=float, default=None, help='minutes to run headless (default: until Ctrl+C)')
+    parser.add_argument('--bins', type=int, default=300)
+    parser.add_argument('--dpi', type=int, default=100)
+    args = parser.parse_args(argv)
+
+    run_dir = resolve_run(args.run, args.data_dir)
+    channels = args.channels or Run(run_dir).channels
+    snapshots = args.snapshot or (['histogram.png'] if args.headless else [])
+    ncols = min(2, len(channels))
+    monitor = Monitor(run_dir, channels, args.bins, args.poll, snapshots, args.every, nrows=-(-len(channels) // ncols),
+                      ncols=ncols, titles={channel: f'Channel {channel}' for channel in channels},
+                      figsize=(6 * ncols, 4 * -(-len(channels) // ncols)), dpi=args.dpi)
+    print(f'monitoring {run_dir}, channels {channels}' + (f', snapshots {monitor.snapshots}' if snapshots else ''))
+    if args.headless:
+        monitor.run(None if args.runtime is None else args.runtime * 60)
+    else:
+        monitor.show(args.fps)
+    print(f'{sum(monitor.hist.entries.values())} hits, {monitor.frames} frames, {monitor.snapshots_written} snapshots')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+# Acquisition from several boards in one process with asyncio.
+#
+# Every board is a byte source: a serial port (USB-Blaster, pseudo terminal of the
+# emulator, socket://host:port) or a UDP socket (udp://host:port) of the Ethernet
+# design. A single event loop waits on all of them with loop.add_reader, so no
+# thread per board is needed. The readable callbacks only collect the raw bytes and
+# the host time of the read; every batch_secs the collected bytes of each board are
+# decoded with one decoder call and written. The per-batch numpy cost is the same
+# for one or many boards, which keeps the CPU use low when boards are added.
+#
+# One run directory holds all boards:
+#
+#   run.json                manifest: boards, sources, formats, start/stop time, counters
+#   <board>/hits.tdc        the hits of the board, loadable with Run(f'{run_dir}/<board>')
+#   <board>/arrivals.i8     int64 pairs (hits written so far, host time in ns) per batch
+#   <board>/health.json     health metrics of the board (metrics.py)
+#
+# The arrival times give the host time of the last hit of each batch. The boards have
+# independent clocks, so they are used to align the coarse counters of different boards
+# to within the host latency (host_times() interpolates them per hit).
+#
+#   python -m tdc.multi --board a=/dev/ttyUSB0 --board b=/dev/ttyUSB1,channels --board c=udp://0.0.0.0:5000 --runtime 60
+
+import argparse
+import asyncio
+import datetime
+import os
+import time
+
+import numpy as np
+
+from .decode import CHANNELS, ChannelFrameDecoder, FrameDecoder
+from .metrics import HealthMonitor, write_snapshot
+from .storage import FILE_NAME, FLAG_NO_COARSE, LAYOUT_FINE_COARSE, LAYOUT_PER_CHANNEL, EventWriter
+from .udp import UdpReceiver
+
+FORMATS = ['coarse', 'channels', 'ethernet']
+MANIFEST = 'run.json'
+ARRIVALS_FILE = 'arrivals.i8'
+# Bytes taken from a source per readable event
+READ_BYTES = 1 << 16
+
+
+class Board:
+    """One byte source with its decoder and output files in run_dir/name."""
+
+    def __init__(self, name: str, url: str, fmt: str | None, run_dir: str, clock_hz: float = 12e6,
+                 baudrate: int = 115200):
+        fmt = fmt or ('ethernet' if url.startswith('udp://') else 'coarse')
+        if fmt not in FORMATS:
+            raise ValueError(f'{name}: unknown format {fmt!r}, use one of {FORMATS}')
+        self.name = name
+        self.url = url
+        self.fmt = fmt
+        self.dir = os.path.join(run_dir, name)
+        os.makedirs(self.dir)
+
+        if url.startswith('udp://'):
+            host, port = url[len('udp://'):].rsplit(':', 1)
+            self.receiver = UdpReceiver(host, int(port), timeout=0.)
+            self.source = self.receiver
+        else:
+            import serial
+            self.receiver = None
+            self.source = serial.serial_for_url(url, baudrate=baudrate, bytesize=8, timeout=0)
+
+        def log(message):
+            print(f'{name}: {message}')
+
+        if fmt == 'channels':
+            self.channels = CHANNELS
+            self.decoder = ChannelFrameDecoder(log=log)
+            self.writer = EventWriter(os.path.join(self.dir, FILE_NAME), CHANNELS, clock_hz, LAYOUT_PER_CHANNEL,
+                                      source=url, board=name)
+        else:
+            self.channels = ['0']
+            self.decoder = FrameDecoder(log=log)
+            self.writer = EventWriter(os.path.join(self.dir, FILE_NAME), ['0'], clock_hz, LAYOUT_FINE_COARSE,
+                                      source=url, board=name)
+        self.arrivals = open(os.path.join(self.dir, ARRIVALS_FILE), 'ab')
+        self.health = HealthMonitor(self.channels, decoder=self.decoder, writer=self.writer, receiver=self.receiver)
+
+        self.chunks = []
+        self.last_read_ns = 0
+        self.reads = 0
+        self.error = None
+
+    def fileno(self) -> int:
+        if self.receiver is not None:
+            return self.receiver.sock.fileno()
+        return self.source.fileno()
+
+    # Readable callback: only move the bytes into memory and note the time
+    def on_readable(self) -> None:
+        try:
+            data = self.source.read(READ_BYTES)
+        except Exception as e:
+            self.error = e
+            asyncio.get_running_loop().remove_reader(self.fileno())
+            print(f'{self.name}: {e!r}, board removed')
+            return
+        if data:
+            self.chunks.append(data)
+            self.last_read_ns = time.time_ns()
+            self.reads += 1
+
+    # Decode and write everything read since the last call. final: the stream ends, also write the frame
+    # the decoder kept back
+    def process(self, final: bool = False) -> int:
+        if not self.chunks and not final:
+            return 0
+        data = b''.join(self.chunks)
+        self.chunks = []
+        values = self.decoder.feed(data, final)
+        n = len(values[1])
+        if not n:
+            return 0
+        if self.fmt == 'channels':
+            self.writer.write(values[0], values[1], flags=FLAG_NO_COARSE)
+            self.health.count(values[0])
+        else:
+            self.writer.write(0, values[0], values[1])
+            self.health.count(0, n)
+        self.arrivals.write(np.array([self.writer.hits, self.last_read_ns], dtype='<i8').tobytes())
+        return n
+
+    def info(self) -> dict:
+        info = {
+            'name': self.name,
+            'source': self.url,
+            'format': self.fmt,
+            'channels': self.channels,
+            'dir': self.name,
+            'hits': self.writer.hits,
+            'bytes': self.decoder.bytes,
+            'sync_errors': self.decoder.sync_errors,
+            'bytes_discarded': self.decoder.bytes_discarded,
+        }
+        if self.receiver is not None:
+            info.update({k: v for k, v in self.receiver.stats().items() if k in ('datagrams', 'lost_datagrams')})
+        if self.error is not None:
+            info['error'] = repr(self.error)
+        return info
+
+    def close(self) -> None:
+        self.source.close()
+        self.writer.close()
+        self.arrivals.close()
+
+
+class MultiAcquisition:
+    """Read all boards concurrently into one run directory.
+
+    boards: list of (name, url, format) with format None for the default of the source.
+    """
+
+    def __init__(self, boards: list[tuple[str, str, str | None]], data_dir: str = './data', clock_hz: float = 12e6,
+                 baudrate: int = 115200, batch_secs: float = 0.05, report_secs: float = 5.):
+        names = [b[0] for b in boards]
+        if len(set(names)) != len(names):
+            raise ValueError(f'board names are not unique: {names}')
+        self.clock_hz = clock_hz
+        self.batch_secs = batch_secs
+        self.report_secs = report_secs
+        self.started = datetime.datetime.now()
+        self.run_dir = os.path.join(data_dir, 'multi_' + self.started.strftime('%Y-%m-%d_%H:%M:%S'))
+        os.makedirs(self.run_dir)
+        self.boards = []
+        try:
+            for name, url, fmt in boards:
+                self.boards.append(Board(name, url, fmt, self.run_dir, clock_hz, baudrate))
+        except Exception:
+            self.close()
+            raise
+        self.start_ns = time.time_ns()
+        self.stopped = None
+
+    def manifest(self) -> dict:
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'start_time_ns': self.start_ns,
+            'stopped': self.stopped.isoformat(timespec='seconds') if self.stopped else None,
+            'status': 'done' if self.stopped else 'running',
+            'clock_hz': self.clock_hz,
+            'arrivals': f'<board>/{ARRIVALS_FILE}: int64 pairs (hits written so far, host time in ns)',
+            'boards': [board.info() for board in self.boards],
+        }
+
+    def write_manifest(self) -> None:
+        write_snapshot(self.manifest(), os.path.join(self.run_dir, MANIFEST))
+
+    def report(self) -> None:
+        for board in self.boards:
+            snap = board.health.snapshot()
+            write_snapshot(snap, os.path.join(board.dir, 'health.json'))
+            rate = sum(snap['hits_per_s'].values())
+            print(f"{board.name}: {board.writer.hits} hits, {rate:.0f} hits/s, {snap['sync_errors']} sync errors")
+        self.write_manifest()
+
+    async def run(self, duration: float | None = None) -> dict:
+        loop = asyncio.get_running_loop()
+        for board in self.boards:
+            loop.add_reader(board.fileno(), board.on_readable)
+        self.write_manifest()
+        print(f'reading {len(self.boards)} boards into {self.run_dir}')
+
+        start = time.monotonic()
+        next_report = start + self.report_secs
+        try:
+            while duration is None or time.monotonic() - start < duration:
+                await asyncio.sleep(self.batch_secs)
+                for board in self.boards:
+                    board.process()
+                if time.monotonic() >= next_report:
+                    self.report()
+                    next_report += self.report_secs
+                if all(board.error is not None for board in self.boards):
+                    break
+        finally:
+            for board in self.boards:
+                if board.error is None:
+                    loop.remove_reader(board.fileno())
+                board.process(final=True)
+            self.stopped = datetime.datetime.now()
+            self.report()
+        return self.manifest()
+
+    def close(self) -> None:
+        for board in self.boards:
+            board.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Host time in ns of records of a board (index into hits.tdc, all channels), interpolated between the recorded batches
+def host_times(board_dir: str, index: np.ndarray) -> np.ndarray:
+    arrivals = np.fromfile(os.path.join(board_dir, ARRIVALS_FILE), dtype='<i8').reshape(-1, 2)
+    # Row k: hits[k] hits were written when the read at time[k] returned, i.e. hit hits[k] - 1 arrived then
+    return np.interp(index, arrivals[:, 0] - 1, arrivals[:, 1]).astype(np.int64)
+
+
+# 'name=url' or 'name=url,format'
+def parse_board(spec: str) -> tuple[str, str, str | None]:
+    name, sep, rest = spec.partition('=')
+    if not sep or not name or not rest:
+        raise argparse.ArgumentTypeError(f'expected name=url[,format], got {spec!r}')
+    url, _, fmt = rest.partition(',')
+    return name, url, fmt or None
+
+
+def main(argv: list[str] | None = None, prog: str | None = None):
+    parser = argparse.ArgumentParser(prog=prog, description='Read several TDC boards into one run directory')
+    parser.add_argument('--board', type=parse_board, action='append', required=True,
+                        help='name=url[,format], url: serial port, socket://host:port or udp://host:port,'
+                             f' format: one of {FORMATS} (default coarse, ethernet for udp)')
+    parser.add_argument('--runtime', type=float, default=None, help='minutes to read (default: until Ctrl+C)')
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('--clock', type=float, default=12e6, help='clock frequency in Hz')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--batch', type=float, default=0.05, help='seconds between decoding the collected bytes')
+    args = parser.parse_args(argv)
+
+    with MultiAcquisition(args.board, args.data_dir, args.clock, args.baud, args.batch) as acq:
+        try:
+            asyncio.run(acq.run(None if args.runtime is None else args.runtime * 60))
+        except KeyboardInterrupt:
+            pass
+    print(os.path.join(acq.run_dir, MANIFEST))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+# Out-of-core analysis of long runs on all cores.
+#
+# plot_calib and coincidence in calibration.py load every channel into memory at
+# once. Here the run (hits.tdc) is cut into chunks that worker processes read
+# themselves from the memory mapped file, so the memory only depends on the chunk
+# size and all cores are used. The results are the same as in a single pass:
+#
+#   index = index_run(run_dir)                                # hits and code histogram per file chunk
+#   luts = calibrate_parallel(run_dir, index=index)           # = calibrate(remove_overflow(fine))
+#   events, times = coincidence_parallel(run_dir, window=0, offsets={'00': -1}, luts=luts, index=index)
+#
+# Histograms of the chunks are simply added. remove_overflow removes the hits with
+# the same index in all channels, so the indices of the overflow hits are collected
+# first and the codes of the removed hits are subtracted from the counts afterwards.
+#
+# Coincidences are split by ranges of the timestamps instead of file chunks: an event
+# belongs to the chunk in which its first hit lies. Each worker also reads the hits
+# up to window before and after its range, so events at the edges of the ranges
+# come out exactly like in build_events over the whole run.
+#
+#   python -m tdc.parallel ./data/<timestamp> --offset 00=-1 --window 0
+
+import argparse
+import multiprocessing
+import os
+from typing import Iterator, NamedTuple
+
+import numpy as np
+
+from .calib import Lut, lut_from_counts, save_luts
+from .coincidence import Events, build_events, event_values, fold_counts
+from .decode import FINE_BITS
+from .loader import RECORD_BLOCK, Run
+from .storage import FLAG_NO_COARSE, FLAG_NO_FINE, RECORD_DTYPE
+from .timestamps import load_timestamps
+
+# Bins of the code histograms: every value a 9 bit fine code can take
+CODES = 1 << FINE_BITS
+STAMPS = ['index', 'timestamps']
+
+
+class RunIndex(NamedTuple):
+    run_dir: str
+    channels: list[str]
+    bounds: np.ndarray      # (n_chunks + 1,) record number where each chunk starts, and the end
+    counts: np.ndarray      # (n_chunks, n_channels) hits of each channel in each chunk
+    hist: np.ndarray        # (n_chunks, n_channels, CODES) code histogram of each channel in each chunk
+
+    # Hits of each channel before each chunk, shape (n_chunks + 1, n_channels)
+    @property
+    def first(self) -> np.ndarray:
+        return np.vstack([np.zeros(len(self.channels), dtype=np.int64), np.cumsum(self.counts, axis=0)])
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self.counts.sum(axis=0)
+
+    # Overflow code of each channel: the highest code that occurs (-1 for empty channels)
+    @property
+    def max_codes(self) -> np.ndarray:
+        total = self.hist.sum(axis=0)
+        return np.array([np.flatnonzero(h)[-1] if h.any() else -1 for h in total])
+
+
+def _open(run_dir: str) -> Run:
+    run = Run(run_dir)
+    if not run.binary:
+        raise ValueError(f'{run_dir}: no {os.path.basename(run.path)}, convert the run with python -m tdc.storage to-binary')
+    return run
+
+
+# Records that count as hits, like in Run.iter_chunks
+def _valid(run: Run, records: np.ndarray) -> np.ndarray:
+    valid = (records['flags'] & FLAG_NO_FINE) == 0
+    if run.has_coarse:
+        valid &= (records['flags'] & FLAG_NO_COARSE) == 0
+    return valid
+
+
+# Index of the run being processed, sent once to each worker instead of with every task
+_index = None
+
+
+def _set_index(index):
+    global _index
+    _index = index
+
+
+# Run func (a module level function) over the tasks in a process pool, or in this process for processes=1.
+# initializer(*initargs) runs once per worker first. Results come in task order
+def pool_map(func, tasks: list[tuple], processes: int | None, initializer=None, initargs: tuple = ()) -> Iterator:
+    if processes == 1 or len(tasks) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from (func(*task) for task in tasks)
+        return
+    # Forked workers do not import the calling script again (the analysis scripts have no __main__ guard)
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    with context.Pool(processes, initializer=initializer, initargs=initargs) as pool:
+        yield from pool.imap(_star, [(func, task) for task in tasks])
+
+
+# pool_map with the run index set in every worker
+def _map(func, tasks: list[tuple], processes: int | None, index: RunIndex | None = None) -> Iterator:
+    return pool_map(func, tasks, processes, _set_index, (index,))
+
+
+def _star(item):
+    func, task = item
+    return func(*task)
+
+
+# Channel numbers and fine codes of the valid records lo to hi. Plain columns, the records are not copied
+def _read(run: Run, lo: int, hi: int) -> tuple[np.ndarray, np.ndarray]:
+    records = run.records[lo:hi]
+    channel, fine = np.asarray(records['channel']), np.asarray(records['fine'])
+    valid = _valid(run, records)
+    if valid.all():
+        return channel, fine
+    return channel[valid], fine[valid]
+
+
+def _index_chunk(run_dir: str, lo: int, hi: int, ids: list[int]) -> tuple[np.ndarray, np.ndarray]:
+    channel, fine = _read(_open(run_dir), lo, hi)
+    # Histogram of all selected channels in one bincount, other channels go to an extra row
+    row = np.full(256, len(ids), dtype=np.int64)
+    row[ids] = np.arange(len(ids))
+    hist = np.bincount(row[channel] * CODES + (fine & (CODES - 1)), minlength=(len(ids) + 1) * CODES)
+    hist = hist.reshape(len(ids) + 1, CODES)[:len(ids)]
+    return hist.sum(axis=1), hist
+
+
+# First pass over a run: hits and code histogram of each channel in each chunk of chunk records
+def index_run(run_dir: str, channels: list[str] | None = None, chunk: int = RECORD_BLOCK,
+              processes: int | None = None) -> RunIndex:
+    run = _open(run_dir)
+    channels = list(run.channels) if channels is None else list(channels)
+    ids = [run.channels.index(c) for c in channels]
+    bounds = np.append(np.arange(0, len(run.records), chunk), len(run.records))
+    tasks = [(run_dir, int(lo), int(hi), ids) for lo, hi in zip(bounds[:-1], bounds[1:])]
+    results = list(_map(_index_chunk, tasks, processes))
+    counts = np.array([r[0] for r in results], dtype=np.int64).reshape(-1, len(channels))
+    hist = np.array([r[1] for r in results], dtype=np.int64).reshape(-1, len(channels), CODES)
+    return RunIndex(run_dir, channels, bounds, counts, hist)
+
+
+# Fine codes of the hits a[k] to b[k] of each channel k (counted over the whole run), read in one go
+# from the file chunks that contain them
+def _channel_fine(run: Run, index: RunIndex, a: list[int], b: list[int]) -> list[np.ndarray]:
+    first = index.first
+    ranges = [k for k in range(len(index.channels)) if b[k] > a[k]]
+    if not ranges:
+        return [np.empty(0, dtype=RECORD_DTYPE['fine']) for _ in index.channels]
+    c0 = min(int(np.searchsorted(first[:, k], a[k], side='right')) - 1 for k in ranges)
+    c1 = max(int(np.searchsorted(first[:, k], b[k], side='left')) for k in ranges)
+    channel, fine = _read(run, index.bounds[max(c0, 0)], index.bounds[min(c1, len(index.bounds) - 1)])
+    c0 = max(c0, 0)
+    return [fine[channel == run.channels.index(name)][a[k] - first[c0, k]:b[k] - first[c0, k]] if b[k] > a[k]
+            else np.empty(0, dtype=fine.dtype) for k, name in enumerate(index.channels)]
+
+
+# Fine codes of each channel in file chunk c
+def _chunk_fine(run: Run, index: RunIndex, c: int) -> list[np.ndarray]:
+    channel, fine = _read(run, index.bounds[c], index.bounds[c + 1])
+    return [fine[channel == run.channels.index(name)] for name in index.channels]
+
+
+# Indices (over the whole run) of the hits with the overflow code in one chunk, per channel
+def _overflow_chunk(run_dir: str, c: int) -> list[np.ndarray]:
+    index = _index
+    first = index.first
+    max_codes = index.max_codes
+    return [first[c, k] + np.flatnonzero(fine == max_codes[k])
+            for k, fine in enumerate(_chunk_fine(_open(run_dir), index, c))]
+
+
+# Code histogram of the given hits (indices over the whole run) of one chunk, per channel
+def _removed_chunk(run_dir: str, c: int, removed: list[np.ndarray]) -> np.ndarray:
+    index = _index
+    first = index.first
+    hist = np.zeros((len(index.channels), CODES), dtype=np.int64)
+    for k, fine in enumerate(_chunk_fine(_open(run_dir), index, c)):
+        hist[k] = np.bincount(fine[removed[k] - first[c, k]] & (CODES - 1), minlength=CODES)
+    return hist
+
+
+# Calibrate a run chunk by chunk in worker processes. The LUTs are the same as calibrate(remove_overflow(fine))
+# of the whole run: hits with the index of an overflow hit in any channel are removed in all channels.
+def calibrate_parallel(run_dir: str, channels: list[str] | None = None, freq: float | None = None,
+                       index: RunIndex | None = None, chunk: int = RECORD_BLOCK, processes: int | None = None,
+                       save: bool = True) -> dict[str, Lut]:
+    index = index or index_run(run_dir, channels, chunk, processes)
+    if channels is not None and list(channels) != index.channels:
+        index = _subset(index, channels)
+    freq = freq or _open(run_dir).clock_hz
+    tasks = [(run_dir, c) for c in range(len(index.counts))]
+    found = list(_map(_overflow_chunk, tasks, processes, index))
+    overflow = np.unique(np.concatenate([i for part in found for i in part] + [np.empty(0, dtype=np.int64)]))
+
+    # The overflow indices in each channel and chunk
+    first = index.first
+    lengths = index.lengths
+    tasks = []
+    for c in range(len(index.counts)):
+        removed = [overflow[(overflow >= first[c, k]) & (overflow < min(first[c + 1, k], lengths[k]))]
+                   for k in range(len(index.channels))]
+        if any(len(r) for r in removed):
+            tasks.append((run_dir, c, removed))
+    counts = index.hist.sum(axis=0)
+    for hist in _map(_removed_chunk, tasks, processes, index):
+        counts -= hist
+
+    used = [np.flatnonzero(h)[-1] + 1 for h in counts if h.any()]
+    n_codes = max(used, default=0)
+    luts = {channel: lut_from_counts(channel, counts[k, :n_codes], freq) for k, channel in enumerate(index.channels)}
+    if save:
+        save_luts(run_dir, luts)
+    return luts
+
+
+def _subset(index: RunIndex, channels: list[str]) -> RunIndex:
+    cols = [index.channels.index(c) for c in channels]
+    return RunIndex(index.run_dir, list(channels), index.bounds, index.counts[:, cols], index.hist[:, cols])
+
+
+# Events whose first hit has a stamp in [t_lo, t_hi)
+def _events_chunk(run_dir: str, t_lo: int, t_hi: int, window: int, min_fold: int, offsets: list[int], stamps: str,
+                  drop_overflow: bool, centers: list[np.ndarray] | None,
+                  require: list[str] | None) -> tuple[Events, np.ndarray | None]:
+    run, index = _open(run_dir), _index
+    first = index.first
+    lengths = index.lengths
+    max_codes = index.max_codes
+    a, b, c0, chunk_stamps = [], [], [], []
+    for k, channel in enumerate(index.channels):
+        # Hits with stamps in [t_lo - window - 1, t_hi + window]: the hit before an event decides whether
+        # it starts a new event, the hits after it can belong to an event that starts in the range
+        if stamps == 'index':
+            a.append(int(np.clip(t_lo - window - 1 - offsets[k], 0, lengths[k])))
+            b.append(int(np.clip(t_hi + window + 1 - offsets[k], 0, lengths[k])))
+            chunk_stamps.append(np.arange(a[k], b[k], dtype=np.int64) + offsets[k])
+        else:
+            ts = load_timestamps(run_dir, channel)
+            a.append(int(np.searchsorted(ts, t_lo - window - 1, side='left')))
+            b.append(int(np.searchsorted(ts, t_hi + window, side='right')))
+            chunk_stamps.append(np.asarray(ts[a[k]:b[k]], dtype=np.int64))
+        # Read from the start of the file chunk to count the overflow hits before a
+        c0.append(max(int(np.searchsorted(first[:, k], a[k], side='right')) - 1, 0))
+
+    starts = [int(first[c0[k], k]) for k in range(len(index.channels))]
+    values, kept_before = {}, []
+    for k, (channel, fine) in enumerate(zip(index.channels, _channel_fine(run, index, starts, b))):
+        keep = fine != max_codes[k] if drop_overflow else np.ones(len(fine), dtype=bool)
+        skipped = index.hist[:c0[k], k, max_codes[k]].sum() if drop_overflow and max_codes[k] >= 0 else 0
+        kept_before.append(starts[k] - skipped + int(keep[:a[k] - starts[k]].sum()))
+        fine, keep = fine[a[k] - starts[k]:], keep[a[k] - starts[k]:]
+        chunk_stamps[k] = chunk_stamps[k][keep]
+        if centers is not None:
+            values[channel] = centers[k][np.minimum(fine[keep], len(centers[k]) - 1)]
+
+    events = build_events(dict(zip(index.channels, chunk_stamps)), window, min_fold)
+    sel = (events.start >= t_lo) & (events.start < t_hi)
+    if require:
+        cols = [index.channels.index(c) for c in require]
+        sel &= (events.index[:, cols] >= 0).all(axis=1)
+    events = Events(events.channels, events.index[sel], events.fold[sel], events.start[sel])
+    times = event_values(events, values) if centers is not None else None
+    shifted = np.where(events.index >= 0, events.index + np.array(kept_before, dtype=np.int64), -1)
+    return Events(events.channels, shifted, events.fold, events.start), times
+
+
+# Stamp ranges of the chunks: about chunk hits of the longest channel each
+def _stamp_bounds(run_dir: str, index: RunIndex, stamps: str, offsets: list[int], chunk: int) -> np.ndarray:
+    lengths = index.lengths
+    if stamps == 'index':
+        lo = min(offsets)
+        hi = max(int(n) + o for n, o in zip(lengths, offsets))
+        return np.append(np.arange(lo, hi, chunk), hi)
+    ts = {c: load_timestamps(run_dir, c) for c, n in zip(index.channels, lengths) if n}
+    if not ts:
+        return np.zeros(1, dtype=np.int64)
+    longest = ts[index.channels[int(np.argmax(lengths))]]
+    lo = min(int(t[0]) for t in ts.values())
+    hi = max(int(t[-1]) for t in ts.values()) + 1
+    inner = np.asarray(longest[chunk::chunk], dtype=np.int64)
+    return np.unique(np.concatenate([[lo], inner[(inner > lo) & (inner < hi)], [hi]]))
+
+
+# Build the events of a run chunk by chunk in worker processes and yield (events, times) per chunk, in order.
+# stamps: 'index' (hit number in each channel plus offsets[channel], for the designs without coarse counter) or
+# 'timestamps' (the ps timestamps written by python -m tdc.timestamps, must be sorted).
+# Overflow hits are dropped first if drop_overflow. With luts, times holds the bin centers of the hits of each
+# event (nan for missing channels). require: only keep events that contain all these channels.
+# Event indices count the (kept) hits of each channel over the whole run.
+def iter_coincidences(run_dir: str, channels: list[str] | None = None, window: int = 0, min_fold: int = 2,
+                      offsets: dict[str, int] | None = None, stamps: str = 'index', drop_overflow: bool = True,
+                      luts: dict[str, Lut] | None = None, require: list[str] | None = None,
+                      index: RunIndex | None = None, chunk: int = RECORD_BLOCK,
+                      processes: int | None = None) -> Iterator[tuple[Events, np.ndarray | None]]:
+    if stamps not in STAMPS:
+        raise ValueError(f'unknown stamps {stamps!r}, use one of {STAMPS}')
+    index = index or index_run(run_dir, channels, chunk, processes)
+    if channels is not None and list(channels) != index.channels:
+        index = _subset(index, channels)
+    offsets = [(offsets or {}).get(c, 0) for c in index.channels]
+    centers = [luts[c].centers for c in index.channels] if luts else None
+    # About chunk records per task
+    bounds = _stamp_bounds(run_dir, index, stamps, offsets, max(chunk // len(index.channels), 1))
+    tasks = [(run_dir, int(lo), int(hi), window, min_fold, offsets, stamps, drop_overflow, centers, require)
+             for lo, hi in zip(bounds[:-1], bounds[1:])]
+    yield from _map(_events_chunk, tasks, processes, index)
+
+
+# All events of a run, the same as build_events over the whole run (see iter_coincidences)
+def coincidence_parallel(run_dir: str, channels: list[str] | None = None, window: int = 0, min_fold: int = 2,
+                         **kwargs) -> tuple[Events, np.ndarray | None]:
+    parts = list(iter_coincidences(run_dir, channels, window, min_fold, **kwargs))
+    channels = parts[0][0].channels if parts else list(channels or [])
+    events = Events(channels,
+                    np.concatenate([p[0].index for p in parts] + [np.empty((0, len(channels)), dtype=np.int64)]),
+                    np.concatenate([p[0].fold for p in parts] + [np.empty(0, dtype=np.int64)]),
+                    np.concatenate([p[0].start for p in parts] + [np.empty(0, dtype=np.int64)]))
+    if not parts or parts[0][1] is None:
+        return events, None
+    return events, np.concatenate([p[1] for p in parts])
+
+
+def main(argv: list[str] | None = None, prog: str | None = None):
+    from .catalog import resolve_run
+
+    parser = argparse.ArgumentParser(prog=prog, description='Calibrate a run and build its events on all cores')
+    parser.add_argument('run', nargs='?', default='latest',
+                        help="run folder, run name in --data-dir, part of it or 'latest'")
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('-c', '--channels', nargs='+', default=None)
+    parser.add_argument('--stamps', choices=STAMPS, default='index')
+    parser.add_argument('--window', type=int, default=0, help='coincidence window in units of the stamps')
+    parser.add_argument('--min-fold', type=int, default=2)
+    parser.add_argument('--offset', action='append', default=[], metavar='CHANNEL=N',
+                        help='added to the hit numbers of a channel (index stamps), e.g. 00=-1')
+    parser.add_argument('--chunk', type=int, default=RECORD_BLOCK, help='records per chunk')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='worker processes (default: all cores)')
+    args = parser.parse_args(argv)
+
+    run_dir = resolve_run(args.run, args.data_dir)
+    offsets = {c: int(n) for c, n in (o.split('=') for o in args.offset)}
+    index = index_run(run_dir, args.channels, args.chunk, args.processes)
+    print(f'{run_dir}: {dict(zip(index.channels, index.lengths.tolist()))} hits in {len(index.counts)} chunks')
+    luts = calibrate_parallel(run_dir, index=index, processes=args.processes)
+    print(f'LUTs of {len(luts)} channels saved, {luts[index.channels[0]].n_codes} codes')
+    events, _ = coincidence_parallel(run_dir, window=args.window, min_fold=args.min_fold, offsets=offsets,
+                                     stamps=args.stamps, index=index, chunk=args.chunk, processes=args.processes)
+    print(f'Events per fold: {fold_counts(events)}')
+
+
+if __name__ == '__main__':
+    main()
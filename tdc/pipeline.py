@@ -0,0 +1,217 @@
+# Pipelined acquisition: serial reader, decoder and writer in separate threads.
+#
+# The reader thread only moves raw byte chunks from the serial port into a bounded
+# queue, so a slow write or fsync can not stall the serial read and overflow the
+# FIFO on the FPGA. A decoder thread turns the chunks into decoded batches and a
+# writer thread hands them to the output. The reader never blocks: if the chunk
+# queue is full the chunk is dropped and counted, and a ChunkLoss in front of the next
+# chunk tells the decoder that the stream has a hole (lost(n_bytes)). The decoder waits
+# for the writer instead, so a slow writer fills the chunk queue before anything is lost.
+# An exception in one of the threads ends the run.
+
+import queue
+import threading
+import time
+from typing import NamedTuple
+
+# Marks the end of the stream in the queues
+_STOP = object()
+
+
+class ChunkLoss(NamedTuple):
+    """Put into the chunk queue in front of the first chunk after dropped chunks."""
+    bytes: int
+
+
+class StageQueue(queue.Queue):
+    """Bounded queue that keeps track of its high-water mark and of dropped items."""
+
+    def __init__(self, maxsize: int):
+        super().__init__(maxsize)
+        self.high_water = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+
+    # Put without blocking. Returns False and counts the item as dropped if the queue is full
+    def offer(self, item, size: int = 0) -> bool:
+        try:
+            self.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            self.dropped_bytes += size
+            return False
+        self.high_water = max(self.high_water, self.qsize())
+        return True
+
+    # Blocking put that also updates the high-water mark
+    def push(self, item) -> None:
+        self.put(item)
+        self.high_water = max(self.high_water, self.qsize())
+
+
+class AcquisitionPipeline:
+    """Run reader -> decoder -> writer threads on an open serial port.
+
+    decode(chunk) turns a raw bytes chunk into a batch (or None if nothing complete was decoded),
+    write(batch) stores a batch. Both are called from their own thread only. lost(n_bytes) is called
+    by the decoder thread where chunks were dropped, before the next chunk is decoded (e.g. the skip
+    of the decoders in decode.py), flush() at the end of the stream for what the decoder kept back
+    (a batch or None). They can be set after start_reading(), so the port is read while the decoder
+    and the output are still being set up.
+    """
+
+    def __init__(self, ser, decode=None, write=None, lost=None, flush=None, chunk_queue: int = 4096,
+                 batch_queue: int = 256):
+        self.ser = ser
+        self.decode = decode
+        self.write = write
+        self.lost = lost
+        self.flush = flush
+
+        self.chunks = StageQueue(chunk_queue)
+        self.batches = StageQueue(batch_queue)
+
+        self.bytes_read = 0
+        self.in_waiting_high_water = 0
+        self.batches_written = 0
+        self.errors = []
+        # Set as soon as one of the threads failed
+        self.failed = threading.Event()
+
+        self._running = threading.Event()
+        # Bytes dropped since the last chunk that made it into the queue
+        self._lost = 0
+        self._threads = [
+            threading.Thread(target=self._read, name='tdc-reader', daemon=True),
+            threading.Thread(target=self._decode, name='tdc-decoder', daemon=True),
+            threading.Thread(target=self._write, name='tdc-writer', daemon=True),
+        ]
+
+    # Start only the reader thread, the chunks wait in the chunk queue until start()
+    def start_reading(self) -> 'AcquisitionPipeline':
+        self._running.set()
+        self._threads[0].start()
+        return self
+
+    def start(self) -> 'AcquisitionPipeline':
+        self._running.set()
+        for thread in self._threads:
+            if thread.ident is None:
+                thread.start()
+        return self
+
+    # Stop reading, let decoder and writer drain their queues and wait for them
+    def stop(self) -> dict:
+        self._running.clear()
+        for thread in self._threads:
+            if thread.ident is not None:
+                thread.join()
+        return self.stats()
+
+    def stats(self) -> dict:
+        return {
+            'bytes_read': self.bytes_read,
+            'in_waiting_high_water': self.in_waiting_high_water,
+            'batches_written': self.batches_written,
+            'chunk_queue_depth': self.chunks.qsize(),
+            'chunk_queue_high_water': self.chunks.high_water,
+            'chunk_queue_size': self.chunks.maxsize,
+            'chunks_dropped': self.chunks.dropped,
+            'bytes_dropped': self.chunks.dropped_bytes,
+            'batch_queue_depth': self.batches.qsize(),
+            'batch_queue_high_water': self.batches.high_water,
+            'batch_queue_size': self.batches.maxsize,
+            'errors': len(self.errors),
+        }
+
+    def _fail(self, e: Exception) -> None:
+        self.errors.append(e)
+        self.failed.set()
+
+    # Put a chunk into the chunk queue without blocking, after a ChunkLoss if chunks were dropped before.
+    # The reader is the only thread that puts chunks, so the free space can only grow meanwhile
+    def _offer(self, data: bytes) -> None:
+        if self.chunks.maxsize - self.chunks.qsize() < (2 if self._lost else 1):
+            self.chunks.dropped += 1
+            self.chunks.dropped_bytes += len(data)
+            self._lost += len(data)
+            return
+        if self._lost:
+            self.chunks.push(ChunkLoss(self._lost))
+            self._lost = 0
+        self.chunks.push(data)
+
+    # Reader: only move raw bytes from the serial port to the chunk queue.
+    # The serial port should have a read timeout so that stop() is noticed.
+    def _read(self):
+        try:
+            while self._running.is_set():
+                waiting = self.ser.in_waiting
+                self.in_waiting_high_water = max(self.in_waiting_high_water, waiting)
+                data = self.ser.read(max(1, waiting))
+                if data:
+                    self.bytes_read += len(data)
+                    self._offer(data)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self.chunks.put(_STOP)
+
+    def _decode(self):
+        try:
+            while (chunk := self.chunks.get()) is not _STOP:
+                if isinstance(chunk, ChunkLoss):
+                    if self.lost is not None:
+                        self.lost(chunk.bytes)
+                    continue
+                batch = self.decode(chunk)
+                if batch is not None:
+                    self.batches.push(batch)
+            if self.flush is not None and (batch := self.flush()) is not None:
+                self.batches.push(batch)
+        except Exception as e:
+            self._fail(e)
+            # Keep the reader from blocking on a queue nobody empties anymore
+            while self.chunks.get() is not _STOP:
+                pass
+        finally:
+            self.batches.put(_STOP)
+
+    def _write(self):
+        try:
+            while (batch := self.batches.get()) is not _STOP:
+                self.write(batch)
+                self.batches_written += 1
+        except Exception as e:
+            self._fail(e)
+            while self.batches.get() is not _STOP:
+                pass
+
+
+# Print the queue statistics in one line
+def format_stats(stats: dict) -> str:
+    return (f"read {stats['bytes_read']} B | chunk queue {stats['chunk_queue_depth']}/{stats['chunk_queue_size']}"
+            f" (max {stats['chunk_queue_high_water']}, dropped {stats['chunks_dropped']} = {stats['bytes_dropped']} B)"
+            f" | batch queue {stats['batch_queue_depth']}/{stats['batch_queue_size']}"
+            f" (max {stats['batch_queue_high_water']})")
+
+
+# Run the pipeline for runtime_secs and print the queue statistics every report_secs.
+# Stops at once and raises RuntimeError if one of the threads failed
+def run_pipeline(pipeline: AcquisitionPipeline, runtime_secs: float, report_secs: float = 10.) -> dict:
+    start_time = time.time()
+    pipeline.start()
+    try:
+        while (time.time() - start_time) < runtime_secs and not pipeline.failed.is_set():
+            pipeline.failed.wait(min(report_secs, max(0., runtime_secs - (time.time() - start_time))))
+            print(format_stats(pipeline.stats()))
+    except KeyboardInterrupt:
+        pass
+    stats = pipeline.stop()
+    print(format_stats(stats))
+    for e in pipeline.errors:
+        print(f'Error in pipeline: {e!r}')
+    if pipeline.errors:
+        raise RuntimeError(f'acquisition stopped after {time.time() - start_time:.1f} s, '
+                           f'{len(pipeline.errors)} error(s) in the pipeline') from pipeline.errors[0]
+    return stats
@@ -0,0 +1,321 @@
+# Rate, dead time and lost hits of a run from the unwrapped coarse counter.
+#
+# On the FPGA the hits go channel -> fifo_writer -> 16 deep fifo -> uart. A hit
+# takes 5 bytes, i.e. 50 bits at 115200 baud or 0.43 ms, so when the input comes
+# faster than the UART drains the FIFO, hits are dropped without any notice. On the
+# host this only shows up in the coarse counter: the steps between hits get longer
+# than they should be. RateAnalyzer reads the coarse values chunk by chunk in
+# constant memory and collects:
+#   - the rate over time: hits per time bin. Bins are merged in pairs whenever the
+#     run gets longer than max_bins bins, so the series never has more than max_bins,
+#   - the distribution of the steps between hits in bins that are one tick wide for
+#     short steps and 1/16 octave wide above 256 ticks, with the distribution a random
+#     (Poisson) input would give, with and without a dead time,
+#   - the dead time: the shortest step, the 0.1 % quantile of the steps and the shift
+#     of the exponential step distribution (mean - standard deviation of the steps),
+#   - suspected gaps: for a periodic input (the steps vary by less than 10 %) steps
+#     longer than gap_factor periods, for a random input steps that a Poisson input
+#     gives with a probability below gap_p. The largest gaps are kept with their
+#     hit number and time.
+# Steps over a counter reset are left out, the elapsed time is unknown there.
+#
+# The summary is small (a few kB) and is saved as <run>/rates.json.
+#
+#   summary = analyze_run('./data/<timestamp>', bin_secs=1., link_baud=115200)
+#   print(format_rates(summary))
+#
+#   python -m tdc.rates latest --link 115200 --plot
+
+import argparse
+import heapq
+import os
+
+import numpy as np
+
+from .coarse import Unwrapper
+from .decode import FRAME_BYTES
+from .loader import RECORD_BLOCK, Run
+from .metrics import write_snapshot
+from .storage import FLAG_NO_COARSE, FLAG_NO_FINE
+
+RATES_FILE = 'rates.json'
+# Longest rate series, bins are merged in pairs above
+MAX_BINS = 4096
+# Bin edges of the step histogram in ticks: every tick up to 256, then 16 bins per octave up to 2^44 ticks
+STEP_EDGES = np.unique(np.concatenate([np.arange(256), np.floor(2 ** (np.arange(8 * 16, 44 * 16 + 1) / 16))])
+                       ).astype(np.int64)
+# Periodic input: the median absolute deviation of the steps is below this fraction of the median step
+PERIODIC_MAD = 0.1
+# Largest gaps kept
+TOP_GAPS = 20
+
+
+class RateAnalyzer:
+    """Streaming rate, step, dead time and gap statistics of the coarse values of one channel."""
+
+    def __init__(self, clock_hz: float = 12e6, bin_secs: float = 1., max_bins: int = MAX_BINS,
+                 gap_factor: float = 1.5, gap_p: float = 1e-9, min_hits: int = 16):
+        self.clock_hz = clock_hz
+        self.bin_ticks = max(1, round(bin_secs * clock_hz))
+        self.max_bins = max_bins + max_bins % 2
+        self.gap_factor = gap_factor
+        self.gap_p = gap_p
+        self.min_hits = min_hits
+
+        self.unwrapper = Unwrapper()
+        self.rate = np.zeros(self.max_bins, dtype=np.int64)
+        self.steps = np.zeros(len(STEP_EDGES), dtype=np.int64)
+        self.n_steps = 0
+        self.sum_steps = 0.
+        self.sum_steps2 = 0.
+        self.min_step = None
+        self.max_step = None
+        self.resets = 0
+        self.wraps = 0
+        # Suspected gaps: number, hits missing in them, the largest as (step, hit, tick)
+        self.gaps = 0
+        self.missing = 0
+        self.top_gaps = []
+        self.periodic_batches = 0
+        self.batches = 0
+
+    def feed(self, coarse: np.ndarray) -> None:
+        coarse = np.asarray(coarse)
+        if len(coarse) == 0:
+            return
+        u = self.unwrapper
+        first = u.n
+        last_tick = u.last_tick
+        ticks = u.feed(coarse)
+        self.wraps += len(u.wraps)
+        self.resets += len(u.resets)
+        resets = np.asarray(u.resets, dtype=np.int64) - first
+        u.wraps, u.resets = [], []
+
+        # Rate: merge pairs of bins until the run fits
+        while ticks[-1] // self.bin_ticks >= self.max_bins:
+            self.rate = np.concatenate([self.rate.reshape(-1, 2).sum(axis=1), np.zeros(self.max_bins // 2, np.int64)])
+            self.bin_ticks *= 2
+        self.rate += np.bincount(ticks // self.bin_ticks, minlength=self.max_bins)
+
+        # Steps to the previous hit, without the steps over a counter reset
+        steps = np.diff(ticks, prepend=last_tick)
+        index = np.arange(first, first + len(ticks))
+        keep = np.ones(len(steps), dtype=bool)
+        keep[resets] = False
+        if first == 0:
+            keep[0] = False
+        steps, index, ticks = steps[keep], index[keep], ticks[keep]
+        if len(steps) == 0:
+            return
+        self.steps += np.bincount(np.searchsorted(STEP_EDGES, steps, side='right') - 1, minlength=len(STEP_EDGES))
+        self.n_steps += len(steps)
+        self.sum_steps += float(steps.sum())
+        self.sum_steps2 += float((steps.astype(np.float64) ** 2).sum())
+        self.min_step = int(steps.min()) if self.min_step is None else min(self.min_step, int(steps.min()))
+        self.max_step = int(steps.max()) if self.max_step is None else max(self.max_step, int(steps.max()))
+        self._gaps(steps, index, ticks)
+
+    # Suspected gaps of one batch, judged against the typical step of the batch
+    def _gaps(self, steps: np.ndarray, index: np.ndarray, ticks: np.ndarray) -> None:
+        if len(steps) < self.min_hits:
+            return
+        self.batches += 1
+        median = max(float(np.median(steps)), 1.)
+        if np.median(np.abs(steps - median)) < PERIODIC_MAD * median:
+            self.periodic_batches += 1
+            gap = steps > self.gap_factor * median
+            missing = np.rint(steps[gap] / median) - 1
+        else:
+            mean = max(float(steps.mean()), 1.)
+            gap = steps > -np.log(self.gap_p) * mean
+            missing = np.rint(steps[gap] / mean) - 1
+        self.gaps += int(gap.sum())
+        self.missing += int(missing.sum())
+        for step, hit, tick in zip(steps[gap].tolist(), index[gap].tolist(), ticks[gap].tolist()):
+            item = (step, hit, tick)
+            if len(self.top_gaps) < TOP_GAPS:
+                heapq.heappush(self.top_gaps, item)
+            elif item > self.top_gaps[0]:
+                heapq.heapreplace(self.top_gaps, item)
+
+    # Quantile q of the steps in ticks (lower bin edge)
+    def step_quantile(self, q: float) -> int | None:
+        if self.n_steps == 0:
+            return None
+        return int(STEP_EDGES[np.searchsorted(np.cumsum(self.steps), q * self.n_steps)])
+
+    # Steps per bin a random input with the mean step of the run would give, shifted by dead_time ticks
+    def expected_steps(self, dead_time: float = 0.) -> np.ndarray:
+        if self.n_steps == 0:
+            return np.zeros(len(STEP_EDGES))
+        scale = max(self.sum_steps / self.n_steps - dead_time, 1e-9)
+        edges = np.append(STEP_EDGES, np.inf)
+        cdf = 1 - np.exp(-np.maximum(edges - dead_time, 0) / scale)
+        return self.n_steps * np.diff(cdf)
+
+    def summary(self) -> dict:
+        u = self.unwrapper
+        tick_ns = 1e9 / self.clock_hz
+        n_bins = int(u.last_tick // self.bin_ticks) + 1 if u.n else 0
+        rate = self.rate[:n_bins] * self.clock_hz / self.bin_ticks
+        mean = self.sum_steps / self.n_steps if self.n_steps else None
+        std = np.sqrt(max(self.sum_steps2 / self.n_steps - mean ** 2, 0.)) if self.n_steps else None
+        periodic = self.batches > 0 and self.periodic_batches > self.batches / 2
+        # For a random input with a dead time the steps are exponential, shifted by the dead time
+        dead_time = max(mean - std, 0.) if self.n_steps and not periodic else None
+        used = np.flatnonzero(self.steps)
+        short = STEP_EDGES < 0.1 * (mean or 0)
+        expected = self.expected_steps()
+        return {
+            'clock_hz': self.clock_hz,
+            'hits': u.n,
+            'span_s': u.last_tick / self.clock_hz if u.n else None,
+            'mean_rate_hz': (u.n - 1) / (u.last_tick / self.clock_hz) if u.n > 1 and u.last_tick else None,
+            'wraps': self.wraps,
+            'resets': self.resets,
+            'input': 'periodic' if periodic else 'random',
+            'rate': {'bin_s': self.bin_ticks / self.clock_hz, 'hz': rate.round(3).tolist(),
+                     'max_hz': float(rate.max()) if n_bins else None},
+            'steps': {
+                'n': self.n_steps,
+                'mean_ns': mean * tick_ns if mean is not None else None,
+                'std_ns': std * tick_ns if std is not None else None,
+                'min_ns': self.min_step * tick_ns if self.min_step is not None else None,
+                'q001_ns': max(self.step_quantile(0.001), self.min_step) * tick_ns if self.n_steps else None,
+                'max_ns': self.max_step * tick_ns if self.max_step is not None else None,
+                # Bins with steps: lower edge in ticks and counts, with the counts of a random input
+                'edges': STEP_EDGES[used].tolist(),
+                'counts': self.steps[used].tolist(),
+                'expected': expected[used].round(3).tolist(),
+                'expected_dead_time': self.expected_steps(dead_time or 0.)[used].round(3).tolist(),
+                # Steps below a tenth of the mean step, compared to a random input without dead time (1: no dead time)
+                'short_ratio': float(self.steps[short].sum() / expected[short].sum()) if short.any()
+                and expected[short].sum() > 0 else None,
+            },
+            'dead_time_ns': dead_time * tick_ns if dead_time is not None else None,
+            'gaps': {'n': self.gaps, 'missing_hits': self.missing,
+                     'largest': [{'step_ns': s * tick_ns, 'hit': h, 'time_s': t / self.clock_hz}
+                                 for s, h, t in sorted(self.top_gaps, reverse=True)]},
+        }
+
+
+# Analyze the coarse values of one channel of a run and save the summary in the run folder.
+# link_baud: baud rate of the UART, to compare the rates with what it can carry (10 bits per byte).
+def analyze_run(run_dir: str, channel: str | None = None, bin_secs: float = 1., link_baud: float | None = None,
+                chunk: int = RECORD_BLOCK, save: bool = True, **options) -> dict:
+    run = Run(run_dir)
+    if not run.has_coarse:
+        raise ValueError(f'{run_dir}: the {run.layout} layout has no coarse counter')
+    channel = channel or run.channels[0]
+    analyzer = RateAnalyzer(run.clock_hz, bin_secs, **options)
+    if run.binary:
+        i = run.channels.index(channel)
+        for lo in range(0, len(run.records), chunk):
+            records = run.records[lo:lo + chunk]
+            valid = (records['channel'] == i) & ((records['flags'] & (FLAG_NO_COARSE | FLAG_NO_FINE)) == 0)
+            analyzer.feed(records['coarse'][valid])
+    else:
+        for part in run.iter_chunks([channel], chunk=chunk):
+            analyzer.feed(part[channel].coarse)
+
+    summary = {'run': os.path.basename(os.path.normpath(run_dir)), 'channel': channel, **analyzer.summary()}
+    if link_baud:
+        link_hz = link_baud / 10 / FRAME_BYTES
+        rate = np.array(summary['rate']['hz'])
+        summary['link'] = {'baud': link_baud, 'max_hz': link_hz,
+                           'bins_at_limit': int(np.count_nonzero(rate >= 0.95 * link_hz))}
+    if save:
+        write_snapshot(summary, os.path.join(run_dir, RATES_FILE))
+    return summary
+
+
+def format_rates(summary: dict) -> str:
+    steps = summary['steps']
+    lines = [f"{summary['run']} channel {summary['channel']}: {summary['hits']} hits"
+             + (f" in {summary['span_s']:.1f} s, {summary['mean_rate_hz']:.1f} hits/s" if summary['span_s'] else '')
+             + f", {summary['wraps']} wraps, {summary['resets']} counter resets, {summary['input']} input"]
+    if summary['rate']['max_hz'] is not None:
+        lines.append(f"rate: highest {summary['rate']['max_hz']:.1f} hits/s in bins of {summary['rate']['bin_s']:g} s")
+    if 'link' in summary:
+        link = summary['link']
+        lines.append(f"link: {link['max_hz']:.0f} hits/s at {link['baud']:g} baud, {link['bins_at_limit']} bins"
+                     f" above 95 % of it")
+    if steps['n']:
+        lines.append(f"steps: mean {steps['mean_ns'] / 1e3:.3f} us, std {steps['std_ns'] / 1e3:.3f} us,"
+                     f" shortest {steps['min_ns'] / 1e3:.3f} us, 0.1 % below {steps['q001_ns'] / 1e3:.3f} us")
+    if summary['dead_time_ns'] is not None:
+        ratio = f", {steps['short_ratio']:.3f} of the short steps of a random input" \
+            if steps['short_ratio'] is not None else ''
+        lines.append(f"dead time: {summary['dead_time_ns'] / 1e3:.3f} us from the step distribution{ratio}")
+    gaps = summary['gaps']
+    lines.append(f"suspected gaps: {gaps['n']} ({gaps['missing_hits']} hits missing)")
+    for gap in gaps['largest'][:5]:
+        lines.append(f"  {gap['step_ns'] / 1e6:.3f} ms before hit {gap['hit']} at {gap['time_s']:.3f} s")
+    return '\n'.join(lines)
+
+
+# Rate over time and the step distribution against a random input
+def plot_rates(summary: dict, save_path: str | None = None, show: bool = True):
+    import matplotlib.pyplot as plt
+
+    fig, (ax_rate, ax_steps) = plt.subplots(2, 1, figsize=(10, 8))
+    rate = np.array(summary['rate']['hz'])
+    ax_rate.step(np.arange(len(rate)) * summary['rate']['bin_s'], rate, where='post')
+    if 'link' in summary:
+        ax_rate.axhline(summary['link']['max_hz'], color='red', linestyle='--', label='UART limit')
+        ax_rate.legend()
+    ax_rate.set_xlabel('Time [s]')
+    ax_rate.set_ylabel('Rate [hits/s]')
+    ax_rate.set_title(f"{summary['run']} channel {summary['channel']}")
+
+    steps = summary['steps']
+    tick_us = 1e6 / summary['clock_hz']
+    edges = np.array(steps['edges']) * tick_us
+    ax_steps.step(edges, steps['counts'], where='post', label='observed')
+    if summary['input'] == 'random':
+        ax_steps.step(edges, steps['expected'], where='post', label='random input')
+        if summary['dead_time_ns']:
+            ax_steps.step(edges, steps['expected_dead_time'], where='post',
+                          label=f"random input, dead time {summary['dead_time_ns'] / 1e3:.2f} us")
+    ax_steps.set_xscale('log')
+    ax_steps.set_yscale('log')
+    ax_steps.set_xlabel('Step to the previous hit [us]')
+    ax_steps.set_ylabel('Hits per bin')
+    ax_steps.legend()
+    fig.tight_layout()
+    if save_path:
+        fig.savefig(save_path, dpi=300)
+    if show:
+        plt.show()
+    return fig
+
+
+def main(argv: list[str] | None = None, prog: str | None = None):
+    from .catalog import resolve_run
+
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Rate, dead time and lost hits of a run from the coarse counter')
+    parser.add_argument('run', nargs='?', default='latest',
+                        help="run folder, run name in --data-dir, part of it or 'latest'")
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('-c', '--channel', default=None)
+    parser.add_argument('--bin', type=float, default=1., help='width of the rate bins in s (merged for long runs)')
+    parser.add_argument('--link', type=float, default=None, metavar='BAUD', help='compare the rates with this UART')
+    parser.add_argument('--gap-factor', type=float, default=1.5,
+                        help='gap: step above this many periods (periodic input)')
+    parser.add_argument('--gap-p', type=float, default=1e-9, help='gap: step less likely than this (random input)')
+    parser.add_argument('--plot', action='store_true')
+    parser.add_argument('--save', default=None, help='save the plot to this file')
+    args = parser.parse_args(argv)
+
+    run_dir = resolve_run(args.run, args.data_dir)
+    summary = analyze_run(run_dir, args.channel, args.bin, args.link, gap_factor=args.gap_factor, gap_p=args.gap_p)
+    print(format_rates(summary))
+    print(f'saved {os.path.join(run_dir, RATES_FILE)}')
+    if args.plot or args.save:
+        plot_rates(summary, args.save, show=args.plot)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# Compact binary event format for the TDC runs.
+#
+# A run is stored in one append-only file hits.tdc in the run directory:
+#
+#   header   '<4sHHd' magic b'TDCB', format version, header size in bytes, clock frequency in Hz,
+#            followed by a JSON object with the channel map and the legacy layout, padded with
+#            spaces to a multiple of 8 bytes so the records can be memory mapped.
+#   records  one 8 byte little endian record per hit, see RECORD_DTYPE.
+#
+# The legacy text layout (fine.txt + coarse.txt for the one channel design,
+# 00.txt ... 11.txt for the four channel design) can be converted in both
+# directions without losing information:
+#
+#   python -m tdc.storage to-binary ./data/<timestamp>
+#   python -m tdc.storage to-text ./data/<timestamp> [output directory]   # or the path of a hits.tdc
+#
+# The run can also be given by its name in ./data, a part of it or 'latest' (see catalog.find_run).
+
+import argparse
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+MAGIC = b'TDCB'
+VERSION = 1
+FILE_NAME = 'hits.tdc'
+HEADER_STRUCT = struct.Struct('<4sHHd')
+
+# Channel index into the channel map, flags, 9 bit fine code and 31 bit coarse counter
+RECORD_DTYPE = np.dtype([('channel', 'u1'), ('flags', 'u1'), ('fine', '<u2'), ('coarse', '<u4')])
+
+# Set if the design has no coarse counter (or the coarse value was missing in the legacy files)
+FLAG_NO_COARSE = 0x01
+# Set if the fine value was missing in the legacy files
+FLAG_NO_FINE = 0x02
+
+# Legacy layouts: one channel with separate fine/coarse files, or one file per channel ID
+LAYOUT_FINE_COARSE = 'fine_coarse'
+LAYOUT_PER_CHANNEL = 'per_channel'
+
+
+# Build the header bytes
+def make_header(clock_hz: float, channels: list[str], layout: str, **extra) -> bytes:
+    meta = json.dumps({'channels': list(channels), 'layout': layout, **extra}).encode()
+    size = HEADER_STRUCT.size + len(meta)
+    size += -size % 8
+    return HEADER_STRUCT.pack(MAGIC, VERSION, size, clock_hz) + meta.ljust(size - HEADER_STRUCT.size)
+
+
+# Read the header of a binary run file
+def read_header(path: str) -> dict:
+    with open(path, 'rb') as f:
+        fixed = f.read(HEADER_STRUCT.size)
+        if len(fixed) < HEADER_STRUCT.size:
+            raise ValueError(f'{path}: file too short for a header')
+        magic, version, size, clock_hz = HEADER_STRUCT.unpack(fixed)
+        if magic != MAGIC:
+            raise ValueError(f'{path}: not a TDC binary file')
+        if version > VERSION:
+            raise ValueError(f'{path}: format version {version} is newer than supported ({VERSION})')
+        meta = json.loads(f.read(size - HEADER_STRUCT.size))
+    return {'version': version, 'header_size': size, 'clock_hz': clock_hz, **meta}
+
+
+class EventWriter:
+    """Append hits to a binary run file. The header is written when the file is created."""
+
+    def __init__(self, path: str, channels: list[str], clock_hz: float = 12e6, layout: str = LAYOUT_PER_CHANNEL,
+                 flush_secs: float = 1.0, **extra):
+        self.path = path
+        self.channels = list(channels)
+        self.flush_secs = flush_secs
+        self.hits = 0
+
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab', buffering=1 << 20)
+        if new:
+            self.file.write(make_header(clock_hz, self.channels, layout, **extra))
+        else:
+            header = read_header(path)
+            if header['channels'] != self.channels:
+                raise ValueError(f'{path}: channel map {header["channels"]} does not match {self.channels}')
+        self.last_flush = time.monotonic()
+        # Duration of the last and of the slowest flush in s
+        self.flush_latency = 0.
+        self.flush_latency_max = 0.
+
+    # Write one batch of hits. channel, flags and coarse can also be scalars
+    def write(self, channel, fine, coarse=0, flags=0) -> None:
+        records = np.empty(len(fine), dtype=RECORD_DTYPE)
+        records['channel'] = channel
+        records['flags'] = flags
+        records['fine'] = fine
+        records['coarse'] = coarse
+        self.write_records(records)
+
+    def write_records(self, records: np.ndarray) -> None:
+        self.file.write(records.tobytes())
+        self.hits += len(records)
+        if time.monotonic() - self.last_flush >= self.flush_secs:
+            self.flush()
+
+    def flush(self) -> None:
+        start = time.monotonic()
+        self.file.flush()
+        self.last_flush = time.monotonic()
+        self.flush_latency = self.last_flush - start
+        self.flush_latency_max = max(self.flush_latency_max, self.flush_latency)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Read all records of a binary run file (memory mapped) together with its header
+def read_events(path: str) -> tuple[dict, np.ndarray]:
+    header = read_header(path)
+    n_records = (os.path.getsize(path) - header['header_size']) // RECORD_DTYPE.itemsize
+    if n_records == 0:
+        return header, np.empty(0, dtype=RECORD_DTYPE)
+    records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=header['header_size'], shape=(n_records,))
+    return header, records
+
+
+# Read a newline separated column of integers
+def read_column(path: str) -> np.ndarray:
+    with open(path, 'rb') as f:
+        return np.fromstring(f.read(), dtype=np.int64, sep=' ')
+
+
+# Detect the legacy text layout of a run directory
+def legacy_layout(run_dir: str) -> tuple[str, list[str]]:
+    if os.path.exists(os.path.join(run_dir, 'fine.txt')):
+        return LAYOUT_FINE_COARSE, ['0']
+    channels = [c for c in ('00', '01', '10', '11') if os.path.exists(os.path.join(run_dir, f'{c}.txt'))]
+    if not channels:
+        raise FileNotFoundError(f'{run_dir}: no fine.txt or 00.txt ... 11.txt found')
+    return LAYOUT_PER_CHANNEL, channels
+
+
+# Convert a legacy text run into a binary file. Returns the path of the binary file
+def text_to_binary(run_dir: str, path: str | None = None, clock_hz: float = 12e6) -> str:
+    path = path or os.path.join(run_dir, FILE_NAME)
+    layout, channels = legacy_layout(run_dir)
+
+    if layout == LAYOUT_FINE_COARSE:
+        fine = read_column(os.path.join(run_dir, 'fine.txt'))
+        coarse_path = os.path.join(run_dir, 'coarse.txt')
+        coarse = read_column(coarse_path) if os.path.exists(coarse_path) else np.empty(0, dtype=np.int64)
+
+        # Keep unpaired values of an interrupted run, marking the missing half
+        n = max(len(fine), len(coarse))
+        records = np.zeros(n, dtype=RECORD_DTYPE)
+        records['fine'][:len(fine)] = fine
+        records['coarse'][:len(coarse)] = coarse
+        records['flags'][len(fine):] |= FLAG_NO_FINE
+        records['flags'][len(coarse):] |= FLAG_NO_COARSE
+
+    else:
+        # Interleave the channels hit by hit, the per-channel order stays unchanged
+        data = [read_column(os.path.join(run_dir, f'{c}.txt')) for c in channels]
+        index = np.concatenate([np.arange(len(d)) for d in data])
+        ids = np.concatenate([np.full(len(d), i) for i, d in enumerate(data)])
+        order = np.lexsort((ids, index))
+
+        records = np.zeros(len(order), dtype=RECORD_DTYPE)
+        records['channel'] = ids[order]
+        records['fine'] = np.concatenate(data)[order]
+        records['flags'] = FLAG_NO_COARSE
+
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    with EventWriter(path, channels, clock_hz, layout) as writer:
+        writer.write_records(records)
+    return path
+
+
+# Convert a binary file back into the legacy text layout
+def binary_to_text(path: str, run_dir: str | None = None) -> str:
+    run_dir = run_dir or os.path.dirname(os.path.abspath(path))
+    header, records = read_events(path)
+    os.makedirs(run_dir, exist_ok=True)
+
+    def write_column(name, values):
+        with open(os.path.join(run_dir, f'{name}.txt'), 'x') as f:
+            f.write(''.join(f'{i}\n' for i in values.tolist()))
+
+    if header['layout'] == LAYOUT_FINE_COARSE:
+        write_column('fine', records['fine'][(records['flags'] & FLAG_NO_FINE) == 0])
+        # A run without any coarse value was interrupted before coarse.txt was written
+        has_coarse = (records['flags'] & FLAG_NO_COARSE) == 0
+        if has_coarse.any() or len(records) == 0:
+            write_column('coarse', records['coarse'][has_coarse])
+    else:
+        for i, channel in enumerate(header['channels']):
+            write_column(channel, records['fine'][records['channel'] == i])
+    return run_dir
+
+
+def main(argv: list[str] | None = None, prog: str | None = None):
+    from .catalog import resolve_run
+
+    parser = argparse.ArgumentParser(prog=prog, description='Convert TDC runs between the text and the binary format')
+    sub = parser.add_subparsers(dest='command', required=True)
+    to_binary = sub.add_parser('to-binary', help='convert fine.txt/coarse.txt or 00.txt ... 11.txt to hits.tdc')
+    to_binary.add_argument('run', help="run folder, run name in --data-dir, part of it or 'latest'")
+    to_binary.add_argument('-o', '--output', default=None)
+    to_binary.add_argument('--clock', type=float, default=12e6, help='clock frequency in Hz')
+    to_text = sub.add_parser('to-text', help='convert hits.tdc back to text files')
+    to_text.add_argument('path', help="hits.tdc, its run folder, run name in --data-dir, part of it or 'latest'")
+    to_text.add_argument('run_dir', nargs='?', default=None)
+    for command in (to_binary, to_text):
+        command.add_argument('--data-dir', default='./data')
+    args = parser.parse_args(argv)
+
+    if args.command == 'to-binary':
+        print(text_to_binary(resolve_run(args.run, args.data_dir), args.output, args.clock))
+    else:
+        path = args.path if os.path.isfile(args.path) else os.path.join(resolve_run(args.path, args.data_dir), FILE_NAME)
+        print(binary_to_text(path, args.run_dir))
+
+
+if __name__ == '__main__':
+    main()
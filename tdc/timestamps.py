@@ -0,0 +1,132 @@
+# Absolute timestamps in picoseconds from the coarse counter and the calibrated fine code.
+#
+# The coarse counter counts the clock edges, the delay line measures how far the
+# signal travelled between its arrival and the next clock edge. The time of a hit is
+# therefore
+#
+#   t = ticks * T - fine_time
+#
+# with ticks the unwrapped coarse counter (coarse.py), T the clock period and
+# fine_time the bin center of the fine code from the calibration LUT (calib.py).
+# The timestamps are int64 ps since the first hit; the clock period is applied in
+# integer arithmetic so runs of many hours stay exact to the ps.
+#
+# The run is processed in chunks of a fixed number of hits, so peak memory only
+# depends on the chunk size:
+#
+#   for stamps in iter_timestamps('./data/<timestamp>'):
+#       ...                                            # dict channel -> int64 ps
+#   python -m tdc.timestamps ./data/<timestamp>         # writes timestamps/<channel>.i8
+
+import argparse
+import math
+import os
+from typing import Iterator
+
+import numpy as np
+
+from .calib import Lut, calibrate_run, load_luts
+from .coarse import COARSE_PERIOD, Unwrapper
+from .loader import RECORD_BLOCK, Run
+
+TIMESTAMP_DIR = 'timestamps'
+
+
+# Convert ticks to ps exactly: ps = ticks * 10^12 / clock_hz, split as quotient and remainder so nothing overflows int64
+def ticks_to_ps(ticks: np.ndarray, clock_hz: float) -> np.ndarray:
+    clock = int(round(clock_hz))
+    g = math.gcd(10**12, clock)
+    num, den = 10**12 // g, clock // g
+    ticks = np.asarray(ticks, dtype=np.int64)
+    return ticks // den * num + (ticks % den) * num // den
+
+
+class TimestampBuilder:
+    """Turns chunks of (fine, coarse) of one channel into int64 ps timestamps, keeping the unwrap state."""
+
+    def __init__(self, lut: Lut, clock_hz: float = 12e6, period: int = COARSE_PERIOD):
+        self.lut = lut
+        self.clock_hz = clock_hz
+        self.unwrapper = Unwrapper(period)
+        # Bin centers in ps, the overflow code gets the time of the last bin
+        self.fine_ps = np.rint(lut.centers * 1e3).astype(np.int64)
+
+    def feed(self, fine: np.ndarray, coarse: np.ndarray) -> np.ndarray:
+        ticks = self.unwrapper.feed(coarse)
+        return ticks_to_ps(ticks, self.clock_hz) - self.fine_ps[np.minimum(fine, len(self.fine_ps) - 1)]
+
+
+# Load the saved LUTs of a run, or calibrate it chunk by chunk if it has none
+def run_luts(run_dir: str, channels: list[str], clock_hz: float = 12e6) -> dict[str, Lut]:
+    try:
+        return load_luts(run_dir, channels)
+    except FileNotFoundError:
+        return calibrate_run(run_dir, channels, clock_hz)
+
+
+# Iterate over the timestamps of a run, chunk hits per channel at a time
+def iter_timestamps(run_dir: str, channels: list[str] | None = None, luts: dict[str, Lut] | None = None,
+                    chunk: int = RECORD_BLOCK) -> Iterator[dict[str, np.ndarray]]:
+    run = Run(run_dir)
+    if not run.has_coarse:
+        raise ValueError(f'{run_dir}: the run has no coarse counter, absolute timestamps can not be built')
+    channels = list(run.channels) if channels is None else list(channels)
+    luts = luts or run_luts(run_dir, channels, run.clock_hz)
+    builders = {c: TimestampBuilder(luts[c], run.clock_hz) for c in channels}
+
+    for hits in run.iter_chunks(channels, chunk):
+        yield {c: builders[c].feed(h.fine, h.coarse) for c, h in hits.items()}
+
+    for channel, builder in builders.items():
+        if builder.unwrapper.wraps or builder.unwrapper.resets:
+            print(f'{run_dir} {channel}: {builder.unwrapper.report()}')
+
+
+def timestamp_path(run_dir: str, channel: str) -> str:
+    return os.path.join(run_dir, TIMESTAMP_DIR, f'{channel}.i8')
+
+
+# Write the timestamps of each channel to timestamps/<channel>.i8 (raw little endian int64). Returns the hits per channel
+def write_timestamps(run_dir: str, channels: list[str] | None = None, luts: dict[str, Lut] | None = None,
+                     chunk: int = RECORD_BLOCK) -> dict[str, int]:
+    channels = list(Run(run_dir).channels) if channels is None else list(channels)
+    os.makedirs(os.path.join(run_dir, TIMESTAMP_DIR), exist_ok=True)
+    files = {c: open(timestamp_path(run_dir, c), 'wb') for c in channels}
+    counts = {c: 0 for c in channels}
+    try:
+        for stamps in iter_timestamps(run_dir, channels, luts, chunk):
+            for channel, t in stamps.items():
+                t.astype('<i8').tofile(files[channel])
+                counts[channel] += len(t)
+    finally:
+        for f in files.values():
+            f.close()
+    return counts
+
+
+# Memory map the timestamps written by write_timestamps
+def load_timestamps(run_dir: str, channel: str) -> np.ndarray:
+    path = timestamp_path(run_dir, channel)
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype='<i8')
+    return np.memmap(path, dtype='<i8', mode='r')
+
+
+def main(argv: list[str] | None = None, prog: str | None = None):
+    from .catalog import resolve_run
+
+    parser = argparse.ArgumentParser(prog=prog, description='Build absolute ps timestamps from coarse and calibrated fine values')
+    parser.add_argument('run', nargs='?', default='latest',
+                        help="run folder, run name in --data-dir, part of it or 'latest'")
+    parser.add_argument('--data-dir', default='./data')
+    parser.add_argument('-c', '--channels', nargs='+', default=None)
+    parser.add_argument('--chunk', type=int, default=RECORD_BLOCK, help='hits per chunk')
+    args = parser.parse_args(argv)
+
+    run_dir = resolve_run(args.run, args.data_dir)
+    for channel, n in write_timestamps(run_dir, args.channels, chunk=args.chunk).items():
+        print(f'{timestamp_path(run_dir, channel)}: {n} hits')
+
+
+if __name__ == '__main__':
+    main()
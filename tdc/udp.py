@@ -0,0 +1,185 @@
+# UDP receiver for the OneChannel_Ethernet design.
+#
+# The Ethernet design sends the same 5 byte fine+coarse records as the UART
+# design (fifo_writer.vhd), framed by sop/eop for the TSE MAC. On the host, the
+# datagrams are received with recv_into straight into one preallocated buffer
+# and handed on as one bytes block per read, so the 5 byte records of many
+# datagrams are decoded in a single decode_frames call.
+#
+# UdpReceiver has the read()/in_waiting interface of a serial port, so it can be
+# used in place of `ser` in AcquisitionPipeline, FrameDecoder.read and the
+# readout scripts. Everything downstream (hits.tdc, live histogram, online
+# calibration) stays the same.
+#
+# Lost data is detected in two ways:
+#   - optional sequence number: if the sender prefixes each datagram with a
+#     seq_bytes little endian counter, skipped numbers are counted as lost
+#     datagrams. The current hardware sends no sequence number (seq_bytes = 0).
+#   - coarse gaps: for a periodic input signal, a step of the coarse counter much
+#     larger than the usual step means hits were lost (CoarseGapDetector).
+#
+# send_frames() is a simple local sender to test the receiver without hardware.
+
+import socket
+import time
+
+import numpy as np
+
+from .coarse import COARSE_PERIOD
+from .decode import FRAME_BYTES, encode_frames
+
+DEFAULT_PORT = 5000
+# Largest datagram that is expected (jumbo frames included)
+MAX_DATAGRAM = 9000
+
+
+class UdpReceiver:
+    """Receive the record datagrams on host:port and return their payload like a serial port would."""
+
+    def __init__(self, host: str = '0.0.0.0', port: int = DEFAULT_PORT, seq_bytes: int = 0,
+                 buffer_bytes: int = 1 << 22, max_datagram: int = MAX_DATAGRAM, timeout: float = 0.1,
+                 rcvbuf: int = 1 << 25, sock: socket.socket | None = None):
+        # sock: an already bound socket, e.g. bound before the imports so no datagram of the start is lost
+        self.sock = sock
+        if sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # A large kernel buffer bridges short stalls of the reading thread. The OS may limit the size (net.core.rmem_max)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+            self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+
+        self.seq_bytes = seq_bytes
+        self.max_datagram = max_datagram
+        self.buffer_bytes = buffer_bytes
+        self.timeout = timeout
+        self._buf = bytearray(buffer_bytes + max_datagram)
+        self._view = memoryview(self._buf)
+
+        self.datagrams = 0
+        self.bytes = 0
+        self.lost_datagrams = 0
+        self.bad_datagrams = 0
+        self.bytes_discarded = 0
+        self.last_seq = None
+
+    # Serial port interface: read() returns as much as fits into the buffer anyway
+    @property
+    def in_waiting(self) -> int:
+        return self.buffer_bytes
+
+    # Wait up to timeout for the first datagram, then take all datagrams that are already waiting
+    # (at most size bytes). Returns the payload of complete records only.
+    def read(self, size: int | None = None) -> bytes:
+        size = min(size or self.buffer_bytes, self.buffer_bytes)
+        view = self._view
+        pos = 0
+        self.sock.settimeout(self.timeout)
+        try:
+            while pos < size:
+                n = self.sock.recv_into(view[pos:], self.max_datagram)
+                if pos == 0:
+                    self.sock.setblocking(False)
+                self.datagrams += 1
+                pos += self._check(pos, n)
+        except (BlockingIOError, socket.timeout):
+            pass
+        self.bytes += pos
+        return bytes(view[:pos])
+
+    # Strip and check the sequence number and cut incomplete records. Returns the payload length
+    def _check(self, pos: int, n: int) -> int:
+        s = self.seq_bytes
+        if s:
+            if n < s:
+                self.bad_datagrams += 1
+                self.bytes_discarded += n
+                return 0
+            seq = int.from_bytes(self._buf[pos:pos + s], 'little')
+            if self.last_seq is not None:
+                self.lost_datagrams += (seq - self.last_seq - 1) % (1 << 8 * s)
+            self.last_seq = seq
+            self._buf[pos:pos + n - s] = self._buf[pos + s:pos + n]
+            n -= s
+        extra = n % FRAME_BYTES
+        if extra:
+            self.bad_datagrams += 1
+            self.bytes_discarded += extra
+        return n - extra
+
+    def stats(self) -> dict:
+        return {
+            'datagrams': self.datagrams,
+            'bytes': self.bytes,
+            'lost_datagrams': self.lost_datagrams,
+            'bad_datagrams': self.bad_datagrams,
+            'bytes_discarded': self.bytes_discarded,
+        }
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CoarseGapDetector:
+    """Count steps of the coarse counter larger than factor times the typical step.
+
+    Only meaningful for a periodic input signal. The typical step is the median step of the
+    last batch with enough hits.
+    """
+
+    def __init__(self, factor: float = 1.5, period: int = COARSE_PERIOD, min_hits: int = 16):
+        self.factor = factor
+        self.period = period
+        self.min_hits = min_hits
+        self.step = None
+        self.last = None
+        self.gaps = 0
+        self.missing = 0
+
+    # Returns the number of gaps found in this batch
+    def check(self, coarse: np.ndarray) -> int:
+        coarse = np.asarray(coarse, dtype=np.int64)
+        if len(coarse) == 0:
+            return 0
+        steps = np.diff(coarse, prepend=coarse[0] if self.last is None else self.last) % self.period
+        if self.last is None:
+            steps = steps[1:]
+        self.last = int(coarse[-1])
+        if len(steps) >= self.min_hits:
+            self.step = max(float(np.median(steps)), 1.)
+        if self.step is None:
+            return 0
+        gap = steps > self.factor * self.step
+        n = int(gap.sum())
+        self.gaps += n
+        self.missing += int(np.rint(steps[gap] / self.step).sum()) - n
+        return n
+
+
+# Send the records as datagrams of frames_per_datagram records to host:port, optionally with a
+# sequence number. rate limits the bytes/s (None: as fast as possible). Returns the datagrams sent.
+def send_frames(fine: np.ndarray, coarse: np.ndarray, host: str = '127.0.0.1', port: int = DEFAULT_PORT,
+                frames_per_datagram: int = 256, seq_bytes: int = 0, rate: float | None = None,
+                skip: set[int] = frozenset()) -> int:
+    data = encode_frames(fine, coarse)
+    size = frames_per_datagram * FRAME_BYTES
+    start = time.perf_counter()
+    sent = 0
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for seq, lo in enumerate(range(0, len(data), size)):
+            # skip: datagram numbers that are dropped on purpose
+            if seq in skip:
+                continue
+            header = (seq % (1 << 8 * seq_bytes)).to_bytes(seq_bytes, 'little') if seq_bytes else b''
+            sock.sendto(header + data[lo:lo + size], (host, port))
+            sent += 1
+            if rate:
+                ahead = (lo + size) / rate - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+    return sent
@@ -0,0 +1,38 @@
+# Tests of picking runs by folder or by name.
+
+import os
+
+import pytest
+
+from tdc.catalog import resolve_run
+from tdc.cli import main
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    for name in ['2025-02-20_09:00:00', '2025-02-21_10:00:00']:
+        os.makedirs(tmp_path / name)
+        with open(tmp_path / name / '00.txt', 'w') as f:
+            f.write('1\n2\n3\n')
+    return str(tmp_path)
+
+
+def test_resolve_run(data_dir):
+    folder = os.path.join(data_dir, '2025-02-20_09:00:00')
+    assert resolve_run(folder, data_dir) == folder
+    assert resolve_run('latest', data_dir) == os.path.join(data_dir, '2025-02-21_10:00:00')
+    assert resolve_run('02-20', data_dir) == folder
+    with pytest.raises(FileNotFoundError, match='no run matching'):
+        resolve_run('2024', data_dir)
+
+
+# Every subcommand that reads a run takes both a folder and a name
+@pytest.mark.parametrize('spec', ['folder', 'latest'])
+def test_commands_take_folder_and_name(data_dir, spec, capsys):
+    run = os.path.join(data_dir, '2025-02-21_10:00:00') if spec == 'folder' else spec
+    main(['calibrate', run, '--data-dir', data_dir, '--recompute'])
+    main(['drift', 'build', run, '--data-dir', data_dir, '--rebuild'])
+    main(['runs', 'show', run, '--data-dir', data_dir])
+    main(['convert', 'to-binary', run, '--data-dir', data_dir, '-o', os.path.join(data_dir, f'{spec}.tdc')])
+    out = capsys.readouterr().out
+    assert '00: 3 hits' in out and 'channel 00: 3 hits' in out
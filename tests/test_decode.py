@@ -0,0 +1,161 @@
+# Tests of the frame decoders: bulk decoding and resynchronization after lost bytes.
+
+import numpy as np
+import pytest
+
+from tdc.decode import (CHANNEL_FRAME_BYTES, FRAME_BYTES, MAX_FINE, SEARCH_BYTES, ChannelFrameDecoder, FrameDecoder,
+                        decode_channel_frames, decode_frames, encode_channel_frames, encode_frames)
+
+N_FRAMES = 20000
+
+
+def coarse_stream(n: int = N_FRAMES, seed: int = 0) -> tuple[np.ndarray, np.ndarray, bytes]:
+    rng = np.random.default_rng(seed)
+    fine = rng.integers(0, MAX_FINE + 1, n).astype(np.uint16)
+    coarse = np.sort(rng.integers(0, 2**31, n)).astype(np.uint32)
+    return fine, coarse, encode_frames(fine, coarse)
+
+
+def channel_stream(n: int = N_FRAMES, seed: int = 0) -> tuple[np.ndarray, np.ndarray, bytes]:
+    rng = np.random.default_rng(seed)
+    channel = np.tile(np.arange(4), n // 4).astype(np.uint8)
+    fine = rng.integers(0, MAX_FINE + 1, n).astype(np.uint16)
+    return channel, fine, encode_channel_frames(channel, fine)
+
+
+STREAMS = {
+    'coarse': (FrameDecoder, coarse_stream, FRAME_BYTES),
+    'channels': (ChannelFrameDecoder, channel_stream, CHANNEL_FRAME_BYTES),
+}
+
+
+# Feed data in pieces of size bytes and flush at the end, like a serial port read
+def feed_all(decoder, data: bytes, size: int) -> tuple:
+    parts = [decoder.feed(data[lo:lo + size]) for lo in range(0, len(data), size)] + [decoder.flush()]
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+
+# Whether the decoded frames appear in the sent frames in the same order, i.e. no frame was made up
+def is_subsequence(decoded: tuple, sent: tuple) -> bool:
+    sent = list(zip(*(column.tolist() for column in sent)))
+    i = 0
+    for frame in zip(*(column.tolist() for column in decoded)):
+        while i < len(sent) and sent[i] != frame:
+            i += 1
+        if i == len(sent):
+            return False
+        i += 1
+    return True
+
+
+def test_frames_round_trip():
+    fine, coarse, data = coarse_stream(1000)
+    decoded_fine, decoded_coarse, used = decode_frames(data + data[:3])
+    assert used == len(data)
+    assert np.array_equal(decoded_fine, fine) and np.array_equal(decoded_coarse, coarse)
+
+    edges = np.array([0, 1, 255, 256, 511], dtype=np.uint16), np.array([0, 1, 2**31 - 1, 2**30, 12345], dtype=np.uint32)
+    decoded_fine, decoded_coarse, _ = decode_frames(encode_frames(*edges))
+    assert np.array_equal(decoded_fine, edges[0]) and np.array_equal(decoded_coarse, edges[1])
+
+
+def test_channel_frames_round_trip():
+    channel, fine, data = channel_stream(1000)
+    decoded_channel, decoded_fine, used = decode_channel_frames(data + data[:1])
+    assert used == len(data)
+    assert np.array_equal(decoded_channel, channel) and np.array_equal(decoded_fine, fine)
+
+
+@pytest.mark.parametrize('name', STREAMS)
+@pytest.mark.parametrize('size', [997, 64, 7])
+def test_clean_stream(name, size):
+    decoder_type, make_stream, _ = STREAMS[name]
+    *sent, data = make_stream()
+    decoder = decoder_type(log=None)
+    decoded = feed_all(decoder, data, size)
+    assert all(np.array_equal(d, s) for d, s in zip(decoded, sent))
+    assert decoder.sync_errors == 0 and decoder.bytes_discarded == 0
+
+
+# Three single bytes deleted in the middle of the stream, fed in odd-sized pieces. Every deleted byte destroys
+# the frame it belonged to; at most one more frame next to it may be dropped, but none is made up
+@pytest.mark.parametrize('name', STREAMS)
+@pytest.mark.parametrize('size', [997, 64, 7])
+@pytest.mark.parametrize('seed', range(5))
+def test_lost_bytes(name, size, seed):
+    decoder_type, make_stream, frame_bytes = STREAMS[name]
+    *sent, data = make_stream(seed=seed)
+    holes = np.sort(np.random.default_rng(seed).choice(np.arange(100, len(data) - 100), 3, replace=False))
+    damaged = np.delete(np.frombuffer(data, dtype=np.uint8), holes).tobytes()
+
+    decoder = decoder_type(log=None)
+    decoded = feed_all(decoder, damaged, size)
+    assert is_subsequence(decoded, sent)
+    assert N_FRAMES - 6 <= len(decoded[0]) <= N_FRAMES - 3
+    assert decoder.sync_errors == 3
+    assert decoder.bytes_discarded == len(damaged) - frame_bytes * len(decoded[0]) - len(decoder.rest)
+
+
+# The reviewed case: bytes deleted at known offsets, fed in 997 byte pieces
+def test_lost_bytes_known_offsets():
+    fine, coarse, data = coarse_stream()
+    damaged = np.delete(np.frombuffer(data, dtype=np.uint8), [1000, 50001, 77777]).tobytes()
+    decoder = FrameDecoder(log=None)
+    decoded = feed_all(decoder, damaged, 997)
+    assert is_subsequence(decoded, (fine, coarse))
+    assert len(decoded[0]) == 19997
+    assert decoder.sync_errors == 3
+    assert decoder.bytes_discarded == 12
+
+
+# A frame of a channel stream hit by a lost byte looks plausible: the channel is right, the fine value is made
+# of the first byte of the next frame. It has to be dropped, also when it is the last frame of a feed
+@pytest.mark.parametrize('size', [997, 2 * 5001, 64])
+def test_lost_channel_byte(size):
+    channel, fine, data = channel_stream()
+    damaged = np.delete(np.frombuffer(data, dtype=np.uint8), [2 * 5000 + 1]).tobytes()
+    decoder = ChannelFrameDecoder(log=None)
+    decoded = feed_all(decoder, damaged, size)
+    assert np.array_equal(decoded[0], np.delete(channel, 5000)) and np.array_equal(decoded[1], np.delete(fine, 5000))
+    assert decoder.sync_errors == 1
+    assert decoder.bytes_discarded == 1
+
+
+# More garbage than SEARCH_BYTES: the search continues over the whole buffer
+@pytest.mark.parametrize('name', STREAMS)
+def test_long_garbage(name):
+    decoder_type, make_stream, frame_bytes = STREAMS[name]
+    *sent, data = make_stream()
+    cut = 1000 * frame_bytes
+    garbage = b'\xff' * (SEARCH_BYTES + 1001)
+    decoder = decoder_type(log=None)
+    decoded = feed_all(decoder, data[:cut] + garbage + data[cut:], 1 << 16)
+    assert all(np.array_equal(d, s) for d, s in zip(decoded, sent))
+    assert decoder.sync_errors == 1
+    assert decoder.bytes_discarded == len(garbage)
+
+
+# A dropped chunk (skip): the partial frame is discarded and the stream is locked again without made up frames
+@pytest.mark.parametrize('name', STREAMS)
+def test_skip(name):
+    decoder_type, make_stream, frame_bytes = STREAMS[name]
+    *sent, data = make_stream()
+    size = 997
+    pieces = [data[lo:lo + size] for lo in range(0, len(data), size)]
+    dropped = (10, 11, 40)
+    decoder = decoder_type(log=None)
+    parts = []
+    for i, piece in enumerate(pieces):
+        if i in dropped:
+            decoder.skip(len(piece))
+        else:
+            parts.append(decoder.feed(piece))
+    parts.append(decoder.flush())
+    decoded = tuple(np.concatenate(column) for column in zip(*parts))
+    assert is_subsequence(decoded, sent)
+    assert decoder.sync_errors == 3
+    # The dropped bytes are counted as discarded
+    assert decoder.bytes_discarded == len(data) - frame_bytes * len(decoded[0]) - len(decoder.rest)
+    # Besides the frames of the dropped chunks, only the partial frames around the two holes are lost
+    received = len(data) - sum(len(pieces[i]) for i in dropped)
+    assert len(decoded[0]) >= received // frame_bytes - 2 * 2
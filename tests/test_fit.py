@@ -0,0 +1,22 @@
+# The histogram of the fit has the range of the original plot_hist.
+
+import numpy as np
+import pytest
+
+from tdc.fit import hist_edges
+
+# Time differences in ps, also with the maximum between -100 and 0 where rounding before adding 100 shifts the range
+DATA = [[-250.5, -0.5], [-120.0, -50.2], [-250.5, -99.9], [12.0, 199.5], [-40.0, 0.0], [-330.7, 410.3]]
+
+
+# The TH1F range of plot_hist in calibration.py
+def plot_hist_range(data) -> tuple[float, float]:
+    range_ = [int(np.min(data)//100 * 100) - 50, int((np.max(data)) + 100)//100 * 100 + 50]
+    return range_[0] - 100, range_[1] + 100
+
+
+@pytest.mark.parametrize('data', DATA)
+def test_hist_edges(data):
+    edges = hist_edges(np.array(data))
+    assert (edges[0], edges[-1]) == plot_hist_range(np.array(data))
+    assert np.allclose(np.diff(edges), 100)
@@ -0,0 +1,124 @@
+# Tests of the run loader and of the analysis entry points that read runs through it.
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from tdc.drift import build_drift
+from tdc.loader import Run
+from tdc.rates import analyze_run
+from tdc.storage import FILE_NAME, FLAG_NO_COARSE, FLAG_NO_FINE, LAYOUT_FINE_COARSE, LAYOUT_PER_CHANNEL, EventWriter
+from tdc.timestamps import write_timestamps
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COARSE_DIST = [os.path.join(ROOT, 'Max1000', 'OneChannel_FineAndCoarse', 'Analysis', 'coarse_dist.py'),
+               os.path.join(ROOT, 'Max10_Development', 'OneChannel_UART', 'Analysis', 'coarse_dist.py')]
+
+
+def write_text(run_dir, name: str, values) -> None:
+    os.makedirs(run_dir, exist_ok=True)
+    with open(os.path.join(run_dir, name), 'w') as f:
+        f.write(''.join(f'{v}\n' for v in values))
+
+
+def write_binary(run_dir, channels: list[str], layout: str, ids, fine, coarse, flags) -> Run:
+    os.makedirs(run_dir, exist_ok=True)
+    with EventWriter(os.path.join(run_dir, FILE_NAME), channels, 12e6, layout) as out:
+        out.write(ids, fine, coarse, flags)
+    return Run(str(run_dir))
+
+
+def concat_chunks(run: Run, channel: str, **kwargs) -> np.ndarray:
+    chunks = [c[channel].fine for c in run.iter_chunks(**kwargs) if channel in c]
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.uint16)
+
+
+NO_FINE = np.zeros(10, dtype=np.uint8)
+NO_FINE[[1, 4]] = FLAG_NO_FINE
+
+# Single channel files: the four channel design with one channel writes every record with FLAG_NO_COARSE,
+# an interrupted one channel run has records without a fine value
+SINGLE = {
+    'per_channel': (['00'], LAYOUT_PER_CHANNEL, np.full(10, FLAG_NO_COARSE, dtype=np.uint8)),
+    'fine_coarse': (['0'], LAYOUT_FINE_COARSE, NO_FINE),
+}
+RANGES = [(0, None), (2, 5), (7, 20), (20, None)]
+
+
+@pytest.mark.parametrize('name', SINGLE)
+@pytest.mark.parametrize('start, stop', RANGES)
+def test_load_single_channel(tmp_path, name, start, stop):
+    channels, layout, flags = SINGLE[name]
+    run = write_binary(tmp_path / name, channels, layout, 0, np.arange(10), np.arange(10), flags)
+    valid = np.arange(10)[(flags & run._invalid_flags()) == 0]
+    loaded = run.load(start=start, stop=stop)[channels[0]]
+    assert list(loaded.fine) == list(valid[start:stop])
+    assert np.array_equal(loaded.fine, concat_chunks(run, channels[0], start=start, stop=stop, chunk=3))
+    if run.has_coarse:
+        assert list(loaded.coarse) == list(valid[start:stop])
+    else:
+        assert loaded.coarse is None
+
+
+@pytest.mark.parametrize('start, stop', RANGES)
+def test_load_per_channel(tmp_path, start, stop):
+    channels = ['00', '01', '10', '11']
+    ids = np.tile(np.arange(4), 10)
+    fine = np.arange(40)
+    flags = np.full(40, FLAG_NO_COARSE, dtype=np.uint8)
+    flags[[5, 6, 21]] |= FLAG_NO_FINE
+    run = write_binary(tmp_path / 'four', channels, LAYOUT_PER_CHANNEL, ids, fine, 0, flags)
+    hits = run.load(start=start, stop=stop)
+    for i, channel in enumerate(channels):
+        valid = fine[(ids == i) & ((flags & FLAG_NO_FINE) == 0)]
+        assert list(hits[channel].fine) == list(valid[start:stop])
+        assert hits[channel].coarse is None
+        assert np.array_equal(hits[channel].fine, concat_chunks(run, channel, start=start, stop=stop, chunk=7))
+
+
+# A run of the one channel design interrupted before coarse.txt was written
+@pytest.fixture
+def fine_only(tmp_path):
+    run_dir = tmp_path / 'data' / '2025-02-21_10:00:00'
+    write_text(run_dir, 'fine.txt', [1, 2, 3, 300, 5])
+    return str(run_dir)
+
+
+def test_fine_only_has_no_coarse(fine_only):
+    run = Run(fine_only)
+    assert not run.has_coarse
+    hits = run.load()['0']
+    assert hits.coarse is None and list(hits.fine) == [1, 2, 3, 300, 5]
+    chunks = [c['0'] for c in run.iter_chunks(chunk=2)]
+    assert all(c.coarse is None for c in chunks)
+    assert list(np.concatenate([c.fine for c in chunks])) == [1, 2, 3, 300, 5]
+
+
+def test_fine_only_timestamps(fine_only):
+    with pytest.raises(ValueError, match='no coarse counter'):
+        write_timestamps(fine_only)
+
+
+def test_fine_only_rates(fine_only):
+    with pytest.raises(ValueError, match='no coarse counter'):
+        analyze_run(fine_only, save=False)
+
+
+def test_fine_only_drift(fine_only):
+    store = build_drift(fine_only, width_hits=2)
+    assert store.unit == 'hits'
+    view = store.view()
+    assert view.unit == 'hits'
+    assert view.hits.sum() == 5
+
+
+@pytest.mark.parametrize('script', COARSE_DIST, ids=['max1000', 'max10'])
+def test_fine_only_coarse_dist(fine_only, script):
+    env = {**os.environ, 'PYTHONPATH': ROOT, 'MPLBACKEND': 'Agg'}
+    result = subprocess.run([sys.executable, script], cwd=os.path.dirname(os.path.dirname(fine_only)), env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 1
+    assert 'no coarse values' in result.stderr
@@ -0,0 +1,68 @@
+# The chunked, multi-process calibration and event building must give the same results as a single pass.
+
+import os
+
+import numpy as np
+import pytest
+
+from tdc.calib import calibrate, remove_overflow
+from tdc.coincidence import build_events, event_values
+from tdc.loader import load_run
+from tdc.parallel import calibrate_parallel, coincidence_parallel
+from tdc.storage import FILE_NAME, FLAG_NO_COARSE, FLAG_NO_FINE, EventWriter
+
+CHANNELS = ['00', '01', '10', '11']
+LENGTHS = [1000, 990, 1003, 1000]
+OVERFLOW = 280
+# Records per chunk, well below the length of the run
+CHUNK = 97
+OFFSETS = {'00': -1}
+
+
+# Four channel run with interleaved channels, overflow codes in every channel and a few records without fine value
+@pytest.fixture(scope='module')
+def run_dir(tmp_path_factory):
+    rng = np.random.default_rng(1)
+    run_dir = tmp_path_factory.mktemp('parallel')
+    ids = rng.permutation(np.repeat(np.arange(len(CHANNELS)), LENGTHS))
+    fine = rng.integers(0, OVERFLOW, len(ids))
+    fine[rng.random(len(ids)) < 0.01] = OVERFLOW
+    flags = np.full(len(ids), FLAG_NO_COARSE, dtype=np.uint8)
+    flags[rng.choice(len(ids), 5, replace=False)] |= FLAG_NO_FINE
+    with EventWriter(os.path.join(run_dir, FILE_NAME), CHANNELS, 12e6) as out:
+        out.write(ids, fine, flags=flags)
+    return str(run_dir)
+
+
+@pytest.fixture(scope='module')
+def fine(run_dir):
+    return {channel: np.asarray(hits.fine) for channel, hits in load_run(os.path.basename(run_dir), CHANNELS,
+                                                                         data_dir=os.path.dirname(run_dir)).items()}
+
+
+def test_calibrate_parallel(run_dir, fine):
+    expected = calibrate(remove_overflow(fine), 12e6)
+    luts = calibrate_parallel(run_dir, chunk=CHUNK, processes=2, save=False)
+    for channel in CHANNELS:
+        assert np.array_equal(luts[channel].counts, expected[channel].counts)
+        assert np.allclose(luts[channel].centers, expected[channel].centers)
+
+
+# The path of coincidence() in FourChannels calibration.py: overflow hits are dropped per channel, the hit
+# numbers (channel 00 off by one) are the stamps
+@pytest.mark.parametrize('window', [0, 1, 3])
+@pytest.mark.parametrize('min_fold', [2, 3, 4])
+def test_coincidence_parallel(run_dir, fine, window, min_fold):
+    luts = calibrate(remove_overflow(fine), 12e6)
+    keep = {c: fine[c] != np.max(fine[c]) for c in CHANNELS}
+    stamps = {c: (np.arange(len(fine[c])) + OFFSETS.get(c, 0))[keep[c]] for c in CHANNELS}
+    expected = build_events(stamps, window, min_fold)
+    expected_times = event_values(expected, {c: luts[c].centers[fine[c][keep[c]]] for c in CHANNELS})
+
+    events, times = coincidence_parallel(run_dir, window=window, min_fold=min_fold, offsets=OFFSETS, luts=luts,
+                                         chunk=CHUNK, processes=2)
+    assert len(events) == len(expected)
+    assert np.array_equal(events.index, expected.index)
+    assert np.array_equal(events.fold, expected.fold)
+    assert np.array_equal(events.start, expected.start)
+    assert np.array_equal(times, expected_times, equal_nan=True)
@@ -0,0 +1,94 @@
+# Round trips between the legacy text layout and the binary hits.tdc.
+
+import filecmp
+import os
+
+import numpy as np
+import pytest
+
+from tdc.storage import (FILE_NAME, FLAG_NO_COARSE, FLAG_NO_FINE, LAYOUT_FINE_COARSE, LAYOUT_PER_CHANNEL, RECORD_DTYPE,
+                         EventWriter, binary_to_text, read_events, text_to_binary)
+
+
+def write_text(run_dir, name: str, values) -> None:
+    os.makedirs(run_dir, exist_ok=True)
+    with open(os.path.join(run_dir, name), 'w') as f:
+        f.write(''.join(f'{v}\n' for v in values))
+
+
+# Convert the text run in run_dir to binary and back into a new directory, which must hold the same files
+def round_trip(tmp_path, files: dict[str, list[int]]) -> np.ndarray:
+    run_dir = tmp_path / 'text'
+    for name, values in files.items():
+        write_text(run_dir, name, values)
+    path = text_to_binary(str(run_dir))
+    out_dir = tmp_path / 'back'
+    binary_to_text(path, str(out_dir))
+    assert sorted(os.listdir(out_dir)) == sorted(files)
+    match, mismatch, errors = filecmp.cmpfiles(run_dir, out_dir, list(files), shallow=False)
+    assert not mismatch and not errors
+    return read_events(path)[1]
+
+
+# Fine and coarse lengths of complete and of interrupted one channel runs
+@pytest.mark.parametrize('n_fine, n_coarse', [(10, 10), (10, 7), (7, 10), (0, 0)])
+def test_fine_coarse(tmp_path, n_fine, n_coarse):
+    rng = np.random.default_rng(0)
+    fine = rng.integers(0, 289, n_fine).tolist()
+    coarse = np.sort(rng.integers(0, 2**31, n_coarse)).tolist()
+    records = round_trip(tmp_path, {'fine.txt': fine, 'coarse.txt': coarse})
+
+    assert len(records) == max(n_fine, n_coarse)
+    assert list(records['fine'][:n_fine]) == fine and list(records['coarse'][:n_coarse]) == coarse
+    # Only the unpaired tail is flagged
+    assert list(records['flags'] == 0) == [i < min(n_fine, n_coarse) for i in range(len(records))]
+    assert np.all(records['flags'][n_fine:] & FLAG_NO_FINE)
+    assert np.all(records['flags'][n_coarse:] & FLAG_NO_COARSE)
+
+
+# A run interrupted before coarse.txt was written stays without coarse.txt
+def test_fine_only(tmp_path):
+    records = round_trip(tmp_path, {'fine.txt': [1, 2, 3, 300, 5]})
+    assert np.all(records['flags'] == FLAG_NO_COARSE)
+
+
+@pytest.mark.parametrize('lengths', [{'00': 5, '01': 3, '10': 4, '11': 0}, {'00': 6, '10': 2}])
+def test_per_channel(tmp_path, lengths):
+    rng = np.random.default_rng(1)
+    files = {f'{c}.txt': rng.integers(0, 289, n).tolist() for c, n in lengths.items()}
+    records = round_trip(tmp_path, files)
+
+    header = read_events(str(tmp_path / 'text' / FILE_NAME))[0]
+    assert header['layout'] == LAYOUT_PER_CHANNEL and header['channels'] == list(lengths)
+    assert np.all(records['flags'] == FLAG_NO_COARSE)
+    for i, name in enumerate(files):
+        assert list(records['fine'][records['channel'] == i]) == files[name]
+
+
+# Binary runs as written by the acquisition survive the way through the text layout
+@pytest.mark.parametrize('layout', [LAYOUT_FINE_COARSE, LAYOUT_PER_CHANNEL])
+def test_binary_round_trip(tmp_path, layout):
+    rng = np.random.default_rng(2)
+    if layout == LAYOUT_FINE_COARSE:
+        channels = ['0']
+        records = np.zeros(12, dtype=RECORD_DTYPE)
+        records['fine'] = rng.integers(0, 289, 12)
+        records['coarse'] = np.sort(rng.integers(0, 2**31, 12))
+        # Interrupted after a fine value
+        records['coarse'][-2:] = 0
+        records['flags'][-2:] = FLAG_NO_COARSE
+    else:
+        channels = ['00', '01', '10', '11']
+        records = np.zeros(40, dtype=RECORD_DTYPE)
+        records['channel'] = np.tile(np.arange(4), 10)
+        records['fine'] = rng.integers(0, 289, 40)
+        records['flags'] = FLAG_NO_COARSE
+
+    path = str(tmp_path / 'binary' / FILE_NAME)
+    os.makedirs(os.path.dirname(path))
+    with EventWriter(path, channels, 12e6, layout) as out:
+        out.write_records(records)
+    text_dir = binary_to_text(path, str(tmp_path / 'text'))
+    header, back = read_events(text_to_binary(text_dir))
+    assert header['layout'] == layout and header['channels'] == channels
+    assert np.asarray(back).tobytes() == records.tobytes()